@@ -0,0 +1,82 @@
+"""
+    Benchmark for request authentication
+
+    Times the per request token check.  legacy is the old scheme, parsing the
+    username out of the token and looking its id up, signed is auth.authenticate
+    verifying an HMAC signed token.
+
+    python benchmarks/bench_auth.py [requests] [users]
+"""
+import os
+import sys
+import time
+import shutil
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask_package_mgr import flask_package_mgr
+from flask_package_mgr import package_database
+from flask_package_mgr import auth
+
+def legacy_authenticate(token):
+    username = token.rsplit('-', 1)[1]
+    return package_database.lookup_user_id(username=username)
+
+def report(name, requests, elapsed, queries):
+    print('{m:>7}: {n} checks in {e:.3f}s : {r:.1f} checks/sec, {us:.1f}us/check, {q:.2f} queries/check'.format(
+        m=name,
+        n=requests,
+        e=elapsed,
+        r=requests / elapsed,
+        us=elapsed / requests * 1000000,
+        q=float(queries) / requests
+        ))
+
+def run(requests, users):
+    app = flask_package_mgr.app
+    workdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+
+    queries = [0]
+    query_db = package_database.query_db
+    def counting_query_db(*args, **kwargs):
+        queries[0] += 1
+        return query_db(*args, **kwargs)
+    package_database.query_db = counting_query_db
+
+    try:
+        with app.app_context():
+            flask_package_mgr.init_db()
+            db = flask_package_mgr.get_db()
+            for u in range(users):
+                db.execute(
+                    "INSERT INTO users (username, password, apikey) VALUES (?, 'password', 'ApiKey')",
+                    [ 'user{u}'.format(u=u) ]
+                    )
+            db.commit()
+            signer = auth.get_token_signer()
+            signed = [ signer.sign(u + 1) for u in range(users) ]
+
+        picks = [ random.randrange(users) for i in range(requests) ]
+        for name, check, tokens in (
+                ('legacy', legacy_authenticate, [ 'aValidToken-user{u}'.format(u=u) for u in range(users) ]),
+                ('signed', auth.authenticate, signed)):
+            queries[0] = 0
+            start = time.time()
+            for pick in picks:
+                with app.app_context():
+                    check(tokens[pick])
+            report(name, requests, time.time() - start, queries[0])
+
+        with app.app_context():
+            flask_package_mgr.shutdown_background_services()
+    finally:
+        package_database.query_db = query_db
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    run(requests, users)
@@ -0,0 +1,110 @@
+"""
+    Benchmark for concurrent downloads
+
+    Publishes one file, then downloads it from several threads in each DOWNLOAD_MODE and
+    reports downloads/sec, MB/s sent by the worker and how long a worker is tied up per
+    download.  In the offload modes the front proxy sends the bytes, the worker only
+    resolves the file.
+
+    python benchmarks/bench_download.py [size in MB] [downloads] [clients]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import json
+from flask_package_mgr import flask_package_mgr
+from flask_package_mgr import auth
+
+MODES = [ 'direct', 'x-sendfile', 'x-accel-redirect' ]
+
+def publish(client, token, path):
+    meta = json.dumps({ 'package_name' : 'bench', 'tag' : '1.0' }).replace('"', '\\"')
+    with open(path, 'rb') as upload, tempfile.TemporaryFile() as empty:
+        r = client.post(
+                '/api/v1/packages',
+                headers={ 'token' : token },
+                data={
+                    'file' : (upload, 'bench.txt'),
+                    'json' : (empty, meta, 'application/json')
+                    }
+                )
+    assert 200 == r.status_code, r.data
+
+def run_mode(app, token, mode, megabytes, downloads, clients):
+    app.config['DOWNLOAD_MODE'] = mode
+    busy = []
+    sent = []
+    lock = threading.Lock()
+    def client(n):
+        test_client = app.test_client()
+        for i in range(n):
+            start = time.time()
+            r = test_client.get(
+                    '/api/v1/packages/bench/1.0',
+                    headers={ 'token' : token },
+                    data='{}',
+                    content_type='application/json'
+                    )
+            # the worker is busy until the last byte it sends has been read
+            length = len(r.data)
+            elapsed = time.time() - start
+            assert 200 == r.status_code
+            with lock:
+                busy.append(elapsed)
+                sent.append(length)
+
+    threads = [ threading.Thread(target=client, args=(downloads // clients, )) for c in range(clients) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print('{m:>16}: {n} downloads of {s} MB in {e:.3f}s : {r:.1f} downloads/sec, worker sent {b:.1f} MB/s, {w:.2f}ms busy per download'.format(
+        m=mode,
+        n=len(busy),
+        s=megabytes,
+        e=elapsed,
+        r=len(busy) / elapsed,
+        b=sum(sent) / elapsed / (1024 * 1024),
+        w=sum(busy) / len(busy) * 1000.0
+        ))
+
+def run(megabytes, downloads, clients, modes):
+    app = flask_package_mgr.app
+    workdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+    app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    app.config['PASSWORD_HASH_ITERATIONS'] = 1000
+    os.mkdir(app.config['UPLOAD_FOLDER'])
+    try:
+        with app.app_context():
+            flask_package_mgr.init_db()
+            auth.auth_add_user(username='bench', password='password')
+            token = auth.authorize(username='bench', provided_password='password')['token']
+        path = os.path.join(workdir, 'bench.txt')
+        with open(path, 'wb') as f:
+            for i in range(megabytes):
+                f.write(os.urandom(1024 * 1024))
+        publish(app.test_client(), token, path)
+
+        for mode in modes:
+            run_mode(app, token, mode, megabytes, downloads, clients)
+        with app.app_context():
+            flask_package_mgr.shutdown_background_services()
+    finally:
+        app.config['DOWNLOAD_MODE'] = 'direct'
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    downloads = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    clients = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    run(megabytes, downloads, clients, MODES)
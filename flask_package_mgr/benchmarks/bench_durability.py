@@ -0,0 +1,96 @@
+"""
+    Benchmark for publish durability
+
+    Publishes small files from several threads at each DURABILITY level and reports
+    publishes/sec and the mean time until a publish is acknowledged.  UPLOAD_FSYNC is
+    set to match, so the benchmark also runs against versions without DURABILITY.
+
+    python benchmarks/bench_durability.py [size in KB] [publishes per level] [clients]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import json
+from flask_package_mgr import flask_package_mgr
+from flask_package_mgr import auth
+
+LEVELS = [ 'none', 'file', 'group' ]
+
+def publish(client, token, path, package_name):
+    meta = json.dumps({ 'package_name' : package_name, 'tag' : '1.0' }).replace('"', '\\"')
+    with open(path, 'rb') as upload, tempfile.TemporaryFile() as empty:
+        r = client.post(
+                '/api/v1/packages',
+                headers={ 'token' : token },
+                data={
+                    'file' : (upload, 'bench.txt'),
+                    'json' : (empty, meta, 'application/json')
+                    }
+                )
+    assert 200 == r.status_code, r.data
+
+def run_level(app, token, workdir, level, kilobytes, publishes, clients):
+    app.config['DURABILITY'] = level
+    app.config['UPLOAD_FSYNC'] = level != 'none'
+    latencies = []
+    lock = threading.Lock()
+    def client(c, n):
+        test_client = app.test_client()
+        # distinct content per publish, so every one stores a new blob
+        path = os.path.join(workdir, 'bench{c}.txt'.format(c=c))
+        for i in range(n):
+            with open(path, 'wb') as f:
+                f.write(os.urandom(kilobytes * 1024))
+            start = time.time()
+            publish(test_client, token, path, '{l}-{c}-{i}'.format(l=level, c=c, i=i))
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [ threading.Thread(target=client, args=(c, publishes // clients)) for c in range(clients) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print('{l:>6}: {n} publishes of {s} KB in {e:.3f}s : {r:.1f} publishes/sec, {a:.2f}ms to acknowledge'.format(
+        l=level,
+        n=len(latencies),
+        s=kilobytes,
+        e=elapsed,
+        r=len(latencies) / elapsed,
+        a=sum(latencies) / len(latencies) * 1000.0
+        ))
+
+def run(kilobytes, publishes, clients, levels):
+    app = flask_package_mgr.app
+    workdir = tempfile.mkdtemp(dir=os.getcwd())
+    app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+    app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    app.config['PASSWORD_HASH_ITERATIONS'] = 1000
+    os.mkdir(app.config['UPLOAD_FOLDER'])
+    try:
+        with app.app_context():
+            flask_package_mgr.init_db()
+            auth.auth_add_user(username='bench', password='password')
+            token = auth.authorize(username='bench', provided_password='password')['token']
+        for level in levels:
+            run_level(app, token, workdir, level, kilobytes, publishes, clients)
+        with app.app_context():
+            flask_package_mgr.shutdown_background_services()
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    kilobytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    publishes = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    clients = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    run(kilobytes, publishes, clients, LEVELS)
@@ -0,0 +1,77 @@
+"""
+    Benchmark for logins
+
+    Runs concurrent logins (auth.authorize, the work behind get_token) at several
+    pbkdf2 costs and reports logins/sec and how many were turned away because the
+    hashing queue was full.
+
+    python benchmarks/bench_login.py [logins] [clients] [workers] [iterations,...]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask_package_mgr import flask_package_mgr
+from flask_package_mgr import auth
+from flask_package_mgr.error_handlers import ServiceUnavailableError
+
+def run_cost(app, logins, clients, iterations):
+    app.config['PASSWORD_HASH_ITERATIONS'] = iterations
+    with app.app_context():
+        flask_package_mgr.init_db()
+        auth.auth_add_user(username='bench', password='password')
+
+    counts = { 'ok' : 0, 'busy' : 0 }
+    lock = threading.Lock()
+    def client(n):
+        for i in range(n):
+            with app.app_context():
+                try:
+                    auth.authorize(username='bench', provided_password='password')
+                    result = 'ok'
+                except ServiceUnavailableError:
+                    result = 'busy'
+            with lock:
+                counts[result] += 1
+
+    threads = [ threading.Thread(target=client, args=(logins // clients, )) for c in range(clients) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    with app.app_context():
+        flask_package_mgr.shutdown_background_services()
+
+    print('{i:>7} iterations: {n} logins in {e:.3f}s : {r:.1f} logins/sec, {b} rejected busy'.format(
+        i=iterations,
+        n=counts['ok'],
+        e=elapsed,
+        r=counts['ok'] / elapsed,
+        b=counts['busy']
+        ))
+
+def run(logins, clients, workers, costs):
+    app = flask_package_mgr.app
+    workdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+    app.config['PASSWORD_HASH_WORKERS'] = workers
+    try:
+        for iterations in costs:
+            run_cost(app, logins, clients, iterations)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    costs = [ int(c) for c in sys.argv[4].split(',') ] if len(sys.argv) > 4 else [ 10000, 50000, 100000 ]
+    run(logins, clients, workers, costs)
@@ -0,0 +1,83 @@
+"""
+    Benchmark for download resolution
+
+    Times lookup_filepath, the (package, tag) -> filepath resolution every download
+    goes through, and counts how many queries each resolution sends to sqlite.
+
+    python benchmarks/bench_lookup_filepath.py [lookups] [packages] [tags]
+"""
+import os
+import sys
+import time
+import shutil
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask_package_mgr import flask_package_mgr
+from flask_package_mgr import package_database
+
+def populate(packages, tags):
+    db = flask_package_mgr.get_db()
+    for p in range(packages):
+        package_id = db.execute(
+                "INSERT INTO packages (title, user_id) VALUES (?, 1)",
+                [ 'package{p}'.format(p=p) ]
+                ).lastrowid
+        for t in range(tags):
+            filestore_id = db.execute(
+                    "INSERT INTO filestore (package_filepath) VALUES (?)",
+                    [ '/uploads/package{p}/file{t}.npm'.format(p=p, t=t) ]
+                    ).lastrowid
+            db.execute(
+                    "INSERT INTO tags (tag, package_id, filestore_id) VALUES (?, ?, ?)",
+                    [ '1.{t}'.format(t=t), package_id, filestore_id ]
+                    )
+    db.commit()
+
+def run(lookups, packages, tags):
+    app = flask_package_mgr.app
+    workdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+
+    queries = [0]
+    query_db = package_database.query_db
+    def counting_query_db(*args, **kwargs):
+        queries[0] += 1
+        return query_db(*args, **kwargs)
+    package_database.query_db = counting_query_db
+
+    try:
+        with app.app_context():
+            flask_package_mgr.init_db()
+            populate(packages, tags)
+
+        pairs = [ ('package{p}'.format(p=random.randrange(packages)), '1.{t}'.format(t=random.randrange(tags)))
+                  for i in range(lookups) ]
+
+        start = time.time()
+        for package_name, tag in pairs:
+            with app.app_context():
+                package_database.lookup_filepath(package_name=package_name, tag=tag)
+        elapsed = time.time() - start
+
+        with app.app_context():
+            flask_package_mgr.shutdown_background_services()
+    finally:
+        package_database.query_db = query_db
+        shutil.rmtree(workdir)
+
+    print('{n} lookups in {e:.3f}s : {r:.1f} lookups/sec, {us:.1f}us/lookup, {q:.2f} queries/lookup'.format(
+        n=lookups,
+        e=elapsed,
+        r=lookups / elapsed,
+        us=elapsed / lookups * 1000000,
+        q=float(queries[0]) / lookups
+        ))
+
+if __name__ == '__main__':
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    packages = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    tags = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    run(lookups, packages, tags)
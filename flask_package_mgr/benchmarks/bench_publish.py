@@ -0,0 +1,55 @@
+"""
+    Benchmark for the database side of a publish
+
+    Times store_package_rows, one application context per publish just like a
+    request, against a fresh database in a temporary directory.
+
+    python benchmarks/bench_publish.py [publishes] [packages]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask_package_mgr import flask_package_mgr
+from flask_package_mgr.package_database import store_package_rows
+
+def run(publishes, packages):
+    app = flask_package_mgr.app
+    workdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+    try:
+        with app.app_context():
+            flask_package_mgr.init_db()
+
+        start = time.time()
+        for i in range(publishes):
+            package_name = 'package{p}'.format(p=i % packages)
+            with app.app_context():
+                store_package_rows(
+                    package_name=package_name,
+                    user=1,
+                    filepath=os.path.join(workdir, package_name, 'file{i}.npm'.format(i=i)),
+                    tag='1.{i}'.format(i=i)
+                    )
+        elapsed = time.time() - start
+
+        with app.app_context():
+            flask_package_mgr.shutdown_background_services()
+    finally:
+        shutil.rmtree(workdir)
+
+    print('{n} publishes in {e:.3f}s : {r:.1f} publishes/sec, synchronous={s}'.format(
+        n=publishes,
+        e=elapsed,
+        r=publishes / elapsed,
+        s=app.config['DATABASE_SYNCHRONOUS']
+        ))
+
+if __name__ == '__main__':
+    publishes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    packages = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    run(publishes, packages)
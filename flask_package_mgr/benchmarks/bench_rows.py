@@ -0,0 +1,103 @@
+"""
+    Benchmark for listing rows
+
+    Lists every package and serializes it to json the way GET /api/v1/packages does,
+    reporting rows/sec and the peak memory the listing added.  Each mode runs in its
+    own process so the peak memory of one does not hide another.
+
+        make_dicts - the old row factory, a dict built per row while fetching
+        row        - sqlite3.Row rows, converted to dicts at serialization
+        stream     - the streamed listing, keyset batches encoded as they are read
+
+    python benchmarks/bench_rows.py [rows] [mode]
+"""
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import json
+from flask_package_mgr import flask_package_mgr
+from flask_package_mgr import package_database
+from flask_package_mgr.blueprints.routes import rows_to_dicts, stream_response
+
+MODES = ['make_dicts', 'row', 'stream']
+
+def make_dicts(cursor, row):
+    """
+    the row factory listings used before sqlite3.Row
+    """
+    return dict((cursor.description[idx][0], value) for idx, value in enumerate(row))
+
+def populate(rows):
+    db = flask_package_mgr.get_db()
+    db.executemany(
+        "INSERT INTO packages (title, user_id) VALUES (?, 1)",
+        (('package{p}'.format(p=p),) for p in xrange(rows))
+        )
+    db.commit()
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def list_packages(mode):
+    if mode == 'make_dicts':
+        flask_package_mgr.get_read_db().row_factory = make_dicts
+        rows = package_database.search_all_packages()
+        return len(rows), len(json.dumps(rows))
+    if mode == 'row':
+        rows = package_database.search_all_packages()
+        return len(rows), len(json.dumps(rows_to_dicts(rows)))
+
+    response = stream_response(package_database.iter_all_packages(
+                    batch_size=flask_package_mgr.app.config['LIST_BATCH_SIZE']
+                    ))
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    return None, size
+
+def run_mode(database, mode, rows):
+    app = flask_package_mgr.app
+    app.config['DATABASE'] = database
+    with app.test_request_context():
+        flask_package_mgr.get_read_db().execute('SELECT count(*) FROM packages').fetchone()
+        baseline = peak_rss_kb()
+        start = time.time()
+        list_packages(mode)
+        elapsed = time.time() - start
+        peak = peak_rss_kb() - baseline
+    print('{m:>10} : {r:.0f} rows/sec, {e:.2f}s, peak memory +{p:.1f}MB'.format(
+        m=mode,
+        r=rows / elapsed,
+        e=elapsed,
+        p=peak / 1024.0
+        ))
+
+def run(rows):
+    app = flask_package_mgr.app
+    workdir = tempfile.mkdtemp()
+    database = os.path.join(workdir, 'bench.db')
+    app.config['DATABASE'] = database
+    try:
+        with app.app_context():
+            flask_package_mgr.init_db()
+            populate(rows)
+            flask_package_mgr.close_pool()
+        print('listing {n} packages'.format(n=rows))
+        for mode in MODES:
+            subprocess.check_call([ sys.executable, os.path.abspath(__file__), str(rows), mode, database ])
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    if len(sys.argv) > 3:
+        run_mode(sys.argv[3], sys.argv[2], rows)
+    else:
+        run(rows)
@@ -0,0 +1,81 @@
+"""
+    Benchmark for large uploads
+
+    Publishes files of increasing size through the upload route and reports MB/s
+    and the peak resident memory of the process after each size, which should stay
+    flat however big the upload is.
+
+    python benchmarks/bench_upload.py [sizes in MB,...] [uploads per size]
+"""
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import json
+from flask_package_mgr import flask_package_mgr
+from flask_package_mgr import auth
+
+CHUNK = 1024 * 1024
+
+def make_file(path, megabytes):
+    with open(path, 'wb') as f:
+        for i in range(megabytes):
+            f.write(os.urandom(CHUNK))
+
+def publish(client, token, path, package_name, tag):
+    # the json part travels as the filename, quotes escaped as in the tests
+    meta = json.dumps({ 'package_name' : package_name, 'tag' : tag }).replace('"', '\\"')
+    with open(path, 'rb') as upload, tempfile.TemporaryFile() as empty:
+        r = client.post(
+                '/api/v1/packages',
+                headers={ 'token' : token },
+                data={
+                    'file' : (upload, 'bench.txt'),
+                    'json' : (empty, meta, 'application/json')
+                    }
+                )
+    assert 200 == r.status_code, r.data
+
+def run(sizes, uploads):
+    app = flask_package_mgr.app
+    workdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+    app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    app.config['PASSWORD_HASH_ITERATIONS'] = 1000
+    os.mkdir(app.config['UPLOAD_FOLDER'])
+    try:
+        with app.app_context():
+            flask_package_mgr.init_db()
+            auth.auth_add_user(username='bench', password='password')
+            token = auth.authorize(username='bench', provided_password='password')['token']
+        client = app.test_client()
+
+        for megabytes in sizes:
+            path = os.path.join(workdir, 'bench.txt')
+            make_file(path, megabytes)
+            start = time.time()
+            for i in range(uploads):
+                publish(client, token, path, 'bench{m}-{i}'.format(m=megabytes, i=i), '1.0')
+            elapsed = time.time() - start
+            os.unlink(path)
+            print('{m:>5} MB: {n} uploads in {e:.3f}s : {r:.1f} MB/s, peak rss {p} MB'.format(
+                m=megabytes,
+                n=uploads,
+                e=elapsed,
+                r=megabytes * uploads / elapsed,
+                p=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+                ))
+        with app.app_context():
+            flask_package_mgr.shutdown_background_services()
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    sizes = [ int(s) for s in sys.argv[1].split(',') ] if len(sys.argv) > 1 else [ 1, 16, 64, 256 ]
+    uploads = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    run(sizes, uploads)
@@ -0,0 +1,49 @@
+import os
+import hmac
+import hashlib
+
+PREFIX_BYTES = 6
+SECRET_BYTES = 24
+
+class InvalidApiKeyError(Exception):
+    """
+    raised when an api key is malformed or does not match a stored key
+    """
+    pass
+
+def hash_secret(secret):
+    """
+    api key secrets are long and random, so a single sha256 is enough to store them,
+    unlike passwords they do not need a slow key derivation
+    """
+    return hashlib.sha256(secret).hexdigest()
+
+def generate_apikey():
+    """
+    returns (key, prefix, key_hash).  The key given to the user is <prefix>.<secret>,
+    only the prefix and the hash of the secret are stored
+    """
+    prefix = os.urandom(PREFIX_BYTES).encode('hex')
+    secret = os.urandom(SECRET_BYTES).encode('hex')
+    return '{p}.{s}'.format(p=prefix, s=secret), prefix, hash_secret(secret)
+
+def split_apikey(key):
+    """
+    returns (prefix, secret) of a key presented by a client
+    """
+    try:
+        prefix, secret = str(key).strip().split('.')
+    except (ValueError, UnicodeError):
+        raise InvalidApiKeyError()
+    if not prefix or not secret:
+        raise InvalidApiKeyError()
+    return prefix, secret
+
+def check_secret(secret, key_hash):
+    return hmac.compare_digest(hash_secret(secret), str(key_hash))
+
+def cache_key(key):
+    """
+    the verified key cache is keyed by a hash of the whole key so it never holds secrets
+    """
+    return hashlib.sha256(str(key)).digest()
@@ -1,51 +1,138 @@
 from flask import g, current_app
-from package_database import lookup_password, add_user, lookup_user_id
-from error_handlers import UnauthorizedError
+from package_database import lookup_credentials, add_user, update_password, store_apikey, lookup_apikey, list_apikeys, delete_apikey
+from error_handlers import UnauthorizedError, UnhandledError, ServiceUnavailableError, NotFoundError
+from apikeys import InvalidApiKeyError, generate_apikey, split_apikey, check_secret, cache_key
+from cache import get_apikey_cache
+from tokens import InvalidTokenError, get_token_signer, get_revocations
+from passwords import HasherBusyError, get_password_hasher
+from flask_package_mgr import release_db
 
-def authorize(username, provided_password):
+def check_credentials(username, provided_password):
     """
-    this will authorize a user and issue a token to them
-    hard coded to 'aValidToken' for right now
+    looks up a user and checks their password on the password hasher workers.  A
+    password stored with an out of date cost, or in plaintext, is hashed again with
+    the current cost now that we know it
     """
-    stored_password = lookup_password(username)
-    
-    if (provided_password == stored_password):
-        # for now hard coding a token, real implementations 
-        # would require more, plus timeouts/etc
-        return { 'token' : "aValidToken-{u}".format(u=username) }
-    else:
+    credentials = lookup_credentials(username)
+    # don't hold a pooled connection while queued for the hasher
+    release_db()
+    try:
+        matches, new_stored = get_password_hasher().verify(provided_password, credentials['password'])
+    except HasherBusyError:
+        raise ServiceUnavailableError(message='too many logins in progress, try again')
+
+    if not matches:
         raise UnauthorizedError(message='password is incorrect')
 
-def unauthorize(username, provided_password):
+    if new_stored is not None:
+        try:
+            update_password(credentials['id'], new_stored)
+        except UnhandledError:
+            # already logged, the old hash still works so the login can go ahead
+            pass
+    return credentials
+
+def authorize(username, provided_password):
     """
-    This would theoretically revoke the token
+    this will authorize a user and issue a signed token to them, the token
+    carries the user id so requests using it do not need to look the user up
     """
-    stored_password = lookup_password(username)
-    if (provided_password == stored_password):
-        return { 'message' : 'token has been revoked' }
-    else:
-        raise UnauthorizedError(message='password is incorrect')
+    credentials = check_credentials(username, provided_password)
+    return { 'token' : get_token_signer().sign(credentials['id']) }
+
+def unauthorize(username, provided_password, token):
+    """
+    revokes token, which must belong to username
+    """
+    credentials = check_credentials(username, provided_password)
+
+    try:
+        user_id, token_id, expires = get_token_signer().verify(token)
+    except InvalidTokenError as err:
+        raise UnauthorizedError(message=err.message)
+    if user_id != credentials['id']:
+        raise UnauthorizedError(message='token does not belong to user')
+
+    get_revocations().revoke(token_id, expires)
+    return { 'message' : 'token has been revoked' }
 
 def authenticate(token):
     """
-    validate that the user has provided a valid token.  Would also
-    be where timeout checks would go/etc.
+    validate that the user has provided a valid token and return its user id.
+    This only checks the signature, expiry and the revocation list, it never
+    touches the database.  Revocations are only known to the process that
+    revoked the token, other processes accept it until it expires
     """
-    if 'aValidToken' not in token:
-        raise UnauthorizedError(message='Invalid Token')
-    username = token.rsplit('-',1)[1]
-    
-    user_id = lookup_user_id(username=username)
+    try:
+        user_id, token_id, expires = get_token_signer().verify(token)
+    except InvalidTokenError as err:
+        raise UnauthorizedError(message=err.message)
+
+    if get_revocations().is_revoked(token_id):
+        raise UnauthorizedError(message='Token has been revoked')
 
     return user_id
 
+def authenticate_apikey(key):
+    """
+    validate an api key and return its user id.  The key is found by its prefix with
+    a single indexed lookup, and keys verified in the last APIKEY_CACHE_TTL seconds
+    are answered from memory without a query
+    """
+    cache = get_apikey_cache()
+    if cache is not None:
+        cached = cache.get(cache_key(key))
+        if cached is not None:
+            return cached['user_id']
+
+    try:
+        prefix, secret = split_apikey(key)
+    except InvalidApiKeyError:
+        raise UnauthorizedError(message='Invalid ApiKey')
+
+    stored = lookup_apikey(prefix)
+    if stored is None or not check_secret(secret, stored['key_hash']):
+        raise UnauthorizedError(message='Invalid ApiKey')
+
+    if cache is not None:
+        cache.put(cache_key(key), { 'user_id' : stored['user_id'], 'prefix' : prefix })
+    return stored['user_id']
+
+def issue_apikey(user_id, name=None):
+    """
+    creates a new api key for user_id.  The key is only ever returned here
+    """
+    key, prefix, key_hash = generate_apikey()
+    store_apikey(user_id=user_id, name=name, prefix=prefix, key_hash=key_hash)
+    return { 'apikey' : key, 'prefix' : prefix, 'name' : name }
+
+def get_apikeys(user_id):
+    return [ dict(apikey) for apikey in list_apikeys(user_id) ]
+
+def revoke_apikey(user_id, prefix):
+    """
+    deletes one of user_id's api keys and forgets it if this process verified it.
+    Other processes keep accepting it for up to APIKEY_CACHE_TTL seconds
+    """
+    if not delete_apikey(user_id=user_id, prefix=prefix):
+        raise NotFoundError(message='apikey not found')
+    cache = get_apikey_cache()
+    if cache is not None:
+        cache.invalidate_where(lambda key, value: value['prefix'] == prefix)
+    return { 'message' : 'apikey has been revoked' }
+
 def auth_add_user(username, password):
     """
-    This is where one would take extra steps, like salting/hashing
-    a password or generating a real apikey like infrastructure
+    adds a user, storing a salted pbkdf2 hash of their password.  Api keys
+    are issued separately, see issue_apikey
     """
+    try:
+        stored = get_password_hasher().hash(password)
+    except HasherBusyError:
+        raise ServiceUnavailableError(message='too many logins in progress, try again')
+
     return add_user(
                 username=username,
-                password=password,
+                password=stored,
                 key='ApiKey'
                 )
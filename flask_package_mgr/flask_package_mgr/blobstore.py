@@ -0,0 +1,259 @@
+import os
+import errno
+import hashlib
+import shutil
+import tempfile
+
+HASH_CHUNK_SIZE = 1024 * 1024
+WRITE_BUFFER_SIZE = 256 * 1024
+
+# precompressed variants of a blob live next to it, <digest><suffix>
+VARIANT_SUFFIXES = {
+    'gzip' : '.gz',
+    'zstd' : '.zst'
+    }
+
+def blob_root(upload_folder):
+    return os.path.join(os.path.abspath(upload_folder), 'blobs')
+
+def blob_path(upload_folder, digest, levels=2, width=2):
+    """
+    where the blob with a sha256 digest lives, fanned out over levels directories named
+    by the next width characters of the digest so no directory ends up holding every
+    blob, blobs/ab/cd/abcd... by default
+    """
+    prefixes = [ digest[level * width:(level + 1) * width] for level in range(levels) ]
+    return os.path.join(blob_root(upload_folder), *(prefixes + [ digest ]))
+
+def variant_path(path, encoding):
+    return path + VARIANT_SUFFIXES[encoding]
+
+def is_digest(digest):
+    return len(digest) == 64 and all(c in '0123456789abcdef' for c in digest)
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+def temp_dir(upload_folder):
+    """
+    the directory uploads are written to before they are moved into place, on the
+    same filesystem as the blobs so the move is a link
+    """
+    tmp_dir = os.path.join(blob_root(upload_folder), 'tmp')
+    _makedirs(tmp_dir)
+    return tmp_dir
+
+def temp_blob(upload_folder):
+    """
+    opens a temporary file next to the blobs, so it can be renamed into place,
+    returns (fd, path)
+    """
+    return tempfile.mkstemp(dir=temp_dir(upload_folder), suffix='.upload')
+
+def hash_file(path):
+    """
+    returns the sha256 hex digest and size of a file
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+def publish_blob(tmp_path, path):
+    """
+    moves tmp_path to the blob path.  The blob is linked into place, which fails
+    rather than replacing a blob that is already stored, and in that case the new
+    copy is dropped as the content is the same.  Callers hold the database write
+    lock so this can not race with remove_blob
+    """
+    _makedirs(os.path.dirname(path))
+    try:
+        os.link(tmp_path, path)
+        created = True
+    except OSError as err:
+        if err.errno == errno.EXDEV:
+            # the blob belongs on another volume than the upload was written to
+            created = _copy_into_place(tmp_path, path)
+        elif err.errno != errno.EEXIST:
+            raise
+        else:
+            created = False
+    os.unlink(tmp_path)
+    return created
+
+def _copy_file(src, fd):
+    """
+    copies src into the open file descriptor fd and syncs it, closing fd
+    """
+    with os.fdopen(fd, 'wb') as out, open(src, 'rb') as f:
+        shutil.copyfileobj(f, out, HASH_CHUNK_SIZE)
+        out.flush()
+        os.fsync(out.fileno())
+
+def _copy_into_place(src, path):
+    """
+    copies src next to path and links the copy into place, for moves between filesystems
+    """
+    fd, copy_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.copy')
+    try:
+        _copy_file(src, fd)
+        try:
+            os.link(copy_path, path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            return False
+        return True
+    finally:
+        os.unlink(copy_path)
+
+def link_blob(path, new_path):
+    """
+    links a stored blob in at a second path, leaving the first one in place.  A file
+    already at new_path holds the same content, blobs are named by their digest
+    """
+    _makedirs(os.path.dirname(new_path))
+    try:
+        os.link(path, new_path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+def stage_copy(path, upload_folder):
+    """
+    copies a stored blob into a temporary file of another blob store, so it can be linked
+    into place there.  Returns the temporary path
+    """
+    fd, tmp_path = temp_blob(upload_folder)
+    try:
+        _copy_file(path, fd)
+    except Exception:
+        remove_blob(tmp_path)
+        raise
+    return tmp_path
+
+def prune_dirs(path, root):
+    """
+    removes the directories above path that are left empty, up to but not including root
+    """
+    directory = os.path.dirname(path)
+    while directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            # not empty, or already gone
+            break
+        directory = os.path.dirname(directory)
+
+class BlobUpload(object):
+    """
+    A temporary file in the blob store that an upload is streamed into as it is read
+    off the request.  The sha256 and size are worked out while it is written, so the
+    upload is never held in memory or read back to hash it.  The multipart parser
+    writes a line at a time, writes are gathered into WRITE_BUFFER_SIZE blocks before
+    they are hashed and written.  The temporary file is removed on close unless it
+    was published
+    """
+    def __init__(self, upload_folder, volume=None):
+        fd, self.path = temp_blob(upload_folder)
+        self.volume = volume
+        self.file = os.fdopen(fd, 'w+b')
+        self.size = 0
+        self.published = False
+        self._digest = hashlib.sha256()
+        self._pending = []
+        self._pending_size = 0
+
+    def write(self, data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= WRITE_BUFFER_SIZE:
+            self._write_pending()
+
+    def _write_pending(self):
+        if self._pending:
+            block = b''.join(self._pending)
+            self._digest.update(block)
+            self.file.write(block)
+            self.size += len(block)
+            self._pending = []
+            self._pending_size = 0
+
+    def read(self, *args):
+        self._write_pending()
+        return self.file.read(*args)
+
+    def readline(self, *args):
+        self._write_pending()
+        return self.file.readline(*args)
+
+    def seek(self, *args):
+        self._write_pending()
+        return self.file.seek(*args)
+
+    def tell(self):
+        self._write_pending()
+        return self.file.tell()
+
+    def finish(self, fsync=True):
+        """
+        flushes the upload to disk, with fsync when asked, and returns its (digest, size)
+        """
+        self._write_pending()
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        return self._digest.hexdigest(), self.size
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+        if not self.published:
+            remove_blob(self.path)
+
+def copy_to_blob(stream, upload_folder, volume=None):
+    """
+    copies a file that was not streamed into the blob store into a BlobUpload, a chunk at a time
+    """
+    upload = BlobUpload(upload_folder, volume=volume)
+    try:
+        while True:
+            chunk = stream.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            upload.write(chunk)
+    except Exception:
+        upload.close()
+        raise
+    return upload
+
+def unpublish_blob(path, tmp_path):
+    """
+    undoes publish_blob for a publish whose rows were rolled back, the blob is moved back to
+    tmp_path or removed when that is on another filesystem.  Callers hold the database write
+    lock and have checked no row points at the blob
+    """
+    try:
+        os.rename(path, tmp_path)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        remove_blob(path)
+
+def remove_blob(path):
+    try:
+        os.unlink(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
@@ -6,13 +6,21 @@
 """
 from __future__ import unicode_literals, absolute_import
 
-from flask import Blueprint, request, session, g, abort, current_app, jsonify, json, send_from_directory
-from .schemas import TokenSchema, PackagesGetSchema, PackagesPostSchema, PackagesTitlePostSchema, PackagesTitleGetSchema, PackagesTitleTagPostSchema, PackagesTitleTagGetSchema
+import math
+from itertools import izip
+
+from flask import Blueprint, request, session, g, abort, current_app, jsonify, json, Response, stream_with_context
+from .schemas import ListSchema, TokenSchema, ApiKeyPostSchema, UploadPostSchema, PackagesGetSchema, PackagesPostSchema, PackagesTitlePostSchema, PackagesTitleGetSchema, PackagesTitleTagPostSchema, PackagesTitleTagGetSchema
 
 from .. import package_database
-from ..error_handlers import IntegrityError, UnhandledError, UnauthorizedError, InvalidUseError, NotFoundError
-from ..auth import authorize, unauthorize, authenticate, auth_add_user
-from ..filestore import store_file, get_all_packages, search_specific_packages, get_all_tags, search_specific_tags, get_filepath_for_package
+from ..flask_package_mgr import get_pool_stats
+from ..error_handlers import IntegrityError, UnhandledError, UnauthorizedError, InvalidUseError, NotFoundError, ServiceUnavailableError, TooManyRequestsError
+from ..ratelimit import get_rate_limiter
+from ..auth import authorize, unauthorize, authenticate, authenticate_apikey, auth_add_user, issue_apikey, get_apikeys, revoke_apikey
+from ..downloads import send_stored_file
+from ..volumes import get_volume_counters
+from ..upload_sessions import create_upload_session, get_upload_session, write_upload_chunk, commit_upload_session, abort_upload_session
+from ..filestore import store_file, get_all_packages, stream_all_packages, search_specific_packages, get_all_tags, stream_all_tags, search_specific_tags, get_filepath_for_package, get_blob
 
 api_version = '/api/v1'
 
@@ -26,15 +34,29 @@ def validate_request(request):
     if not request.is_json:
         raise InvalidUseError(message='Request not application/json')
     
-def authenticate_request(request):
+def authenticate_credentials(request):
     """
-    validates and authenticates a request, forces check of token
+    authenticates the credentials of a request, either an 'Authorization: ApiKey <key>'
+    header or a token from get_token
     """
-    validate_request(request)
+    authorization = request.headers.get('Authorization')
+    if authorization is not None:
+        scheme, _, key = authorization.partition(' ')
+        if scheme != 'ApiKey':
+            raise UnauthorizedError(message='Authorization scheme must be ApiKey')
+        return authenticate_apikey(key)
+
     if 'token' not in request.headers:
         raise UnauthorizedError(message='Token not provided')
-    
-    user_id = authenticate(request.headers['token'])
+
+    return authenticate(request.headers['token'])
+
+def authenticate_request(request):
+    """
+    validates and authenticates a request, forces check of token or api key
+    """
+    validate_request(request)
+    user_id = authenticate_credentials(request)
 
     if None == user_id:
         raise UnauthorizedError(message='Unable to find user')
@@ -46,16 +68,62 @@ def authenticate_upload(request):
     authenticate upload is different than authenticate_request because upload is a multipart 
     request.  This means the entire request is not json, so it just does a few more manual checks
     """
-    if 'token' not in request.headers:
-        raise UnauthorizedError(message='Token not provided')
-    
-    user_id = authenticate(request.headers['token'])
+    user_id = authenticate_credentials(request)
 
     if None == user_id:
         raise UnauthorizedError(message='Unable to find user')
     
     return user_id
 
+def limit_request(user_id, budget, cost=1):
+    """
+    charges a request to one of the user's rate limit budgets, see ratelimit.py
+    """
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return
+    g.ratelimit = limiter.take(user_id, budget, cost)
+    if g.ratelimit.retry_after:
+        raise TooManyRequestsError(
+                message='{b} rate limit exceeded'.format(b=budget),
+                retry_after=g.ratelimit.retry_after
+                )
+
+def limit_upload(user_id):
+    """
+    takes one of the user's concurrent upload slots until the end of the request and
+    charges the size of the upload to their upload budget.  The slot is taken first, so
+    an upload turned away for concurrency is not charged.  This runs before the body
+    is parsed, so a rejected upload is not read
+    """
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return
+    if not limiter.acquire_upload(user_id):
+        raise TooManyRequestsError(message='too many uploads in progress')
+    g.upload_slot = (limiter, user_id)
+    limit_request(user_id, 'upload_bytes', request.content_length or 0)
+
+@pckg.after_request
+def add_ratelimit_headers(response):
+    if 'ratelimit' in g:
+        for header, value in g.ratelimit.headers().iteritems():
+            response.headers[header] = value
+    return response
+
+@pckg.teardown_request
+def release_upload_slot(error):
+    if 'upload_slot' in g:
+        limiter, user_id = g.pop('upload_slot')
+        limiter.release_upload(user_id)
+
+def count_download(response, volume):
+    """
+    counts the bytes a download reads off its volume, a 304 reads nothing
+    """
+    if response.status_code in (200, 206):
+        get_volume_counters().record_read(volume, response.content_length or 0)
+    return response
 
 def parse_message(content, schema):
     """
@@ -69,15 +137,83 @@ def parse_message(content, schema):
 
     return parsed_data
 
+def rows_to_dicts(rows):
+    """
+    converts database rows to dicts for json.  Every row of a result shares its columns,
+    so the column names are only read once.  The list is converted in place, each row is
+    released as soon as its dict is built
+    """
+    if not rows:
+        return []
+    keys = rows[0].keys()
+    for idx, row in enumerate(rows):
+        rows[idx] = dict(izip(keys, row))
+    return rows
+
+def list_response(rows, parsed_data):
+    """
+    returns one page of a listing as json.  When the page is full the id to continue
+    from is passed back as the next cursor in the X-Next-Cursor header
+    """
+    rows = rows_to_dicts(rows)
+    response = jsonify(rows)
+    limit = parsed_data.get('limit')
+    if limit is not None and len(rows) == limit:
+        response.headers['X-Next-Cursor'] = str(rows[-1]['id'])
+    return response
+
+def stream_response(rows, chunk_rows=500):
+    """
+    streams a listing as a json array, rows are encoded and sent as they are read so
+    the whole listing is never held in memory
+    """
+    def generate():
+        yield '['
+        keys = None
+        chunk = []
+        separator = ''
+        for row in rows:
+            if keys is None:
+                keys = row.keys()
+            chunk.append(dict(izip(keys, row)))
+            if len(chunk) >= chunk_rows:
+                # encode the chunk as one list and drop its brackets
+                yield separator + json.dumps(chunk)[1:-1]
+                separator = ','
+                chunk = []
+        if chunk:
+            yield separator + json.dumps(chunk)[1:-1]
+        yield ']'
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 @pckg.route(api_version + '/admin/user_list', methods=['GET'])
 def user_list():
     """
     marked as 'admin' but really is just a passthrough for testing purposes
     """
-    user_list = package_database.list_users()
+    parsed_data = parse_message(request.args.to_dict(), ListSchema())
+    if parsed_data.get('stream'):
+        return stream_response(
+                package_database.iter_users(
+                    cursor=parsed_data.get('cursor'),
+                    limit=parsed_data.get('limit'),
+                    batch_size=current_app.config['LIST_BATCH_SIZE']
+                    )
+                )
+    user_list = package_database.list_users(
+                    cursor=parsed_data.get('cursor'),
+                    limit=parsed_data.get('limit')
+                    )
     if None == user_list:
         user_list = []
-    return jsonify(user_list)
+    return list_response(user_list, parsed_data)
+
+@pckg.route(api_version + '/admin/stats', methods=['GET'])
+def stats():
+    """
+    marked as 'admin' like user_list, returns internal counters for monitoring
+    """
+    return jsonify(get_pool_stats())
 
 @pckg.route(api_version + '/user/add', methods=['POST'])
 def user_add():
@@ -96,8 +232,8 @@ def user_add():
 @pckg.route(api_version + '/user/get_token', methods=['POST'])
 def get_token():
     """
-    get a token to use in further requests.  this token is not unique/enforced right now, but does
-    add username
+    get a token to use in further requests.  the token is signed and carries the user id
+    and an expiry, see auth.authorize
     """
     validate_request(request)
     content = request.get_json()
@@ -116,15 +252,97 @@ def invalidate_token():
     other users cannot simply log out other clients
     """
     authenticate_request(request)
+    # api keys authenticate too, but there is no token to invalidate then
+    token = request.headers.get('token')
+    if token is None:
+        raise InvalidUseError(message='Token not provided')
     content = request.get_json()
     
     parsed_data = parse_message(content, TokenSchema())
 
     return jsonify(unauthorize(
                     username=parsed_data['username'],
-                    provided_password=parsed_data['password']
+                    provided_password=parsed_data['password'],
+                    token=token
                     ))
 
+@pckg.route(api_version + '/user/apikeys', methods=['GET', 'POST'])
+def apikeys():
+    """
+    issues a new api key to the token user (POST) or lists their keys (GET).  The
+    key itself is only returned by the POST
+    """
+    user_id = authenticate_request(request)
+    if request.method == 'POST':
+        content = request.get_json()
+        parsed_data = parse_message(content, ApiKeyPostSchema())
+        return jsonify(issue_apikey(
+                    user_id=user_id,
+                    name=parsed_data.get('name')
+                    ))
+    return jsonify(get_apikeys(user_id))
+
+@pckg.route(api_version + '/user/apikeys/<prefix>', methods=['DELETE'])
+def apikey(prefix):
+    """
+    revokes one of the user's api keys
+    """
+    user_id = authenticate_request(request)
+    return jsonify(revoke_apikey(
+                user_id=user_id,
+                prefix=prefix
+                ))
+
+@pckg.route(api_version + '/uploads', methods=['POST'])
+def uploads():
+    """
+    starts a resumable upload.  The file is sent in chunks with PUT on the returned
+    upload id, in any order and in parallel, and published with commit once every
+    byte has arrived
+    """
+    user_id = authenticate_request(request)
+    content = request.get_json()
+    parsed_data = parse_message(content, UploadPostSchema())
+    return jsonify(create_upload_session(
+                user_id=user_id,
+                package_name=parsed_data['package_name'],
+                tag=parsed_data['tag'],
+                filename=parsed_data['filename'],
+                size=parsed_data['size'],
+                digest=parsed_data.get('digest')
+                ))
+
+@pckg.route(api_version + '/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def upload(upload_id):
+    """
+    On PUT writes the chunk in the body at the offsets of its Content-Range header.
+    GET reports the byte ranges received so far, DELETE aborts the upload
+    """
+    if request.method == 'PUT':
+        user_id = authenticate_upload(request)
+        limit_upload(user_id)
+        if request.content_length is None:
+            raise InvalidUseError(message='Content-Length is required')
+        return jsonify(write_upload_chunk(
+                    session_id=upload_id,
+                    user_id=user_id,
+                    content_range=request.headers.get('Content-Range'),
+                    content_length=request.content_length,
+                    stream=request.stream
+                    ))
+    user_id = authenticate_request(request)
+    if request.method == 'DELETE':
+        return jsonify(abort_upload_session(upload_id, user_id))
+    return jsonify(get_upload_session(upload_id, user_id))
+
+@pckg.route(api_version + '/uploads/<upload_id>/commit', methods=['POST'])
+def commit_upload(upload_id):
+    """
+    publishes a complete upload, responding like a single request upload
+    """
+    user_id = authenticate_request(request)
+    return jsonify(commit_upload_session(upload_id, user_id))
+
 @pckg.route(api_version + '/packages', methods=['GET', 'POST'])
 def packages():
     """ 
@@ -133,6 +351,7 @@ def packages():
     """
     if request.method == 'POST':
         user_id = authenticate_upload(request)
+        limit_upload(user_id)
 
         # this is really weird, i've spent a lot of time looking into this, and
         # for some reason the python multi-part stuff isn't well defined.
@@ -163,16 +382,29 @@ def packages():
                 )
     elif request.method == 'GET':
         user_id = authenticate_request(request)
+        limit_request(user_id, 'searches')
         content = request.get_json()
         parsed_data = parse_message(content, PackagesGetSchema())
         packages = []
         if 'search' in parsed_data:
             packages = search_specific_packages(
-                    search_term=parsed_data['search']
+                    search_term=parsed_data['search'],
+                    limit=parsed_data.get('limit')
+                    )
+            return jsonify(rows_to_dicts(packages))
+        elif parsed_data.get('stream'):
+            return stream_response(
+                    stream_all_packages(
+                        cursor=parsed_data.get('cursor'),
+                        limit=parsed_data.get('limit')
+                        )
                     )
         else:
-            packages = get_all_packages()
-        return jsonify(packages)
+            packages = get_all_packages(
+                    cursor=parsed_data.get('cursor'),
+                    limit=parsed_data.get('limit')
+                    )
+        return list_response(packages, parsed_data)
     else:
         raise InvalidUseError(message='method not supported')
 
@@ -187,6 +419,7 @@ def specific_package(package_title):
     """
     if request.method == 'POST':
         user_id = authenticate_upload(request)
+        limit_upload(user_id)
         # this is really weird, i've spent a lot of time looking into this, and
         # for some reason the python multi-part stuff isn't well defined.
         # werkzeug will not accept anything that cannot be opened in add_file, which 
@@ -217,7 +450,8 @@ def specific_package(package_title):
                     )
                 )
     elif request.method == 'GET':
-        authenticate_request(request)
+        user_id = authenticate_request(request)
+        limit_request(user_id, 'searches')
         content = request.get_json()
 
         parsed_data = parse_message(content, PackagesTitleGetSchema())
@@ -225,13 +459,28 @@ def specific_package(package_title):
         if 'tag_search' in parsed_data:
             tags = search_specific_tags(
                     package = package_title,
-                    tag_search = parsed_data['tag_search']
+                    tag_search = parsed_data['tag_search'],
+                    limit = parsed_data.get('limit'),
+                    details = parsed_data.get('details', False)
+                    )
+            return jsonify(rows_to_dicts(tags))
+        elif parsed_data.get('stream'):
+            return stream_response(
+                    stream_all_tags(
+                        package = package_title,
+                        cursor = parsed_data.get('cursor'),
+                        limit = parsed_data.get('limit'),
+                        details = parsed_data.get('details', False)
+                        )
                     )
         else:
             tags = get_all_tags(
-                    package = package_title
+                    package = package_title,
+                    cursor = parsed_data.get('cursor'),
+                    limit = parsed_data.get('limit'),
+                    details = parsed_data.get('details', False)
                     )
-        return jsonify(tags)
+        return list_response(tags, parsed_data)
     else:
         raise InvalidUseError(message='method not supported')
 
@@ -248,6 +497,7 @@ def specific_package_tag(package_title, tag):
     """
     if request.method == 'POST':
         user_id = authenticate_upload(request)
+        limit_upload(user_id)
         # this is really weird, i've spent a lot of time looking into this, and
         # for some reason the python multi-part stuff isn't well defined.
         # werkzeug will not accept anything that cannot be opened in add_file, which 
@@ -278,20 +528,57 @@ def specific_package_tag(package_title, tag):
                     )
                 )
     elif request.method == 'GET':
-        authenticate_request(request)
+        user_id = authenticate_request(request)
+        limit_request(user_id, 'downloads')
         content = request.get_json()
 
         parsed_data = parse_message(content, PackagesTitleGetSchema())
 
-        filepath = get_filepath_for_package(
+        found = get_filepath_for_package(
                         package_name = package_title,
                         tag = tag
                         )
         
-        return send_from_directory(directory=filepath[0], filename=filepath[1], as_attachment=True)
+        response = send_stored_file(
+                        found['path'],
+                        digest=found['digest'],
+                        size=found['size'],
+                        filename=found['filename'],
+                        cache_control=current_app.config['DOWNLOAD_CACHE_CONTROL'],
+                        variants=found['variants'],
+                        mtime=found['mtime'],
+                        volume=found['volume'],
+                        content_type=found['content_type']
+                        )
+        if found['digest'] is not None:
+            # the immutable address of the same content, see blob
+            response.headers['Content-Location'] = '{v}/blobs/{d}'.format(v=api_version, d=found['digest'])
+        return count_download(response, found['volume'])
     else:
         raise InvalidUseError(message='method not supported')
 
+@pckg.route(api_version + '/blobs/<digest>', methods=['GET'])
+def blob(digest):
+    """
+    Downloads a file by the sha256 of its content.  The content behind a digest can never change,
+    so the response may be cached for as long as BLOB_CACHE_MAX_AGE.  It is marked private as
+    downloads still need a token or api key
+    """
+    user_id = authenticate_credentials(request)
+    limit_request(user_id, 'downloads')
+    found = get_blob(digest)
+    response = send_stored_file(
+                found['path'],
+                digest=digest,
+                size=found['size'],
+                mtime=found['mtime'],
+                volume=found['volume'],
+                content_type=found['content_type'],
+                variants=found['variants'],
+                cache_control='private, max-age={a}, immutable'.format(a=current_app.config['BLOB_CACHE_MAX_AGE'])
+                )
+    return count_download(response, found['volume'])
+
 
 
 
@@ -300,10 +587,14 @@ def specific_package_tag(package_title, tag):
 @pckg.errorhandler(IntegrityError)
 @pckg.errorhandler(NotFoundError)
 @pckg.errorhandler(InvalidUseError)
+@pckg.errorhandler(ServiceUnavailableError)
+@pckg.errorhandler(TooManyRequestsError)
 def handle_custom_error(error):
     """
     Handles all of the custom errors in the API and returns the relevant message and response code
     """
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
+    if getattr(error, 'retry_after', None):
+        response.headers['Retry-After'] = str(int(math.ceil(error.retry_after)))
     return response
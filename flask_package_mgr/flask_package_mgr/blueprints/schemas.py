@@ -1,4 +1,4 @@
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, validate
 
 class TokenSchema(Schema):
     """
@@ -13,7 +13,29 @@ class TokenSchema(Schema):
                 error_messages={'required' : 'password is required'}
                 )
 
-class PackagesGetSchema(Schema):
+class ApiKeyPostSchema(Schema):
+    """
+    Schema for issuing an api key
+    """
+    name = fields.Str()
+
+class ListSchema(Schema):
+    """
+    Schema for the paging inputs shared by the listing GETs
+    """
+    limit = fields.Int(
+                validate=validate.Range(min=1, error='limit must be a positive integer'),
+                error_messages={'invalid' : 'limit must be a positive integer'}
+                )
+    cursor = fields.Int(
+                validate=validate.Range(min=0, error='cursor must be a non-negative integer'),
+                error_messages={'invalid' : 'cursor must be a non-negative integer'}
+                )
+    stream = fields.Bool(
+                error_messages={'invalid' : 'stream must be a boolean'}
+                )
+
+class PackagesGetSchema(ListSchema):
     """
     Schema for the base level '/packages' GET
     """
@@ -32,11 +54,14 @@ class PackagesPostSchema(Schema):
                 error_messages={'required' : 'tag is required'}
                 )
 
-class PackagesTitleGetSchema(Schema):
+class PackagesTitleGetSchema(ListSchema):
     """
     Schema for the level '/packages/<package_name>' GET
     """
     tag_search = fields.Str()
+    details = fields.Bool(
+                error_messages={'invalid' : 'details must be a boolean'}
+                )
 
 class PackagesTitlePostSchema(Schema):
     """
@@ -60,3 +85,26 @@ class PackagesTitleTagGetSchema(Schema):
     """
     pass
     # this doesn't have any requirements
+
+class UploadPostSchema(Schema):
+    """
+    Schema for starting a resumable upload on '/uploads' POST
+    """
+    package_name = fields.Str(
+                required=True,
+                error_messages={'required' : 'package_name is required'}
+                )
+    tag = fields.Str(
+                required=True,
+                error_messages={'required' : 'tag is required'}
+                )
+    filename = fields.Str(
+                required=True,
+                error_messages={'required' : 'filename is required'}
+                )
+    size = fields.Int(
+                required=True,
+                validate=validate.Range(min=0, error='size must be a non-negative integer'),
+                error_messages={'required' : 'size is required', 'invalid' : 'size must be a non-negative integer'}
+                )
+    digest = fields.Str()
@@ -0,0 +1,242 @@
+import math
+import time
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+class LRUCache(object):
+    """
+    A bounded, thread safe, least recently used cache.  Entries older than ttl seconds
+    are treated as misses.  The cache lives in one process, so entries only see the
+    invalidations made by that process, ttl bounds how stale they can get otherwise.
+    generation counts the invalidations, a value read before an invalidation can be put
+    with that generation and is then dropped rather than cached
+    """
+    def __init__(self, size=1024, ttl=None, database=None):
+        self.size = size
+        self.ttl = ttl
+        self.database = database
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits' : 0,
+            'misses' : 0,
+            'evictions' : 0,
+            'expirations' : 0,
+            'invalidations' : 0
+            }
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats['misses'] += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires <= now:
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return default
+            # reinserting moves the key to the most recently used end
+            self._entries[key] = entry
+            self._stats['hits'] += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            if self._entries.pop(key, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def invalidate_where(self, predicate):
+        """
+        drops every entry for which predicate(key, value) is true
+        """
+        with self._lock:
+            self.generation += 1
+            stale = [ key for key, (value, expires) in self._entries.iteritems() if predicate(key, value) ]
+            for key in stale:
+                del self._entries[key]
+            self._stats['invalidations'] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        stats['size'] = self.size
+        stats['ttl'] = self.ttl
+        return stats
+
+class BloomFilter(object):
+    """
+    A fixed size Bloom filter.  Membership tests can give false positives at about
+    error_rate once capacity keys have been added, never false negatives.  Keys can
+    not be removed
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self.entries = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # double hashing, two halves of one digest stand in for k independent hashes
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [ (h1 + i * h2) % self.bits for i in range(self.hashes) ]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.entries += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+class PackageFilter(object):
+    """
+    A Bloom filter of every package title in the database, used to turn away lookups
+    for packages that do not exist without querying.  Titles published by this process
+    are added straight away, titles published elsewhere are picked up by refresh, at
+    most every refresh_interval seconds.  The filter is rebuilt at twice the capacity
+    once more titles than capacity have been added
+    """
+    def __init__(self, capacity, error_rate=0.01, refresh_interval=5, database=None):
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.database = database
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.last_id = 0
+        self.last_refresh = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'rejected' : 0,
+            'passed' : 0,
+            'rebuilds' : 0
+            }
+
+    def refresh(self, fetch, force=False):
+        """
+        adds the titles fetch(last_id) returns, fetch must return (id, title) rows
+        with an id above last_id in id order
+        """
+        with self._lock:
+            now = time.time()
+            if not force and self.last_refresh is not None and now - self.last_refresh < self.refresh_interval:
+                return
+            self._load(fetch)
+            while self.bloom.entries > self.bloom.capacity:
+                self.bloom = BloomFilter(self.bloom.capacity * 2, self.error_rate)
+                self.last_id = 0
+                self._stats['rebuilds'] += 1
+                self._load(fetch)
+            self.last_refresh = now
+
+    def _load(self, fetch):
+        for row in fetch(self.last_id):
+            self.bloom.add(row[1])
+            self.last_id = row[0]
+
+    def add(self, title):
+        with self._lock:
+            self.bloom.add(title)
+
+    def might_contain(self, title):
+        found = title in self.bloom
+        with self._lock:
+            self._stats['passed' if found else 'rejected'] += 1
+        return found
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['entries'] = self.bloom.entries
+        stats['capacity'] = self.bloom.capacity
+        stats['bits'] = self.bloom.bits
+        stats['hashes'] = self.bloom.hashes
+        stats['error_rate'] = self.error_rate
+        stats['last_id'] = self.last_id
+        return stats
+
+def _get_cache(key, enabled, size, ttl):
+    # resolve the proxy once, these accessors run on every lookup
+    app = current_app._get_current_object()
+    config = app.config
+    if not config[enabled]:
+        return None
+    cache = app.extensions.get(key)
+    if cache is None or cache.database != config['DATABASE']:
+        cache = LRUCache(
+                size=config[size],
+                ttl=config[ttl],
+                database=config['DATABASE']
+                )
+        app.extensions[key] = cache
+    return cache
+
+def get_filepath_cache():
+    """
+    Returns the (package, tag) -> filepath cache for the configured database, or None
+    when FILEPATH_CACHE_ENABLED is off
+    """
+    return _get_cache('filepath_cache', 'FILEPATH_CACHE_ENABLED', 'FILEPATH_CACHE_SIZE', 'FILEPATH_CACHE_TTL')
+
+def get_negative_cache():
+    """
+    Returns the cache of recent lookups that found nothing, or None when
+    NEGATIVE_CACHE_ENABLED is off
+    """
+    return _get_cache('negative_cache', 'NEGATIVE_CACHE_ENABLED', 'NEGATIVE_CACHE_SIZE', 'NEGATIVE_CACHE_TTL')
+
+def get_apikey_cache():
+    """
+    Returns the cache of recently verified api keys, or None when APIKEY_CACHE_ENABLED is off
+    """
+    return _get_cache('apikey_cache', 'APIKEY_CACHE_ENABLED', 'APIKEY_CACHE_SIZE', 'APIKEY_CACHE_TTL')
+
+def get_package_filter():
+    """
+    Returns the package title filter for the configured database, or None when
+    PACKAGE_FILTER_ENABLED is off.  A new filter is empty until its first refresh
+    """
+    app = current_app._get_current_object()
+    config = app.config
+    if not config['PACKAGE_FILTER_ENABLED']:
+        return None
+    package_filter = app.extensions.get('package_filter')
+    if package_filter is None or package_filter.database != config['DATABASE']:
+        package_filter = PackageFilter(
+                capacity=config['PACKAGE_FILTER_CAPACITY'],
+                error_rate=config['PACKAGE_FILTER_ERROR_RATE'],
+                refresh_interval=config['PACKAGE_FILTER_REFRESH'],
+                database=config['DATABASE']
+                )
+        app.extensions['package_filter'] = package_filter
+    return package_filter
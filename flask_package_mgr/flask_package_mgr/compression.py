@@ -0,0 +1,221 @@
+import os
+import gzip
+import zlib
+import threading
+import Queue
+
+from flask import current_app
+
+try:
+    import zstandard
+except ImportError:
+    # zstd variants are only made when the zstandard package is installed
+    zstandard = None
+
+from package_database import list_uncompressed, store_variants
+from blobstore import HASH_CHUNK_SIZE, VARIANT_SUFFIXES, temp_blob, remove_blob
+from volumes import volume_folder
+
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+# how much of a file is test compressed before spending the time on all of it
+SAMPLE_SIZE = 64 * 1024
+
+def available_encodings(encodings):
+    """
+    the configured encodings this process can produce
+    """
+    return [
+        encoding for encoding in encodings
+        if encoding in VARIANT_SUFFIXES and (encoding != 'zstd' or zstandard is not None)
+        ]
+
+def worth_compressing(path, min_saving):
+    """
+    whether the start of a file compresses well enough to be worth compressing all of it,
+    already compressed artifacts such as tarballs are turned away here
+    """
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    return len(zlib.compress(sample, 6)) <= len(sample) * (1 - min_saving)
+
+def compress_file(path, encoding, out):
+    """
+    writes the encoding of the file at path to the open file out, a block at a time
+    """
+    with open(path, 'rb') as src:
+        if encoding == 'zstd':
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(src, out)
+            return
+        # no name or timestamp in the header, the same blob always compresses the same
+        gz = gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL, fileobj=out, mtime=0)
+        while True:
+            block = src.read(HASH_CHUNK_SIZE)
+            if not block:
+                break
+            gz.write(block)
+        gz.close()
+
+def compress_stored_file(row, config):
+    """
+    runs the compression stage on one filestore row.  A variant is kept only when it is at
+    least COMPRESS_MIN_SAVING smaller than the file.  Returns the kept variants, encoding -> size
+    """
+    path = row['package_filepath']
+    variants = {}
+    try:
+        if row['size'] >= config['COMPRESS_MIN_SIZE'] and worth_compressing(path, config['COMPRESS_MIN_SAVING']):
+            for encoding in available_encodings(config['COMPRESS_ENCODINGS']):
+                # next to the blob, so the variant can be linked into place
+                fd, tmp_path = temp_blob(volume_folder(row['volume']))
+                with os.fdopen(fd, 'wb') as out:
+                    compress_file(path, encoding, out)
+                size = os.path.getsize(tmp_path)
+                if size <= row['size'] * (1 - config['COMPRESS_MIN_SAVING']):
+                    variants[encoding] = (tmp_path, size)
+                else:
+                    remove_blob(tmp_path)
+    except Exception:
+        for tmp_path, size in variants.values():
+            remove_blob(tmp_path)
+        raise
+    store_variants(row['id'], path, variants)
+    return dict((encoding, size) for encoding, (tmp_path, size) in variants.iteritems())
+
+def compress_pending(digest=None, batch_size=100):
+    """
+    runs the compression stage on every stored file that has not been through it, or only
+    on the file of digest.  Returns the number of files looked at and of variants kept
+    """
+    config = current_app.config
+    files = 0
+    kept = 0
+    after_id = 0
+    while True:
+        rows = list_uncompressed(after_id=after_id, digest=digest, limit=batch_size)
+        if not rows:
+            break
+        for row in rows:
+            after_id = row['id']
+            try:
+                kept += len(compress_stored_file(row, config))
+            except (IOError, OSError) as err:
+                current_app.logger.error("Unable to compress {fp} : {e}".format(fp=row['package_filepath'], e=err))
+            files += 1
+    return files, kept
+
+class Compressor(object):
+    """
+    Runs the compression stage of new uploads on a background thread, so publishing does
+    not wait for it.  At most queue_size files wait, beyond that they are left for
+    `flask compress_blobs` to pick up
+    """
+    def __init__(self, app, queue_size=64):
+        self.app = app
+        self.queue_size = queue_size
+        self.pid = os.getpid()
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {
+            'submitted' : 0,
+            'dropped' : 0,
+            'compressed' : 0,
+            'variants' : 0,
+            'errors' : 0
+            }
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='compressor')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        # wakes the thread, unless the queue is full and it is busy anyway
+        try:
+            self._queue.put_nowait(None)
+        except Queue.Full:
+            pass
+
+    def wait_stopped(self, timeout=None):
+        """
+        waits up to timeout seconds for the thread to finish once stopped, what is still
+        queued is left for `flask compress_blobs`
+        """
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def submit(self, digest):
+        """
+        queues the compression of a newly published file, False when the queue is full
+        """
+        self.start()
+        try:
+            self._queue.put_nowait(digest)
+        except Queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+            return False
+        with self._lock:
+            self._stats['submitted'] += 1
+        return True
+
+    def join(self):
+        """
+        waits until every queued file has been compressed
+        """
+        self._queue.join()
+
+    def _run(self):
+        # bound locally, module globals are cleared while a daemon thread is still
+        # waiting at interpreter shutdown
+        empty = Queue.Empty
+        while not self._stop_event.is_set():
+            try:
+                digest = self._queue.get(timeout=1)
+            except empty:
+                continue
+            if digest is None:
+                self._queue.task_done()
+                continue
+            try:
+                with self.app.app_context():
+                    files, kept = compress_pending(digest=digest)
+                with self._lock:
+                    self._stats['compressed'] += files
+                    self._stats['variants'] += kept
+            except Exception as err:
+                self.app.logger.error("Unhandled Error compressing {d} : {e}".format(d=digest, e=err))
+                with self._lock:
+                    self._stats['errors'] += 1
+            finally:
+                self._queue.task_done()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['queue_size'] = self.queue_size
+        return stats
+
+def get_compressor():
+    """
+    Returns the background compressor, or None when COMPRESS_ENABLED is off
+    """
+    app = current_app._get_current_object()
+    if not app.config['COMPRESS_ENABLED']:
+        return None
+    compressor = app.extensions.get('compressor')
+    if compressor is not None and (compressor.pid != os.getpid() or compressor.queue_size != app.config['COMPRESS_QUEUE_SIZE']):
+        compressor.stop()
+        compressor = None
+    if compressor is None:
+        compressor = Compressor(app, queue_size=app.config['COMPRESS_QUEUE_SIZE'])
+        app.extensions['compressor'] = compressor
+    return compressor
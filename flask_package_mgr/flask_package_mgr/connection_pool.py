@@ -0,0 +1,223 @@
+import os
+import threading
+import Queue
+from sqlite3 import dbapi2 as sqlite3
+
+class PoolExhaustedError(Exception):
+    """
+    raised when no connection could be checked out of the pool before the timeout
+    """
+    pass
+
+class ConnectionPool(object):
+    """
+    A bounded pool of sqlite connections for a single database file.
+
+    Connections are created lazily up to size, handed out one caller at a time
+    and returned to the pool at the end of the request instead of being closed.
+    A connection is thrown away and replaced once it has been used max_uses
+    times, or if it fails its health check or was released after an error.
+    """
+    def __init__(self, connect, database, size=5, max_uses=1000, timeout=30, health_check=True):
+        self.connect = connect
+        self.database = database
+        self.size = size
+        self.max_uses = max_uses
+        self.timeout = timeout
+        self.health_check = health_check
+        self.pid = os.getpid()
+
+        # LIFO so that the most recently used (and warmest) connection is reused first.
+        # a None entry is a free slot that does not have a connection opened yet
+        self._idle = Queue.LifoQueue(maxsize=size)
+        for slot in range(size):
+            self._idle.put(None)
+
+        self._lock = threading.Lock()
+        self._uses = {}
+        self._closed = False
+        self._stats = {
+            'created' : 0,
+            'checkouts' : 0,
+            'recycled' : 0,
+            'health_check_failures' : 0,
+            'timeouts' : 0
+            }
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _open(self):
+        conn = self.connect(self.database)
+        with self._lock:
+            self._uses[id(conn)] = 0
+            self._stats['created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._uses.pop(id(conn), None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchall()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """
+        checks a connection out of the pool, blocking up to timeout seconds if
+        every connection is currently in use
+        """
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            self._count('timeouts')
+            raise PoolExhaustedError('no database connection available after {t}s'.format(t=self.timeout))
+
+        try:
+            if conn is not None and self.health_check and not self._healthy(conn):
+                self._count('health_check_failures')
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except Exception:
+            # hand the slot back so a failed connect does not shrink the pool
+            self._idle.put(None)
+            raise
+
+        self._count('checkouts')
+        return conn
+
+    def release(self, conn, error=False):
+        """
+        returns a connection to the pool.  Anything left uncommitted is rolled back,
+        and the connection is recycled if it errored or has reached max_uses
+        """
+        with self._lock:
+            uses = self._uses.get(id(conn), 0) + 1
+            self._uses[id(conn)] = uses
+
+        recycle = error or self._closed or (self.max_uses and uses >= self.max_uses)
+        if not recycle:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                recycle = True
+
+        if recycle:
+            self._count('recycled')
+            self._discard(conn)
+            conn = None
+
+        self._idle.put(conn)
+
+    def close(self):
+        """
+        closes every idle connection, connections currently checked out are closed
+        when they are released
+        """
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            if conn is not None:
+                self._discard(conn)
+
+    def get_stats(self):
+        """
+        returns a snapshot of the pool counters for monitoring
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['open'] = len(self._uses)
+        stats['available'] = self._idle.qsize()
+        stats['in_use'] = self.size - stats['available']
+        stats['size'] = self.size
+        stats['max_uses'] = self.max_uses
+        return stats
+
+class WalCheckpointer(threading.Thread):
+    """
+    Background thread that checkpoints the WAL every interval seconds so it cannot
+    grow without limit under sustained writes.  A normal pass uses the configured
+    mode, once the WAL file is larger than wal_size_limit bytes a TRUNCATE
+    checkpoint is forced to give the space back.
+    """
+    def __init__(self, connect, database, interval=60, wal_size_limit=None, mode='PASSIVE'):
+        threading.Thread.__init__(self, name='wal-checkpointer')
+        self.daemon = True
+        self.connect = connect
+        self.database = database
+        self.interval = interval
+        self.wal_size_limit = wal_size_limit
+        self.mode = mode
+        self.pid = os.getpid()
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {
+            'checkpoints' : 0,
+            'truncates' : 0,
+            'errors' : 0,
+            'last_wal_size' : 0,
+            'last_result' : None
+            }
+
+    def wal_size(self):
+        try:
+            return os.path.getsize(self.database + '-wal')
+        except OSError:
+            return 0
+
+    def checkpoint(self, conn):
+        """
+        runs a single checkpoint pass on conn, picking the mode from the WAL size
+        """
+        size = self.wal_size()
+        mode = self.mode
+        if self.wal_size_limit and size >= self.wal_size_limit:
+            mode = 'TRUNCATE'
+        busy, log, checkpointed = conn.execute('PRAGMA wal_checkpoint({m})'.format(m=mode)).fetchone()
+        result = { 'busy' : busy, 'log' : log, 'checkpointed' : checkpointed }
+        with self._lock:
+            self._stats['checkpoints'] += 1
+            if mode == 'TRUNCATE':
+                self._stats['truncates'] += 1
+            self._stats['last_wal_size'] = size
+            self._stats['last_result'] = result
+        return result
+
+    def run(self):
+        conn = None
+        while not self._stop_event.wait(self.interval):
+            try:
+                if conn is None:
+                    conn = self.connect(self.database)
+                self.checkpoint(conn)
+            except sqlite3.Error:
+                with self._lock:
+                    self._stats['errors'] += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['wal_size'] = self.wal_size()
+        stats['interval'] = self.interval
+        return stats
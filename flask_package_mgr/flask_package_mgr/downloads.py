@@ -0,0 +1,277 @@
+import os
+import errno
+import urllib
+import mimetypes
+from zlib import adler32
+
+from flask import request, Response
+from werkzeug.http import parse_if_range_header, is_resource_modified, http_date
+from werkzeug.wsgi import wrap_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+from blobstore import HASH_CHUNK_SIZE, variant_path
+from error_handlers import UnhandledError
+from volumes import get_volume
+from flask_package_mgr import app
+
+def parse_ranges(header):
+    """
+    parses a bytes Range header into (start, stop) pairs, stop is None for an open range
+    and start is negative for a suffix.  Unlike werkzeug's parser ranges may overlap or
+    come in any order, they are coalesced by byte_ranges.  None when it is not a bytes range
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        first, sep, last = spec.strip().partition('-')
+        try:
+            if not sep:
+                return None
+            if not first:
+                ranges.append((-int(last), None))
+            else:
+                start = int(first)
+                stop = int(last) + 1 if last else None
+                if stop is not None and stop <= start:
+                    return None
+                ranges.append((start, stop))
+        except ValueError:
+            return None
+    return ranges
+
+def byte_ranges(ranges, length):
+    """
+    resolves parsed ranges against a file of length bytes into [start, stop) pairs, dropping
+    the ones that fall outside of it.  Overlapping and adjacent ranges are coalesced so no
+    byte is sent twice
+    """
+    resolved = []
+    for start, stop in ranges:
+        if start < 0:
+            start, stop = max(length + start, 0), length
+        stop = length if stop is None else min(stop, length)
+        if start < stop:
+            resolved.append([ start, stop ])
+    resolved.sort()
+    merged = []
+    for start, stop in resolved:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([ start, stop ])
+    return merged
+
+def range_applies(response):
+    """
+    whether a Range header may be answered, an If-Range that no longer matches the file
+    means the whole file has to be sent
+    """
+    if_range = parse_if_range_header(request.headers.get('If-Range'))
+    if if_range.etag is not None:
+        etag, weak = response.get_etag()
+        return not weak and etag == if_range.etag
+    if if_range.date is not None:
+        return response.last_modified is not None and if_range.date == response.last_modified
+    return True
+
+def multipart_ranges(response, f, ranges, length):
+    """
+    answers a Range header asking for more than one range with a multipart/byteranges body,
+    read from the open file f a block at a time, it is closed once the body is sent
+    """
+    boundary = os.urandom(12).encode('hex')
+    part_type = response.mimetype
+    heads = [
+        '\r\n--{b}\r\nContent-Type: {t}\r\nContent-Range: bytes {s}-{e}/{l}\r\n\r\n'.format(
+            b=boundary,
+            t=part_type,
+            s=start,
+            e=stop - 1,
+            l=length
+            )
+        for start, stop in ranges
+        ]
+    tail = '\r\n--{b}--\r\n'.format(b=boundary)
+
+    def generate():
+        with f:
+            for head, (start, stop) in zip(heads, ranges):
+                yield head
+                f.seek(start)
+                remaining = stop - start
+                while remaining:
+                    block = f.read(min(HASH_CHUNK_SIZE, remaining))
+                    if not block:
+                        return
+                    remaining -= len(block)
+                    yield block
+        yield tail
+
+    multipart = Response(
+            generate(),
+            status=206,
+            mimetype='multipart/byteranges; boundary={b}'.format(b=boundary),
+            direct_passthrough=True
+            )
+    for header in ('ETag', 'Last-Modified', 'Cache-Control', 'Content-Disposition'):
+        if header in response.headers:
+            multipart.headers[header] = response.headers[header]
+    multipart.headers['Accept-Ranges'] = 'bytes'
+    multipart.headers['Date'] = http_date()
+    multipart.content_length = sum(len(head) for head in heads) + sum(stop - start for start, stop in ranges) + len(tail)
+    response.close()
+    return multipart
+
+# the header each DOWNLOAD_MODE that hands the transfer to a front proxy responds with
+OFFLOAD_HEADERS = {
+    'x-sendfile' : 'X-Sendfile',
+    'x-accel-redirect' : 'X-Accel-Redirect'
+    }
+
+def accel_uri(path, volume=None):
+    """
+    the internal nginx location of a stored file, the accel_prefix of the volume it is on
+    standing in for the volume's path
+    """
+    stored_on = get_volume(volume)
+    if stored_on is None:
+        # a volume no longer configured, its files are looked for under UPLOAD_FOLDER
+        root, prefix = app.config['UPLOAD_FOLDER'], app.config['DOWNLOAD_ACCEL_PREFIX']
+    else:
+        root, prefix = stored_on['path'], stored_on['accel_prefix']
+    relative = os.path.relpath(path, os.path.abspath(root))
+    return prefix.rstrip('/') + '/' + urllib.quote(relative.replace(os.sep, '/'))
+
+def file_response(size, mtime, filename, content_type=None):
+    """
+    the headers of a download made from what was recorded when the file was stored, the
+    body is attached once it is known the file has to be sent.  filename makes it an
+    attachment under that name, its type is only guessed for files stored before the
+    content type was recorded
+    """
+    mimetype = content_type or (mimetypes.guess_type(filename)[0] if filename else None) or 'application/octet-stream'
+    response = app.response_class(None, mimetype=mimetype, direct_passthrough=True)
+    if filename is not None:
+        response.headers.add('Content-Disposition', 'attachment', filename=filename)
+    response.headers['Content-Length'] = size
+    response.last_modified = mtime
+    return response
+
+def out_of_sync(path):
+    """
+    a file the database says is stored is not on disk
+    """
+    app.logger.error("Unable to locate filepath {fp}, Database and filesystem are out of sync".format(fp=path))
+    raise UnhandledError()
+
+def choose_variant(variants):
+    """
+    negotiates Accept-Encoding against the precompressed variants of a stored file.  The
+    encoding the client prefers wins, the smaller variant when it likes several equally.
+    Returns the encoding and its variant size, or (None, None) to send the file as stored
+    """
+    accepted = request.accept_encodings
+    chosen = (None, None)
+    best = None
+    for encoding, size in variants.iteritems():
+        quality = accepted[encoding]
+        if quality <= 0:
+            continue
+        if best is None or (quality, -size) > best:
+            best = (quality, -size)
+            chosen = (encoding, size)
+    return chosen
+
+def send_stored_file(path, digest=None, size=None, filename=None, cache_control=None, variants=None, mtime=None, volume=None,
+        content_type=None):
+    """
+    sends a stored file, answering conditional and Range requests.  The digest is the strong
+    ETag, If-None-Match and If-Modified-Since are checked before any Range so a client that
+    already has the file gets a 304.  A single range is sent as a plain 206, several as
+    multipart/byteranges, at most DOWNLOAD_MAX_RANGES of them before the whole file is sent
+    instead.  filename makes it an attachment under that name.
+
+    size, mtime and content_type are the ones recorded when the file was stored, so the headers
+    are made without touching the filesystem and a 304 never opens the file.  Files stored before they
+    were recorded are stat'ed instead.
+
+    variants are the precompressed copies of the file, encoding -> size.  When the client
+    accepts one of them it is sent as is with a Content-Encoding, ranges then apply to the
+    encoded bytes and the ETag names the encoding, so nothing is compressed per request.
+    A variant that turns out to be gone is skipped for the file as stored
+
+    With DOWNLOAD_MODE 'direct' the file is sent by the worker, through the WSGI server's
+    file_wrapper (sendfile under gunicorn or uwsgi) when it has one.  'x-sendfile' and
+    'x-accel-redirect' hand the transfer to the front proxy instead, volume is the storage
+    volume the file is on
+    """
+    mode = app.config['DOWNLOAD_MODE']
+    if mode != 'direct' and mode not in OFFLOAD_HEADERS:
+        app.logger.error("Unknown DOWNLOAD_MODE {m}".format(m=mode))
+        raise UnhandledError()
+    stored = (path, digest, size)
+    encoding = None
+    if variants and digest is not None:
+        encoding, variant_size = choose_variant(variants)
+        if encoding is not None:
+            path = variant_path(path, encoding)
+            size = variant_size
+            digest = '{d}-{e}'.format(d=digest, e=encoding)
+    if size is None or mtime is None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            out_of_sync(path)
+        size = st.st_size
+        mtime = int(st.st_mtime)
+
+    response = file_response(size, mtime, filename, content_type)
+    if digest is not None:
+        response.set_etag(digest)
+    else:
+        response.set_etag('{m}-{s}-{p}'.format(m=mtime, s=size, p=adler32(path) & 0xffffffff))
+    if cache_control is not None:
+        response.headers['Cache-Control'] = cache_control
+    if variants:
+        # caches must keep the encodings apart, 304s included
+        response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.content_encoding = encoding
+
+    etag, weak = response.get_etag()
+    if not is_resource_modified(request.environ, etag=etag, last_modified=response.last_modified):
+        return response.make_conditional(request, accept_ranges=True)
+    if mode in OFFLOAD_HEADERS:
+        # the proxy sends the file and answers any Range itself
+        response.headers[OFFLOAD_HEADERS[mode]] = path if mode == 'x-sendfile' else accel_uri(path, volume)
+        return response
+
+    # opened before any range is answered, so a variant that is gone falls back either way
+    try:
+        f = open(path, 'rb')
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        if encoding is None:
+            out_of_sync(path)
+        path, digest, size = stored
+        remaining = dict(variants)
+        del remaining[encoding]
+        return send_stored_file(path, digest=digest, size=size, filename=filename, cache_control=cache_control, variants=remaining, mtime=mtime, volume=volume,
+                content_type=content_type)
+
+    complete_length = size
+    requested = parse_ranges(request.headers.get('Range'))
+    if requested is not None and len(requested) > 1 and range_applies(response):
+        if len(requested) > app.config['DOWNLOAD_MAX_RANGES']:
+            # too many ranges, the whole file is sent
+            complete_length = None
+        else:
+            ranges = byte_ranges(requested, size)
+            if not ranges:
+                f.close()
+                raise RequestedRangeNotSatisfiable(length=size)
+            return multipart_ranges(response, f, ranges, size)
+    response.response = wrap_file(request.environ, f)
+    return response.make_conditional(request, accept_ranges=True, complete_length=complete_length)
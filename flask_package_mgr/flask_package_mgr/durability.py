@@ -0,0 +1,271 @@
+import os
+import time
+import ctypes
+import ctypes.util
+import threading
+import Queue
+
+from flask import current_app
+
+from error_handlers import UnhandledError
+from metrics import Histogram
+
+# none - nothing is synced, a crash can lose recently acknowledged uploads
+# file - each upload is fsynced before it is moved into place, its directories after
+# group - as file, but the syncs of concurrent uploads are batched into one
+LEVELS = ('none', 'file', 'group')
+
+BATCH_SIZE_BOUNDS = [1, 2, 4, 8, 16, 32, 64, 128]
+SYNC_LATENCY_MS_BOUNDS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+def _load_syncfs():
+    # syncfs(2) flushes a whole filesystem in one call, Linux only
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return libc.syncfs
+    except (OSError, AttributeError):
+        return None
+
+_syncfs = _load_syncfs()
+
+def fsync_path(path):
+    """
+    fsyncs a file or directory by path
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_filesystems(paths):
+    """
+    makes every path durable with one syncfs per filesystem they are on, or one fsync per
+    path where syncfs is not available
+    """
+    if _syncfs is None:
+        for path in paths:
+            fsync_path(path)
+        return
+    devices = {}
+    for path in paths:
+        devices.setdefault(os.stat(path).st_dev, path)
+    for path in devices.itervalues():
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if _syncfs(fd) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+        finally:
+            os.close(fd)
+
+class _Job(object):
+    __slots__ = ('paths', 'error', 'done')
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.error = None
+        self.done = threading.Event()
+
+class GroupSyncer(object):
+    """
+    Makes the files of many concurrent uploads durable together.
+
+    Callers submit the paths they need on disk, a single thread takes whatever is
+    queued (up to max_batch, waiting at most max_wait seconds for more to arrive)
+    and flushes them all with one syncfs per filesystem, so one disk flush covers
+    the whole batch.  Every caller in a batch waits for, and shares, its outcome
+    """
+    def __init__(self, max_batch=64, max_wait=0.002, timeout=30):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._queue = Queue.Queue()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.batch_sizes = Histogram(BATCH_SIZE_BOUNDS)
+        self.sync_latency_ms = Histogram(SYNC_LATENCY_MS_BOUNDS)
+        self._stats = {
+            'submitted' : 0,
+            'syncs' : 0,
+            'failed_syncs' : 0
+            }
+
+    def start(self):
+        with self._start_lock:
+            self._start_thread()
+
+    def _start_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='group-syncer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        # wakes the thread, it is waiting on the queue
+        self._queue.put(None)
+
+    def wait_stopped(self, timeout=None):
+        """
+        waits up to timeout seconds for the thread to finish once stopped
+        """
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def submit(self, paths):
+        """
+        queues paths and blocks until the batch they are in is on disk, raises what
+        the sync raised.  A caller still holding a syncer that was stopped, because the
+        settings changed under it, syncs its paths itself
+        """
+        job = _Job(paths)
+        with self._lock:
+            self._stats['submitted'] += 1
+        with self._start_lock:
+            stopped = self._stop_event.is_set()
+            if not stopped:
+                self._start_thread()
+                self._queue.put(job)
+        if stopped:
+            self._sync([ job ])
+        elif not job.done.wait(self.timeout):
+            raise IOError('upload was not synced after {t}s'.format(t=self.timeout))
+        if job.error is not None:
+            raise job.error
+
+    def _next_batch(self):
+        try:
+            job = self._queue.get(timeout=1)
+        except Queue.Empty:
+            return []
+        if job is None:
+            return []
+        batch = [ job ]
+
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    job = self._queue.get(timeout=remaining)
+                else:
+                    job = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if job is None:
+                break
+            batch.append(job)
+        return batch
+
+    def _sync(self, batch):
+        try:
+            start = time.time()
+            sync_filesystems(set(path for job in batch for path in job.paths))
+            self.sync_latency_ms.observe((time.time() - start) * 1000.0)
+            self.batch_sizes.observe(len(batch))
+            with self._lock:
+                self._stats['syncs'] += 1
+        except Exception as err:
+            with self._lock:
+                self._stats['failed_syncs'] += 1
+            for job in batch:
+                job.error = err
+        finally:
+            for job in batch:
+                job.done.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._sync(batch)
+        # whatever was queued before the stop is still synced, submits after it sync themselves
+        with self._start_lock:
+            batch = []
+            while True:
+                try:
+                    job = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if job is not None:
+                    batch.append(job)
+        if batch:
+            self._sync(batch)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['max_batch'] = self.max_batch
+        stats['max_wait'] = self.max_wait
+        stats['syncfs'] = _syncfs is not None
+        stats['batch_size'] = self.batch_sizes.get_stats()
+        stats['sync_latency_ms'] = self.sync_latency_ms.get_stats()
+        return stats
+
+def durability_level():
+    """
+    the configured DURABILITY, databases configured before it existed keep what
+    UPLOAD_FSYNC asked for
+    """
+    config = current_app.config
+    level = config['DURABILITY']
+    if level is None:
+        level = 'file' if config['UPLOAD_FSYNC'] else 'none'
+    if level not in LEVELS:
+        current_app.logger.error("Unknown DURABILITY {l}".format(l=level))
+        raise UnhandledError()
+    return level
+
+# the first publishes arrive together, only one of them may create the syncer they share
+_syncer_lock = threading.Lock()
+
+def get_group_syncer():
+    """
+    Returns the group syncer for the current configuration
+    """
+    app = current_app._get_current_object()
+    config = app.config
+    settings = (config['DURABILITY_GROUP_MAX_BATCH'], config['DURABILITY_GROUP_WINDOW'], config['DURABILITY_GROUP_TIMEOUT'])
+    with _syncer_lock:
+        syncer = app.extensions.get('group_syncer')
+        if syncer is None or syncer.pid != os.getpid() or syncer.settings != settings:
+            if syncer is not None:
+                syncer.stop()
+            syncer = GroupSyncer(
+                    max_batch=config['DURABILITY_GROUP_MAX_BATCH'],
+                    max_wait=config['DURABILITY_GROUP_WINDOW'],
+                    timeout=config['DURABILITY_GROUP_TIMEOUT']
+                    )
+            syncer.settings = settings
+            app.extensions['group_syncer'] = syncer
+    return syncer
+
+def sync_to_disk(paths, level=None):
+    """
+    makes files or directories durable as DURABILITY asks, returning once they are
+    """
+    level = level or durability_level()
+    if level == 'file':
+        for path in paths:
+            fsync_path(path)
+    elif level == 'group':
+        get_group_syncer().submit(paths)
+
+def parent_dirs(path, root):
+    """
+    the directories from the one holding path up to root, whose entries a new file depends on
+    """
+    dirs = []
+    directory = os.path.dirname(path)
+    while directory.startswith(root + os.sep) or directory == root:
+        dirs.append(directory)
+        if directory == root:
+            break
+        directory = os.path.dirname(directory)
+    return dirs
@@ -53,3 +53,18 @@ class NotFoundError(BaseResponseError):
     def __init__(self, message, status_code=response_codes.NOT_FOUND, payload=None):
         BaseResponseError.__init__(self, message, status_code, payload)
 
+class ServiceUnavailableError(BaseResponseError):
+    """
+    This is used when the server is too busy to take on the request right now, the client should retry later
+    """
+    def __init__(self, message, status_code=response_codes.SERVICE_UNAVAILABLE, payload=None):
+        BaseResponseError.__init__(self, message, status_code, payload)
+
+class TooManyRequestsError(BaseResponseError):
+    """
+    This is used when a user has gone over one of their rate limits, retry_after is the seconds until
+    the request would be allowed
+    """
+    def __init__(self, message, retry_after=1, status_code=response_codes.TOO_MANY_REQUESTS, payload=None):
+        BaseResponseError.__init__(self, message, status_code, payload)
+        self.retry_after = retry_after
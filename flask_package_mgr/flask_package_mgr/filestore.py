@@ -1,24 +1,37 @@
 import os
+import time
+import mimetypes
 from werkzeug.utils import secure_filename
-from package_database import lookup_package_id, store_package_rows, search_all_packages, search_packages, search_all_tags, search_tags, lookup_filepath
-from error_handlers import InvalidUseError, IntegrityError
-from flask_package_mgr import app
+from package_database import lookup_package_id, store_package_rows, search_all_packages, search_packages, search_all_tags, search_tags, lookup_filepath_row, lookup_blob, row_variants, list_blobs, relocate_blob, iter_all_packages, iter_all_tags, query_db, transaction
+from error_handlers import InvalidUseError, IntegrityError, NotFoundError
+from cache import get_filepath_cache
+from blobstore import VARIANT_SUFFIXES, BlobUpload, blob_path, blob_root, variant_path, is_digest, copy_to_blob, hash_file, publish_blob, remove_blob, stage_copy, prune_dirs
+from compression import get_compressor
+from durability import durability_level, sync_to_disk, parent_dirs
+from volumes import DEFAULT_VOLUME, get_volumes, volume_folder, choose_volume, get_volume_counters
+from flask_package_mgr import app, upgrade_db, release_db
 
 ALLOWED_EXTENSIONS = set(['txt','npm'])
 ALLOWED_EXTENSIONS_TEXT = 'txt, npm'
 
 
-def search_specific_packages(search_term):
+def search_specific_packages(search_term, limit=None):
     """
     simple passthrough to search specific packages
     """
-    return search_packages(search_term)
+    return search_packages(search_term, limit=limit)
 
-def get_all_packages():
+def get_all_packages(cursor=None, limit=None):
     """
     simple passthrough to search all packages
     """
-    return search_all_packages()
+    return search_all_packages(cursor=cursor, limit=limit)
+
+def stream_all_packages(cursor=None, limit=None):
+    """
+    simple passthrough to iterate over all packages
+    """
+    return iter_all_packages(cursor=cursor, limit=limit, batch_size=app.config['LIST_BATCH_SIZE'])
 
 def allowed_file(filename):
     """
@@ -33,74 +46,313 @@ def allowed_file(filename):
                     )
                 )
 
-def store_file(file, package_name, user, tag):
+def blob_location(digest, volume=None):
+    """
+    where a blob is stored on a volume under the configured BLOB_FANOUT_LEVELS and BLOB_FANOUT_WIDTH
+    """
+    return blob_path(
+                volume_folder(volume),
+                digest,
+                levels=app.config['BLOB_FANOUT_LEVELS'],
+                width=app.config['BLOB_FANOUT_WIDTH']
+                )
+
+def guess_content_type(filename):
+    """
+    the content type a stored file is recorded with, guessed from the name it was uploaded
+    as.  What the upload declared is not trusted, blobs are sent with their content type
+    and no Content-Disposition
+    """
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+def validate_upload(filename, package_name, tag):
     """
-    This is where file management takes place.  It will place all packages into subfolders based on package name.
-    It enforces unique filenames per package.
+    checks the filename, package name and tag of an upload, returns the filename it is stored as
     """
-    if file.filename == '':
+    if filename == '':
         raise InvalidUseError(message='no filename specified')
-    if file and allowed_file(file.filename):
+    if allowed_file(filename):
         raise InvalidUseError(message='invalid file extension')
-    filename = secure_filename(file.filename)
+    filename = secure_filename(filename)
     if '/' in filename:
         raise InvalidUseError(message='filenames cannot contain \'/\'')
     if '/' in package_name:
         raise InvalidUseError(message='package_name cannot contain \'/\'')
     if '/' in tag:
         raise InvalidUseError(message='tags cannot contain \'/\'')
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], package_name)
-    #make sure we are on the absolute path
-    filepath = os.path.abspath(filepath)
-    if not os.path.exists(filepath):
-        os.mkdir(filepath)
-    filepath_filename = os.path.join(filepath, filename)
-    if os.path.exists(filepath_filename):
-        raise IntegrityError(message='filename exists for package')
-    file.save(filepath_filename)
+    return filename
+
+def store_file(file, package_name, user, tag):
+    """
+    This is where file management takes place.  Files are stored once by the sha256 of their content,
+    so the same file published under several packages or tags only takes up space once, the package
+    keeps the name it was uploaded with.  It enforces unique filenames per package.
+    The upload has already been streamed to a temporary file and hashed while the request was parsed,
+    it is moved into place only once its rows are written, so a partly written file is never served.
+    The volume it is stored on was chosen when the upload started.  Its mtime and content type are
+    recorded with it, downloads are answered from them without touching the file
+    """
+    filename = validate_upload(file.filename, package_name, tag)
+    level = durability_level()
+    upload = file.stream
+    if not isinstance(upload, BlobUpload):
+        # only files parsed by UploadRequest are streamed straight into the blob store
+        volume = choose_volume()
+        upload = copy_to_blob(upload, volume['path'], volume=volume['name'])
     try:
-        return store_package_rows(
+        digest, size = upload.finish(fsync=level == 'file')
+        if level == 'group':
+            sync_to_disk([ upload.path ], level)
+        # publishing links or renames the upload into place, which keeps its mtime
+        mtime = int(os.path.getmtime(upload.path))
+        path = blob_location(digest, upload.volume)
+        rows = store_package_rows(
                 package_name=package_name,
                 user=user,
-                filepath=filepath_filename,
-                tag=tag
+                filename=filename,
+                digest=digest,
+                size=size,
+                blob_path=path,
+                tmp_path=upload.path,
+                tag=tag,
+                volume=upload.volume,
+                mtime=mtime,
+                content_type=guess_content_type(filename)
                 )
-    except Exception as err:
-        print "Exception in store_package_rows, deleting file {f}".format(f=filepath_filename)
-        # file has to have been saved already from above, so need to catch
-        # exceptions and remove the file
-        if os.path.exists(filepath_filename):
-            os.unlink(filepath_filename)
-        raise err
+        upload.published = True
+    finally:
+        # the upload is only moved into the blob store once its rows are written,
+        # anything that failed before that leaves it behind in tmp
+        upload.close()
+    # the rows are committed, so the writer is handed back before waiting on the sync
+    release_db()
+    sync_published(path, upload.volume, level)
+    get_volume_counters().record_write(upload.volume, size)
+    queue_compression(digest)
+    return rows
+
+def sync_published(path, volume, level):
+    """
+    makes the directory entries of a newly published blob durable, the publish is only
+    acknowledged once DURABILITY is met
+    """
+    if level != 'none' and os.path.exists(path):
+        sync_to_disk(parent_dirs(path, blob_root(volume_folder(volume))), level)
+
+def queue_compression(digest):
+    """
+    hands a newly published file to the background compressor when COMPRESS_ENABLED is on,
+    files it has no room for are left for `flask compress_blobs`
+    """
+    compressor = get_compressor()
+    if compressor is not None:
+        compressor.submit(digest)
 
-def search_specific_tags(package, tag_search):
+def search_specific_tags(package, tag_search, limit=None, details=False):
     """
     This is a passthrough function to search for specific tags of a package
     """
     return search_tags(
                 package_name=package,
-                tag_search=tag_search
+                tag_search=tag_search,
+                limit=limit,
+                details=details
                 )
 
-def get_all_tags(package):
+def get_all_tags(package, cursor=None, limit=None, details=False):
     """
     This function is a passthrough to get all the tags for a package
     """
-    return search_all_tags(package_name=package)
+    return search_all_tags(package_name=package, cursor=cursor, limit=limit, details=details)
+
+def stream_all_tags(package, cursor=None, limit=None, details=False):
+    """
+    This function is a passthrough to iterate over all the tags for a package
+    """
+    return iter_all_tags(package_name=package, cursor=cursor, limit=limit, batch_size=app.config['LIST_BATCH_SIZE'], details=details)
 
 def get_filepath_for_package(package_name, tag):
     """
-    This function is used to lookup and validate that a file exists for the requested package and tag
+    This function is used to lookup the file stored for the requested package and tag.  Returns the path
+    of the stored file along with the filename it was uploaded as and the digest, size, mtime and content
+    type recorded when it was stored, the file itself is not touched.  Resolved files are remembered in the filepath
+    cache, so repeat downloads skip the database as well
     """
+    cache = get_filepath_cache()
+    if cache is not None:
+        cached = cache.get((package_name, tag))
+        if cached is not None:
+            return cached['file']
 
-    filepath = lookup_filepath(
+    resolved = lookup_filepath_row(
                     package_name=package_name,
                     tag=tag
                     )
+    filepath = resolved['package_filepath']
+    found = {
+        'path' : filepath,
+        # files stored before the blob store was introduced have no filename row
+        'filename' : resolved['filename'] or os.path.basename(filepath),
+        'digest' : resolved['digest'],
+        'size' : resolved['size'],
+        # files stored before it was recorded are stat'ed when they are sent
+        'mtime' : resolved['mtime'],
+        'content_type' : resolved['content_type'],
+        'variants' : row_variants(resolved),
+        'volume' : resolved['volume']
+        }
+    if cache is not None:
+        cache.put((package_name, tag), {
+            'package_id' : resolved['package_id'],
+            'filestore_id' : resolved['filestore_id'],
+            'file' : found
+            })
+    return found
+
+def get_blob(digest):
+    """
+    This function looks up the stored file of a blob, raising NotFoundError for digests that are not stored.
+    Returns its path, size, mtime, content type, precompressed variants and volume
+    """
+    if not is_digest(digest):
+        raise InvalidUseError(message='invalid digest')
+    blob = lookup_blob(digest)
+    if blob is None:
+        raise NotFoundError(message='could not locate blob')
+    return {
+        'path' : blob['package_filepath'],
+        'size' : blob['size'],
+        'mtime' : blob['mtime'],
+        'content_type' : blob['content_type'],
+        'variants' : row_variants(blob),
+        'volume' : blob['volume']
+        }
+
+def migrate_to_blobs():
+    """
+    Moves files stored under UPLOAD_FOLDER/<package>/<filename> by older versions into the blob
+    store.  Files with the same content end up as one blob whose refcount counts every tag using
+    it.  Each file is moved in its own transaction, so the migration can be stopped and run again.
+    Returns the number of files migrated and the number of those that were duplicates
+    """
+    upgrade_db()
+    migrated = 0
+    duplicates = 0
+    for legacy in query_db("SELECT id, package_filepath FROM filestore WHERE digest IS NULL") or []:
+        filestore_id = legacy['id']
+        filepath = legacy['package_filepath']
+        if not os.path.isfile(filepath):
+            print "Unable to locate filepath {fp}, skipping it".format(fp=filepath)
+            continue
+        digest, size = hash_file(filepath)
+        path = blob_location(digest)
+        with transaction() as db:
+            refcount = db.execute("SELECT COUNT(*) FROM tags WHERE filestore_id = ?", [ filestore_id ]).fetchone()[0]
+            db.execute(
+                    "UPDATE tags SET filename = ? WHERE filestore_id = ? AND filename IS NULL",
+                    [ os.path.basename(filepath), filestore_id ]
+                    )
+            existing = db.execute("SELECT id FROM filestore WHERE digest = ?", [ digest ]).fetchone()
+            if existing is not None:
+                db.execute("UPDATE tags SET filestore_id = ? WHERE filestore_id = ?", [ existing['id'], filestore_id ])
+                db.execute("UPDATE filestore SET refcount = refcount + ? WHERE id = ?", [ refcount, existing['id'] ])
+                db.execute("DELETE FROM filestore WHERE id = ?", [ filestore_id ])
+                remove_blob(filepath)
+                duplicates += 1
+            else:
+                db.execute(
+                        "UPDATE filestore SET package_filepath = ?, digest = ?, size = ?, refcount = ?, mtime = ?, content_type = ? WHERE id = ?",
+                        [ path, digest, size, refcount, int(os.path.getmtime(filepath)), guess_content_type(filepath), filestore_id ]
+                        )
+                publish_blob(filepath, path)
+        migrated += 1
+        package_dir = os.path.dirname(filepath)
+        if os.path.isdir(package_dir) and not os.listdir(package_dir):
+            os.rmdir(package_dir)
 
-    if os.path.exists(filepath) and os.path.isfile(filepath):
-        parts = os.path.split(filepath)
-        return parts
-    else:
-        print "Unable to locate filepath {fp}, Database and filesystem are out of syc".format(fp=filepath)
-        raise UnhandledError()
+    cache = get_filepath_cache()
+    if cache is not None:
+        cache.clear()
+    return migrated, duplicates
+
+def _relocate_blobs(place, volumes=None, grace=None, batch_size=100):
+    """
+    moves each stored blob, only those on volumes when given, to the (path, volume) that
+    place(row) returns for it, None leaves it where it is.  Within a volume the blob and its
+    variants are linked in at the new path, onto another volume they are copied over first.
+    Either way the row is repointed in one short transaction, so downloads find the blob at
+    one path or the other throughout.  The old files are only removed after grace seconds,
+    by default FILEPATH_CACHE_TTL, once no worker can still have the old path cached.
+    Returns the number of blobs moved and of blobs whose file was missing
+    """
+    if grace is None:
+        grace = app.config['FILEPATH_CACHE_TTL'] if app.config['FILEPATH_CACHE_ENABLED'] else 0
+    moved = []
+    missing = 0
+    after_id = 0
+    while True:
+        rows = list_blobs(after_id=after_id, limit=batch_size, volumes=volumes)
+        if not rows:
+            break
+        for row in rows:
+            after_id = row['id']
+            target = place(row)
+            if target is None:
+                continue
+            path, volume = target
+            filepath = row['package_filepath']
+            if not os.path.isfile(filepath):
+                print "Unable to locate filepath {fp}, skipping it".format(fp=filepath)
+                missing += 1
+                continue
+            links = [ (filepath, path) ] + [
+                (variant_path(filepath, encoding), variant_path(path, encoding))
+                for encoding in VARIANT_SUFFIXES
+                if os.path.isfile(variant_path(filepath, encoding))
+                ]
+            staged = []
+            try:
+                if (volume or DEFAULT_VOLUME) != (row['volume'] or DEFAULT_VOLUME):
+                    for source, target_path in links:
+                        staged.append(stage_copy(source, volume_folder(volume)))
+                    links = [ (tmp_path, target_path) for tmp_path, (source, target_path) in zip(staged, links) ]
+                relocated = relocate_blob(row['id'], filepath, path, volume, links)
+            finally:
+                for tmp_path in staged:
+                    remove_blob(tmp_path)
+            if relocated:
+                moved.append((filepath, blob_root(volume_folder(row['volume']))))
+
+    if moved and grace > 0:
+        time.sleep(grace)
+    for filepath, root in moved:
+        remove_blob(filepath)
+        for encoding in VARIANT_SUFFIXES:
+            remove_blob(variant_path(filepath, encoding))
+        prune_dirs(filepath, root)
+    return len(moved), missing
+
+def reshard_blobs(grace=None, batch_size=100):
+    """
+    Moves blobs stored under another fan-out to where the current BLOB_FANOUT_LEVELS and
+    BLOB_FANOUT_WIDTH put them on their volume, while the server keeps running.  Can be
+    stopped and run again.  Returns the number of blobs moved and of blobs whose file was missing
+    """
+    def place(row):
+        path = blob_location(row['digest'], row['volume'])
+        return (path, row['volume']) if path != row['package_filepath'] else None
+    return _relocate_blobs(place, grace=grace, batch_size=batch_size)
+
+def drain_volumes(grace=None, batch_size=100):
+    """
+    Moves the blobs on volumes marked drain onto the other volumes, placed as new uploads
+    are, while the server keeps running.  Can be stopped and run again.  Returns the number
+    of blobs moved and of blobs whose file was missing
+    """
+    draining = [ name for name, volume in get_volumes().iteritems() if volume['drain'] ]
+    if not draining:
+        return 0, 0
+    def place(row):
+        volume = choose_volume()
+        return blob_location(row['digest'], volume['name']), volume['name']
+    return _relocate_blobs(place, volumes=draining, grace=grace, batch_size=batch_size)
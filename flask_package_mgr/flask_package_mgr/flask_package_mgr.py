@@ -1,22 +1,198 @@
+from __future__ import print_function
 import os
-from flask import Flask, g, current_app
+import json
+from functools import partial
+import click
+from flask import Flask, Request, g, current_app
 from werkzeug.utils import find_modules, import_string
 from sqlite3 import dbapi2 as sqlite3
 import error_handlers
+from connection_pool import ConnectionPool, PoolExhaustedError, WalCheckpointer
+from group_commit import GroupCommitter
+from blobstore import BlobUpload
+from cache import get_filepath_cache, get_negative_cache, get_package_filter, get_apikey_cache
+from volumes import choose_volume, get_volume_stats
 
-def make_dicts(cursor, row):
+def connect_db(database=None, readonly=False, config=None):
     """
-    Standard row factory function to make it return dictionaries instead of tuples
+    Connects to the specific database.  Connections are pooled and may be
+    handed to a different request thread each time they are checked out.
+
+    readonly connections refuse writes, they are used for lookups when the
+    database is running in WAL mode
     """
-    return dict((cursor.description[idx][0], value) for idx, value in enumerate(row))
+    if config is None:
+        config = current_app.config
+    if database is None:
+        database = config['DATABASE']
+    rv = sqlite3.connect(
+            database,
+            check_same_thread=False,
+            cached_statements=config['DATABASE_STATEMENT_CACHE']
+            )
+    # rows are looked up by column name internally, they only become
+    # dicts when they are serialized to json
+    rv.row_factory = sqlite3.Row
+    rv.execute('PRAGMA busy_timeout = {t}'.format(t=int(config['DATABASE_BUSY_TIMEOUT'])))
+    rv.execute('PRAGMA synchronous = {s}'.format(s=config['DATABASE_SYNCHRONOUS']))
+    if readonly:
+        rv.execute('PRAGMA query_only = 1')
+    elif config['DATABASE_WAL']:
+        rv.execute('PRAGMA journal_mode = WAL')
+        rv.execute('PRAGMA wal_autocheckpoint = {p}'.format(p=int(config['DATABASE_WAL_AUTOCHECKPOINT'])))
+    return rv
+
+def _pool_is_stale(pool):
+    return pool.pid != os.getpid() or pool.database != current_app.config['DATABASE']
 
-def connect_db():
+def get_pool(readonly=False):
     """
-    Connects to the specific database.
+    Returns the connection pool for the configured database, creating it on first use.
+    A pool is only valid for the process that created it, so a forked worker or a change of
+    DATABASE gets a fresh one.
+
+    In WAL mode reads get their own pool of readonly connections and writes are serialized
+    through a pool holding a single connection.  Otherwise both share the same pool.
     """
-    rv = sqlite3.connect(current_app.config['DATABASE'])
-    rv.row_factory = make_dicts 
-    return rv
+    wal = current_app.config['DATABASE_WAL']
+    key = 'sqlite_read_pool' if (readonly and wal) else 'sqlite_pool'
+    pool = current_app.extensions.get(key)
+    if pool is not None and _pool_is_stale(pool):
+        close_pool()
+        pool = None
+    if pool is None:
+        size = current_app.config['DATABASE_POOL_SIZE']
+        if wal and not readonly:
+            size = 1
+        pool = ConnectionPool(
+                connect=partial(connect_db, readonly=readonly and wal, config=current_app.config),
+                database=current_app.config['DATABASE'],
+                size=size,
+                max_uses=current_app.config['DATABASE_POOL_MAX_USES'],
+                timeout=current_app.config['DATABASE_POOL_TIMEOUT'],
+                health_check=current_app.config['DATABASE_POOL_HEALTH_CHECK']
+                )
+        current_app.extensions[key] = pool
+        if wal:
+            start_checkpointer()
+    return pool
+
+def start_checkpointer():
+    """
+    Starts the background WAL checkpoint thread if it is configured and not already running
+    """
+    checkpointer = current_app.extensions.get('sqlite_checkpointer')
+    if checkpointer is not None and checkpointer.is_alive() and checkpointer.pid == os.getpid():
+        return checkpointer
+    if not current_app.config['DATABASE_CHECKPOINT_INTERVAL']:
+        return None
+    checkpointer = WalCheckpointer(
+            connect=partial(connect_db, config=current_app.config),
+            database=current_app.config['DATABASE'],
+            interval=current_app.config['DATABASE_CHECKPOINT_INTERVAL'],
+            wal_size_limit=current_app.config['DATABASE_CHECKPOINT_WAL_SIZE'],
+            mode=current_app.config['DATABASE_CHECKPOINT_MODE']
+            )
+    checkpointer.start()
+    current_app.extensions['sqlite_checkpointer'] = checkpointer
+    return checkpointer
+
+def get_group_committer():
+    """
+    Returns the group commit writer for the configured database, creating it on first use
+    """
+    committer = current_app.extensions.get('sqlite_group_committer')
+    if committer is not None and _pool_is_stale(committer):
+        committer.stop()
+        committer = None
+    if committer is None:
+        committer = GroupCommitter(
+                connect=partial(connect_db, config=current_app.config),
+                database=current_app.config['DATABASE'],
+                max_batch=current_app.config['GROUP_COMMIT_MAX_BATCH'],
+                max_wait=current_app.config['GROUP_COMMIT_MAX_WAIT'],
+                timeout=current_app.config['GROUP_COMMIT_TIMEOUT']
+                )
+        current_app.extensions['sqlite_group_committer'] = committer
+    return committer
+
+def close_pool():
+    """
+    Closes all pooled connections for the current application, stops the checkpointer and
+    group commit writer that hold connections of their own and drops the lookup caches read
+    through them
+    """
+    for key in ('sqlite_pool', 'sqlite_read_pool'):
+        pool = current_app.extensions.pop(key, None)
+        if pool is not None and pool.pid == os.getpid():
+            pool.close()
+    checkpointer = current_app.extensions.pop('sqlite_checkpointer', None)
+    if checkpointer is not None and checkpointer.pid == os.getpid():
+        checkpointer.stop()
+    committer = current_app.extensions.pop('sqlite_group_committer', None)
+    if committer is not None and committer.pid == os.getpid():
+        committer.stop()
+    for key in ('filepath_cache', 'negative_cache', 'package_filter', 'apikey_cache'):
+        current_app.extensions.pop(key, None)
+
+# how long shutdown_background_services waits for each service to finish
+SHUTDOWN_TIMEOUT = 10
+
+def shutdown_background_services():
+    """
+    Stops everything the current application runs in the background, the password hasher,
+    compressor, group syncer and scrubber, waits for them to finish and then closes the
+    connection pools with close_pool, as the compressor and scrubber use pooled connections
+    """
+    services = []
+    for key in ('password_hasher', 'compressor', 'group_syncer', 'scrubber'):
+        service = current_app.extensions.pop(key, None)
+        if service is not None and service.pid == os.getpid():
+            service.stop()
+            services.append(service)
+    for service in services:
+        service.wait_stopped(SHUTDOWN_TIMEOUT)
+    close_pool()
+
+def get_pool_stats():
+    """
+    collects the counters of every pool and the checkpointer for monitoring
+    """
+    stats = {
+        'db_pool' : get_pool().get_stats()
+        }
+    if current_app.config['DATABASE_WAL']:
+        stats['db_read_pool'] = get_pool(readonly=True).get_stats()
+        checkpointer = current_app.extensions.get('sqlite_checkpointer')
+        if checkpointer is not None:
+            stats['wal_checkpointer'] = checkpointer.get_stats()
+    if current_app.config['GROUP_COMMIT']:
+        stats['group_commit'] = get_group_committer().get_stats()
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher is not None:
+        stats['password_hasher'] = hasher.get_stats()
+    compressor = current_app.extensions.get('compressor')
+    if compressor is not None:
+        stats['compressor'] = compressor.get_stats()
+    syncer = current_app.extensions.get('group_syncer')
+    if syncer is not None:
+        stats['group_syncer'] = syncer.get_stats()
+    scrubber = current_app.extensions.get('scrubber')
+    if scrubber is not None:
+        stats['scrubber'] = scrubber.get_stats()
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is not None and current_app.config['RATELIMIT_ENABLED']:
+        stats['rate_limiter'] = limiter.get_stats()
+    for name, accessor in (('filepath_cache', get_filepath_cache),
+                           ('negative_cache', get_negative_cache),
+                           ('apikey_cache', get_apikey_cache),
+                           ('package_filter', get_package_filter)):
+        cache = accessor()
+        if cache is not None:
+            stats[name] = cache.get_stats()
+    from package_database import volume_usage
+    stats['volumes'] = get_volume_stats(volume_usage())
+    return stats
 
 def init_db():
     """
@@ -26,15 +202,115 @@ def init_db():
     with current_app.open_resource('schema.sql', mode='r') as f:
         db.cursor().executescript(f.read())
     db.commit()
+    upgrade_db()
+    init_search_index()
+
+# columns added to tables after they were first created, (table, column, declaration)
+UPGRADE_COLUMNS = [
+    ('filestore', 'digest', 'varchar(64)'),
+    ('filestore', 'size', 'integer'),
+    ('filestore', 'refcount', 'integer default 0'),
+    ('tags', 'filename', 'varchar(255)'),
+    ('filestore', 'gzip_size', 'integer'),
+    ('filestore', 'zstd_size', 'integer'),
+    ('filestore', 'compressed', 'integer default 0'),
+    ('filestore', 'volume', 'varchar(64)'),
+    ('filestore', 'mtime', 'integer'),
+    ('filestore', 'content_type', 'varchar(255)'),
+    ('filestore', 'uploaded', 'integer'),
+    ('tags', 'content_type', 'varchar(255)')
+    ]
+
+def upgrade_db():
+    """
+    Adds the columns, tables and indexes introduced since a database was created.
+    Every statement in schema_upgrade.sql is idempotent and columns are only added
+    when missing, so this is safe to run again
+    """
+    db = get_db()
+    for table, column, declaration in UPGRADE_COLUMNS:
+        columns = [ row['name'] for row in db.execute('PRAGMA table_info({t})'.format(t=table)) ]
+        if column not in columns:
+            db.execute('ALTER TABLE {t} ADD COLUMN {c} {d}'.format(t=table, c=column, d=declaration))
+    with current_app.open_resource('schema_upgrade.sql', mode='r') as f:
+        db.cursor().executescript(f.read())
+    db.commit()
+
+def init_search_index():
+    """
+    Creates (or rebuilds) the full text search index over package titles and tags.
+    Older sqlite builds without FTS5 or the trigram tokenizer keep using LIKE searches
+    """
+    current_app.extensions.pop('sqlite_fts', None)
+    if not current_app.config['SEARCH_FTS']:
+        return False
+    db = get_db()
+    try:
+        with current_app.open_resource('schema_fts.sql', mode='r') as f:
+            db.cursor().executescript(f.read())
+        db.commit()
+        return True
+    except sqlite3.OperationalError as err:
+        db.rollback()
+        current_app.logger.warning("Full text search unavailable, searches fall back to LIKE : {e}".format(e=err))
+        return False
+
+def fts_enabled():
+    """
+    Whether searches can use the full text index, checked once per database
+    """
+    if not current_app.config['SEARCH_FTS']:
+        return False
+    enabled = current_app.extensions.setdefault('sqlite_fts', {})
+    database = current_app.config['DATABASE']
+    if database not in enabled:
+        enabled[database] = get_read_db().execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'packages_fts'"
+                ).fetchone() is not None
+    return enabled[database]
+
+def checkpoint_db(mode='TRUNCATE'):
+    """
+    Runs a WAL checkpoint on the writer connection, returns the busy/log/checkpointed counts
+    """
+    return get_db().execute('PRAGMA wal_checkpoint({m})'.format(m=mode)).fetchone()
+
+def _checkout(attr, readonly):
+    if not hasattr(g, attr):
+        pool = get_pool(readonly=readonly)
+        try:
+            setattr(g, attr, pool.acquire())
+            setattr(g, attr + '_pool', pool)
+        except PoolExhaustedError as err:
+            current_app.logger.error("Unable to get a database connection : {e}".format(e=err))
+            raise error_handlers.UnhandledError()
+    return getattr(g, attr)
 
 def get_db():
     """
-    Opens a new database connection if ther eis none yet for the current application
-    context.
+    Checks a database connection out of the pool if there is none yet for the current
+    application context.  This is the connection used for writes.
     """
-    if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
-    return g.sqlite_db
+    return _checkout('sqlite_db', readonly=False)
+
+def get_read_db():
+    """
+    Checks a readonly connection out of the pool if there is none yet for the current
+    application context.  Without WAL this is the same connection get_db returns.
+    """
+    if not current_app.config['DATABASE_WAL']:
+        return get_db()
+    return _checkout('sqlite_read_db', readonly=True)
+
+def release_db(error=False):
+    """
+    Returns the connections checked out by the current application context to the pool,
+    anything uncommitted is rolled back.  The next get_db/get_read_db checks out a
+    connection again, so a request can hand its connection back before a long wait
+    """
+    for attr in ('sqlite_db', 'sqlite_read_db'):
+        if hasattr(g, attr):
+            g.pop(attr + '_pool').release(g.pop(attr), error=error)
 
 def register_cli(app):
     @app.cli.command('initdb')
@@ -45,17 +321,143 @@ def register_cli(app):
         init_db()
         print('Initialized the database.')
 
+    @app.cli.command('upgradedb')
+    def upgradedb_command():
+        """
+        Adds new tables and indexes to an existing database
+        """
+        upgrade_db()
+        print('Upgraded the database.')
+
+    @app.cli.command('migrate_blobs')
+    def migrate_blobs_command():
+        """
+        Moves files stored by package name into the content addressed blob store
+        """
+        from filestore import migrate_to_blobs
+        migrated, duplicates = migrate_to_blobs()
+        print('Migrated {m} files, {d} of them were duplicates.'.format(m=migrated, d=duplicates))
+
+    @app.cli.command('reshard_blobs')
+    def reshard_blobs_command():
+        """
+        Moves stored blobs to the configured BLOB_FANOUT_LEVELS and BLOB_FANOUT_WIDTH layout
+        """
+        from filestore import reshard_blobs
+        moved, missing = reshard_blobs()
+        print('Moved {m} blobs, {n} were missing.'.format(m=moved, n=missing))
+
+    @app.cli.command('drain_volumes')
+    def drain_volumes_command():
+        """
+        Moves stored blobs off the volumes marked drain onto the others
+        """
+        from filestore import drain_volumes
+        moved, missing = drain_volumes()
+        print('Moved {m} blobs, {n} were missing.'.format(m=moved, n=missing))
+
+    @app.cli.command('scrub')
+    @click.option('--action', type=click.Choice(['report', 'quarantine', 'repair']), default=None,
+                  help='what to do about problems found, SCRUB_ACTION by default')
+    @click.option('--verify/--no-verify', default=None, help='hash every file, SCRUB_VERIFY_DIGEST by default')
+    def scrub_command(action, verify):
+        """
+        Checks the filestore, tags and blob store against each other
+        """
+        from scrubber import scrub, ScrubReport
+        config = dict(app.config)
+        if action is not None:
+            config['SCRUB_ACTION'] = action
+        if verify is not None:
+            config['SCRUB_VERIFY_DIGEST'] = verify
+        report = scrub(ScrubReport(on_finding=lambda finding: print(json.dumps(finding))), config=config)
+        stats = report.get_stats()
+        if stats['skipped']:
+            print('Another process is scrubbing, try again once it is done.')
+            return
+        print('Checked {r} rows, {t} tags and {f} files: {n} problems, {q} quarantined, {p} repaired.'.format(
+            r=stats['rows_checked'],
+            t=stats['tags_checked'],
+            f=stats['files_checked'],
+            n=sum(stats['found'].values()),
+            q=stats['quarantined'],
+            p=stats['repaired']
+            ))
+
+    @app.cli.command('expire_uploads')
+    def expire_uploads_command():
+        """
+        Removes resumable uploads that were abandoned
+        """
+        from upload_sessions import expire_upload_sessions
+        print('Removed {n} expired uploads.'.format(n=expire_upload_sessions()))
+
+    @app.cli.command('compress_blobs')
+    def compress_blobs_command():
+        """
+        Makes the precompressed variants of stored files that do not have them yet
+        """
+        from compression import compress_pending
+        files, kept = compress_pending()
+        print('Compressed {f} files, kept {k} variants.'.format(f=files, k=kept))
+
+    @app.cli.command('build_search_index')
+    def build_search_index_command():
+        """
+        Adds or rebuilds the full text search index on an existing database
+        """
+        if init_search_index():
+            print('Built the search index.')
+        else:
+            print('Full text search is not available, searches will use LIKE.')
+
+    @app.cli.command('checkpoint')
+    def checkpoint_command():
+        """
+        Checkpoints and truncates the WAL file
+        """
+        result = checkpoint_db()
+        print('Checkpoint busy={b} log={l} checkpointed={c}'.format(
+            b=result['busy'],
+            l=result['log'],
+            c=result['checkpointed']
+            ))
+
+def register_background_services(app):
+    @app.before_request
+    def start_background_services():
+        """
+        Starts the scrubber in the worker serving the request, each process of a pre-fork
+        server gets its own once it serves requests
+        """
+        if app.config['SCRUB_INTERVAL']:
+            from scrubber import start_scrubber
+            start_scrubber()
+
 def register_teardowns(app):
     @app.teardown_appcontext
     def close_db(error):
         """
-        Closes the database again at the end of the request.
+        Returns the database connection to the pool at the end of the request.
         """
-        if hasattr(g, 'sqlite_db'):
-            g.sqlite_db.close()
+        release_db(error=error is not None)
+
+class UploadRequest(Request):
+    """
+    Streams uploaded files straight into temporary files in the blob store of the volume
+    chosen for them while the multipart body is parsed, hashing them on the way, instead of
+    buffering them and copying them over afterwards.  The json part of an upload is parsed
+    as usual
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if content_type == 'application/json':
+            return Request._get_file_stream(self, total_content_length, content_type, filename, content_length)
+        volume = choose_volume()
+        return BlobUpload(volume['path'], volume=volume['name'])
 
 
 app = Flask('flask_package_mgr')
+app.request_class = UploadRequest
 
 app.config.update(
     dict(
@@ -64,13 +466,87 @@ app.config.update(
         SECRET_KEY='TempKey',
         USERNAME='admin',
         PASSWORD='default',
-        UPLOAD_FOLDER='uploads/'
+        UPLOAD_FOLDER='uploads/',
+        UPLOAD_FSYNC=True,
+        DURABILITY=None,
+        DURABILITY_GROUP_WINDOW=0.002,
+        DURABILITY_GROUP_MAX_BATCH=64,
+        DURABILITY_GROUP_TIMEOUT=30,
+        UPLOAD_SESSION_TTL=86400,
+        DATABASE_POOL_SIZE=5,
+        DATABASE_POOL_MAX_USES=1000,
+        DATABASE_POOL_TIMEOUT=30,
+        DATABASE_POOL_HEALTH_CHECK=True,
+        DATABASE_STATEMENT_CACHE=200,
+        SEARCH_FTS=True,
+        LIST_BATCH_SIZE=500,
+        DATABASE_WAL=False,
+        DATABASE_BUSY_TIMEOUT=5000,
+        DATABASE_SYNCHRONOUS='FULL',
+        DATABASE_WAL_AUTOCHECKPOINT=1000,
+        DATABASE_CHECKPOINT_INTERVAL=60,
+        DATABASE_CHECKPOINT_WAL_SIZE=64 * 1024 * 1024,
+        DATABASE_CHECKPOINT_MODE='PASSIVE',
+        GROUP_COMMIT=False,
+        GROUP_COMMIT_MAX_BATCH=32,
+        GROUP_COMMIT_MAX_WAIT=0.002,
+        GROUP_COMMIT_TIMEOUT=30,
+        FILEPATH_CACHE_ENABLED=True,
+        FILEPATH_CACHE_SIZE=4096,
+        FILEPATH_CACHE_TTL=300,
+        NEGATIVE_CACHE_ENABLED=True,
+        NEGATIVE_CACHE_SIZE=4096,
+        NEGATIVE_CACHE_TTL=5,
+        PACKAGE_FILTER_ENABLED=True,
+        PACKAGE_FILTER_CAPACITY=100000,
+        PACKAGE_FILTER_ERROR_RATE=0.01,
+        PACKAGE_FILTER_REFRESH=5,
+        TOKEN_TTL=24 * 60 * 60,
+        TOKEN_KEY_ID='1',
+        TOKEN_KEYS=None,
+        PASSWORD_HASH_ITERATIONS=100000,
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_QUEUE_SIZE=16,
+        PASSWORD_HASH_TIMEOUT=30,
+        APIKEY_CACHE_ENABLED=True,
+        APIKEY_CACHE_SIZE=1024,
+        APIKEY_CACHE_TTL=60,
+        RATELIMIT_ENABLED=False,
+        RATELIMIT_LIMITS={
+            'upload_bytes' : (10 * 1024 * 1024, 100 * 1024 * 1024),
+            'downloads' : (10, 50),
+            'searches' : (10, 50)
+            },
+        RATELIMIT_MAX_CONCURRENT_UPLOADS=2,
+        RATELIMIT_USER_LIMITS={},
+        BLOB_CACHE_MAX_AGE=31536000,
+        BLOB_FANOUT_LEVELS=2,
+        BLOB_FANOUT_WIDTH=2,
+        STORAGE_VOLUMES=None,
+        STORAGE_MIN_FREE=0,
+        SCRUB_INTERVAL=0,
+        SCRUB_ACTION='report',
+        SCRUB_VERIFY_DIGEST=False,
+        SCRUB_MAX_IOPS=200,
+        SCRUB_BATCH_SIZE=500,
+        SCRUB_WORKERS=4,
+        SCRUB_ORPHAN_MIN_AGE=3600,
+        DOWNLOAD_CACHE_CONTROL='private, no-cache',
+        DOWNLOAD_MAX_RANGES=16,
+        DOWNLOAD_MODE='direct',
+        DOWNLOAD_ACCEL_PREFIX='/protected/',
+        COMPRESS_ENABLED=False,
+        COMPRESS_ENCODINGS=['gzip', 'zstd'],
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_MIN_SAVING=0.1,
+        COMPRESS_QUEUE_SIZE=64
         )
     )
 
 app.config.from_envvar('FLASK_PACKAGE_MGR_SETTINGS', silent=True)
     
 register_cli(app)
+register_background_services(app)
 register_teardowns(app)
 
 from blueprints.routes import pckg
@@ -0,0 +1,161 @@
+import os
+import time
+import threading
+import Queue
+from sqlite3 import dbapi2 as sqlite3
+
+from metrics import Histogram
+
+BATCH_SIZE_BOUNDS = [1, 2, 4, 8, 16, 32, 64, 128]
+COMMIT_LATENCY_MS_BOUNDS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+class GroupCommitTimeout(Exception):
+    """
+    raised to a caller whose write was not applied within the timeout
+    """
+    pass
+
+class _Job(object):
+    __slots__ = ('write', 'kwargs', 'result', 'error', 'done')
+
+    def __init__(self, write, kwargs):
+        self.write = write
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class GroupCommitter(object):
+    """
+    Applies row writes from many concurrent requests in shared transactions.
+
+    Callers submit a write function, a single writer thread takes whatever is
+    queued (up to max_batch, waiting at most max_wait seconds for more to arrive)
+    and runs each write in its own savepoint inside one transaction, so one
+    commit covers the whole batch.  A write that raises is rolled back to its
+    savepoint and the exception is handed back to that caller only.
+    """
+    def __init__(self, connect, database, max_batch=32, max_wait=0.002, timeout=30):
+        self.connect = connect
+        self.database = database
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._queue = Queue.Queue()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.batch_sizes = Histogram(BATCH_SIZE_BOUNDS)
+        self.commit_latency_ms = Histogram(COMMIT_LATENCY_MS_BOUNDS)
+        self._stats = {
+            'submitted' : 0,
+            'failed_writes' : 0,
+            'failed_commits' : 0
+            }
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='group-committer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def submit(self, write, **kwargs):
+        """
+        queues write(db, **kwargs) and blocks until its batch has committed.  Returns
+        what write returned, or raises what it raised
+        """
+        self.start()
+        job = _Job(write, kwargs)
+        with self._lock:
+            self._stats['submitted'] += 1
+        self._queue.put(job)
+        if not job.done.wait(self.timeout):
+            raise GroupCommitTimeout('write was not committed after {t}s'.format(t=self.timeout))
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _next_batch(self):
+        try:
+            batch = [ self._queue.get(timeout=1) ]
+        except Queue.Empty:
+            return []
+
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _apply(self, db, batch):
+        db.execute('BEGIN IMMEDIATE')
+        for job in batch:
+            db.execute('SAVEPOINT group_write')
+            try:
+                job.result = job.write(db, **job.kwargs)
+                db.execute('RELEASE group_write')
+            except Exception as err:
+                db.execute('ROLLBACK TO group_write')
+                db.execute('RELEASE group_write')
+                job.error = err
+                with self._lock:
+                    self._stats['failed_writes'] += 1
+
+        start = time.time()
+        db.execute('COMMIT')
+        self.commit_latency_ms.observe((time.time() - start) * 1000.0)
+        self.batch_sizes.observe(len(batch))
+
+    def _run(self):
+        db = None
+        while not self._stop_event.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                if db is None:
+                    db = self.connect(self.database)
+                    # savepoints need the connection in autocommit mode, the
+                    # transaction is managed explicitly in _apply
+                    db.isolation_level = None
+                self._apply(db, batch)
+            except Exception as err:
+                with self._lock:
+                    self._stats['failed_commits'] += 1
+                if db is not None:
+                    try:
+                        db.execute('ROLLBACK')
+                    except sqlite3.Error:
+                        pass
+                    db.close()
+                    db = None
+                for job in batch:
+                    job.result = None
+                    job.error = err
+            finally:
+                for job in batch:
+                    job.done.set()
+        if db is not None:
+            db.close()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['max_batch'] = self.max_batch
+        stats['max_wait'] = self.max_wait
+        stats['batch_size'] = self.batch_sizes.get_stats()
+        stats['commit_latency_ms'] = self.commit_latency_ms.get_stats()
+        return stats
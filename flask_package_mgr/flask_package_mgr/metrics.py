@@ -0,0 +1,35 @@
+import bisect
+import threading
+
+class Histogram(object):
+    """
+    A fixed bucket histogram.  Each observation is counted in the first bucket whose
+    upper bound it does not exceed, anything larger than the last bound goes in an
+    overflow bucket
+    """
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._count = 0
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._count += 1
+            self._sum += value
+
+    def get_stats(self):
+        with self._lock:
+            counts = list(self._counts)
+            count = self._count
+            total = self._sum
+        buckets = [ { 'le' : bound, 'count' : c } for bound, c in zip(self.bounds, counts) ]
+        buckets.append({ 'le' : 'inf', 'count' : counts[-1] })
+        return {
+            'buckets' : buckets,
+            'count' : count,
+            'sum' : total
+            }
@@ -1,16 +1,171 @@
+import time
 import sqlite3
+from contextlib import contextmanager
 from flask import g, current_app
 
-from flask_package_mgr import get_db
+from flask_package_mgr import get_db, get_read_db, get_group_committer, fts_enabled
+from group_commit import GroupCommitTimeout
 
 from error_handlers import IntegrityError, UnhandledError, NotFoundError
+from cache import get_filepath_cache, get_negative_cache, get_package_filter
+from blobstore import variant_path, publish_blob, unpublish_blob, remove_blob, link_blob
+from volumes import DEFAULT_VOLUME
 
-def query_db(query, args=(), one=False):
+# RETURNING is only available from sqlite 3.35 onwards
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+@contextmanager
+def transaction():
+    """
+    Runs the enclosed statements on the writer connection as a single transaction.
+    The write lock is taken up front, it is committed once at the end or rolled
+    back if anything raises
+    """
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+# download resolution, kept as a constant so the compiled statement is reused
+# from the per connection statement cache.  tags are found through the
+# unique (tag, package_id) index
+LOOKUP_FILEPATH_QUERY = """
+    SELECT packages.id AS package_id, tags.filestore_id AS filestore_id, tags.filename AS filename,
+           filestore.package_filepath AS package_filepath, filestore.digest AS digest, filestore.size AS size,
+           filestore.gzip_size AS gzip_size, filestore.zstd_size AS zstd_size, filestore.volume AS volume,
+           filestore.mtime AS mtime, COALESCE(tags.content_type, filestore.content_type) AS content_type
+    FROM packages
+    LEFT JOIN tags ON tags.tag = ? AND tags.package_id = packages.id
+    LEFT JOIN filestore ON filestore.id = tags.filestore_id
+    WHERE packages.title = ?
+    """
+
+# substring searches through the trigram index, a trigram index can only answer
+# terms of at least three characters so shorter ones still go through LIKE
+FTS_MIN_TERM_LENGTH = 3
+
+SEARCH_PACKAGES_FTS_QUERY = """
+    SELECT title, rowid AS id FROM packages_fts
+    WHERE packages_fts MATCH ?
+    ORDER BY rank
+    LIMIT ?
+    """
+
+SEARCH_TAGS_FTS_QUERY = """
+    SELECT tags.tag AS tag, tags.id AS id{c} FROM tags_fts
+    JOIN tags ON tags.id = tags_fts.rowid{j}
+    WHERE tags_fts MATCH ? AND tags.package_id = ?
+    ORDER BY tags_fts.rank
+    LIMIT ?
+    """
+
+# what a tag listing returns about each tag's file when details are asked for, recorded
+# on its filestore row when the file was stored
+TAG_DETAILS_COLUMNS = """, tags.filename AS filename, filestore.digest AS digest, filestore.size AS size,
+    COALESCE(tags.content_type, filestore.content_type) AS content_type, filestore.mtime AS mtime,
+    filestore.uploaded AS uploaded"""
+TAG_DETAILS_JOIN = """
+    LEFT JOIN filestore ON filestore.id = tags.filestore_id"""
+
+def tag_columns(details):
+    """
+    the extra columns and join of a tag listing, none unless details are asked for
+    """
+    return (TAG_DETAILS_COLUMNS, TAG_DETAILS_JOIN) if details else ('', '')
+
+def use_fts(search_term):
+    """
+    whether a search for search_term can be answered from the full text index
+    """
+    return len(search_term) >= FTS_MIN_TERM_LENGTH and fts_enabled()
+
+def fts_phrase(search_term):
+    """
+    quotes a search term as a single FTS5 phrase, which the trigram tokenizer
+    matches as a case insensitive substring just like LIKE '%term%'
+    """
+    return '"{st}"'.format(st=search_term.replace('"', '""'))
+
+def invalidate_filepath_cache(predicate):
+    """
+    drops the cached (package, tag) -> filepath resolutions a write has changed
+    """
+    cache = get_filepath_cache()
+    if cache is not None:
+        cache.invalidate_where(predicate)
+
+def fetch_package_titles(after_id):
+    """
+    returns the id and title of every package added after after_id, for the package filter
+    """
+    titles = query_db(
+            query="SELECT id, title FROM packages WHERE id > ? ORDER BY id",
+            args=[ after_id ],
+            readonly=True
+            )
+    return titles if titles is not None else []
+
+def package_may_exist(package_name):
+    """
+    checks the package filter, False means the package is known not to exist and
+    there is no need to query for it
+    """
+    package_filter = get_package_filter()
+    if package_filter is None:
+        return True
+    package_filter.refresh(fetch_package_titles)
+    return package_filter.might_contain(package_name)
+
+def cached_miss(key):
+    """
+    what the negative cache remembers about a lookup that found nothing, None when it was
+    not remembered.  Publishes by this process drop the misses they make wrong, those by
+    other processes are picked up once the miss is NEGATIVE_CACHE_TTL old
+    """
+    negative = get_negative_cache()
+    if negative is None:
+        return None
+    return negative.get(key)
+
+def miss_generation():
+    """
+    read before a lookup and handed to remember_miss, so a publish by this process racing
+    the lookup keeps its miss out of the negative cache
+    """
+    negative = get_negative_cache()
+    return negative.generation if negative is not None else None
+
+def remember_miss(key, generation, value=True):
+    """
+    remembers a lookup that found nothing, unless something was invalidated since generation
+    """
+    negative = get_negative_cache()
+    if negative is not None:
+        negative.put(key, value, generation=generation)
+
+def remember_package(package_name):
+    """
+    adds a newly written package to the package filter and drops the cached misses
+    that it makes wrong
+    """
+    package_filter = get_package_filter()
+    if package_filter is not None:
+        package_filter.add(package_name)
+    negative = get_negative_cache()
+    if negative is not None:
+        negative.invalidate_where(lambda key, value: key[0] in ('package', 'filepath') and key[1] == package_name)
+
+def query_db(query, args=(), one=False, readonly=False):
     """
     Standard query function that will combine getting the cursor, executing, and
-    fetching the results
+    fetching the results.  readonly queries may be sent to a readonly connection
     """
-    cur = get_db().execute(query, args)
+    db = get_read_db() if readonly else get_db()
+    cur = db.execute(query, args)
     rv = cur.fetchall()
     cur.close()
     
@@ -39,14 +194,35 @@ def insert_db(table, fields=(), values=()):
     cur.close()
     return insert_id
 
-def table_list(table):
+def table_list(table, cursor=None, limit=None):
     """
-    Used to generate a table list
+    Used to generate a table list, ordered by id.  cursor/limit select a keyset page,
+    the rows with an id greater than cursor
     """
     return query_db(
-            query='SELECT * FROM {t}'.format(t=table)
+            query='SELECT * FROM {t} WHERE id > ? ORDER BY id LIMIT ?'.format(t=table),
+            args=[ cursor or 0, limit if limit is not None else -1 ],
+            readonly=True
             )
 
+def iter_pages(page, cursor=None, limit=None, batch_size=500, **kwargs):
+    """
+    Generator over every row of a keyset paged listing.  page(cursor=, limit=, **kwargs)
+    is called for batch_size rows at a time, so only one batch is ever held in memory
+    and no read is left open between batches
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        rows = page(cursor=cursor, limit=size, **kwargs) or []
+        for row in rows:
+            yield row
+        if len(rows) < size:
+            return
+        cursor = rows[-1]['id']
+        if remaining is not None:
+            remaining -= len(rows)
+
 def add_user(username, password, key):
     """
     adds a user to the database
@@ -60,9 +236,8 @@ def add_user(username, password, key):
     except sqlite3.IntegrityError as err:
         raise IntegrityError(message='username is already in use')
     except Exception as err:
-        current_app.logger.error("Unable to add user {u}, password {p}, apikey {k} because {e}({et})".format(
+        current_app.logger.error("Unable to add user {u}, apikey {k} because {e}({et})".format(
             u = username,
-            p = password,
             k = key,
             e = err,
             et=type(err)
@@ -79,7 +254,8 @@ def lookup_user_id(username):
         user_id = query_db(
                     query=search_query,
                     args = [ username ],
-                    one=True
+                    one=True,
+                    readonly=True
                     )
         return user_id['id'] if user_id != None else None
     except Exception as err:
@@ -89,27 +265,34 @@ def lookup_user_id(username):
                     ))
         raise UnhandledError()
 
-def list_users():
+def list_users(cursor=None, limit=None):
     """
     lists users of the database, for testing only
     """
-    return table_list('users')
+    return table_list('users', cursor=cursor, limit=limit)
 
-def lookup_password(user):
+def iter_users(cursor=None, limit=None, batch_size=500):
+    """
+    generator over the users of the database, for testing only
+    """
+    return iter_pages(list_users, cursor=cursor, limit=limit, batch_size=batch_size)
+
+def lookup_credentials(user):
     """
-    Lookup a users password.  This is not a good way of doing this.  The 
-    database is not salted or hashed.  But this is a quick way of doing this.
+    Lookup a users id and stored password, see passwords.py for how it is stored
     """
 
     try:
-        password_query = "SELECT password FROM users WHERE username = ?";
-        password = query_db(
-                query=password_query,
-                args=[ user ]
+        credentials_query = "SELECT id, password FROM users WHERE username = ?";
+        credentials = query_db(
+                query=credentials_query,
+                args=[ user ],
+                one=True,
+                readonly=True
                 )
-        if None == password:
+        if None == credentials:
             raise NotFoundError(message='username not found')
-        return password[0]['password']
+        return credentials
     except NotFoundError as err:
         raise err
     except Exception as err:
@@ -119,317 +302,521 @@ def lookup_password(user):
                     ))
         raise UnhandledError()
 
+def update_password(user_id, password):
+    """
+    replaces the stored password of a user
+    """
+    try:
+        with transaction() as db:
+            db.execute("UPDATE users SET password = ? WHERE id = ?", [ password, user_id ])
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in update_password user_id={u} : {e}".format(
+                    u=user_id,
+                    e=err
+                    ))
+        raise UnhandledError()
 
+def store_apikey(user_id, name, prefix, key_hash):
+    """
+    stores a new api key for a user, only the prefix and the hash of the secret are kept
+    """
+    try:
+        return insert_db(
+                table='apikeys',
+                fields=[ 'user_id', 'name', 'prefix', 'key_hash', 'created' ],
+                values=[ user_id, name, prefix, key_hash, int(time.time()) ]
+                )
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in store_apikey user_id={u} prefix={p} : {e}".format(
+                    u=user_id,
+                    p=prefix,
+                    e=err
+                    ))
+        raise UnhandledError()
 
-def search_all_packages():
+def lookup_apikey(prefix):
     """
-    returns a list of all packages currently being stored
+    looks up the user and stored hash of an api key by its prefix, None if there is no such key
     """
     try:
-        all_packages_query = "SELECT title, id FROM packages"
-        packages = query_db(
-                query=all_packages_query
+        return query_db(
+                query="SELECT user_id, key_hash FROM apikeys WHERE prefix = ?",
+                args=[ prefix ],
+                one=True,
+                readonly=True
                 )
-        if None == packages:
-            packages = []
-        return packages
     except Exception as err:
-        current_app.logger.error("Unhandled Error in search_all_packages : {e}".format(
+        current_app.logger.error("Unhandled Error in lookup_apikey prefix={p} : {e}".format(
+                    p=prefix,
                     e=err
                     ))
         raise UnhandledError()
 
+def list_apikeys(user_id):
+    """
+    lists the api keys of a user, without their hashes
+    """
+    try:
+        apikeys = query_db(
+                query="SELECT id, name, prefix, created FROM apikeys WHERE user_id = ? ORDER BY id",
+                args=[ user_id ],
+                readonly=True
+                )
+        return apikeys if apikeys is not None else []
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in list_apikeys user_id={u} : {e}".format(
+                    u=user_id,
+                    e=err
+                    ))
+        raise UnhandledError()
 
+def delete_apikey(user_id, prefix):
+    """
+    removes an api key belonging to user_id, returns False if the user has no such key
+    """
+    try:
+        with transaction() as db:
+            deleted = db.execute(
+                    "DELETE FROM apikeys WHERE prefix = ? AND user_id = ?",
+                    [ prefix, user_id ]
+                    ).rowcount
+        return deleted > 0
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in delete_apikey user_id={u} prefix={p} : {e}".format(
+                    u=user_id,
+                    p=prefix,
+                    e=err
+                    ))
+        raise UnhandledError()
 
-def search_packages(search_term):
+def store_upload_session(session_id, user_id, package_name, tag, filename, size, digest, expires):
     """
-    Allows users to search for specific text within a package name
+    stores a new resumable upload session
     """
     try:
-        search_query = "SELECT title, id FROM packages WHERE title LIKE ?"
-        search_term = "%{st}%".format(st=search_term)
-        packages = query_db(
-                query=search_query,
-                args=[ search_term ]
-                )
-        if None == packages:
-            packages = []
-        return packages
+        with transaction() as db:
+            db.execute(
+                    "INSERT INTO upload_sessions (id, user_id, package_name, tag, filename, size, digest, expires) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [ session_id, user_id, package_name, tag, filename, size, digest, expires ]
+                    )
     except Exception as err:
-        current_app.logger.error("Unhandled Error in search_packages {st} : {e}".format(
-                    st=search_term,
+        current_app.logger.error("Unhandled Error in store_upload_session user_id={u} package_name={pn} tag={t} : {e}".format(
+                    u=user_id,
+                    pn=package_name,
+                    t=tag,
                     e=err
                     ))
         raise UnhandledError()
 
-def lookup_package_id(package_name):
+def lookup_upload_session(session_id):
     """
-    looks up the package id for the given package name, if exists
+    looks up an upload session, None if there is no such session
     """
     try:
-        search_query = "SELECT id FROM packages WHERE title = ?"
-    
-        package_id = query_db(
-                query=search_query,
-                args = [ package_name ],
+        return query_db(
+                query="SELECT * FROM upload_sessions WHERE id = ?",
+                args=[ session_id ],
                 one=True
                 )
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in lookup_upload_session id={i} : {e}".format(
+                    i=session_id,
+                    e=err
+                    ))
+        raise UnhandledError()
 
-        return package_id['id'] if package_id is not None else None
+def list_upload_ranges(session_id):
+    """
+    lists the byte ranges received for an upload session, [start, end) ordered by start
+    """
+    try:
+        ranges = query_db(
+                query="SELECT start_offset, end_offset FROM upload_ranges WHERE session_id = ? ORDER BY start_offset",
+                args=[ session_id ]
+                )
+        return ranges if ranges is not None else []
     except Exception as err:
-        current_app.logger.error("Unhandled Error in lookup_package_id {pn} : {e}".format(
-                    pn = package_name,
+        current_app.logger.error("Unhandled Error in list_upload_ranges id={i} : {e}".format(
+                    i=session_id,
                     e=err
                     ))
+        raise UnhandledError()
 
+def begin_upload_chunk(session_id, user_id, expires):
+    """
+    registers a chunk being written to an open upload session of user_id and pushes back its
+    expiry.  Returns False if there is no such open session.  A session with chunks being
+    written can not be committed or aborted, see claim_upload_session
+    """
+    try:
+        with transaction() as db:
+            return db.execute(
+                    "UPDATE upload_sessions SET writers = writers + 1, expires = ? WHERE id = ? AND user_id = ? AND state = 'open'",
+                    [ expires, session_id, user_id ]
+                    ).rowcount > 0
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in begin_upload_chunk id={i} : {e}".format(
+                    i=session_id,
+                    e=err
+                    ))
         raise UnhandledError()
- 
-def store_package_name(package_name, user):
+
+def end_upload_chunk(session_id, start=None, end=None):
     """
-    stores a new package in the database, should only be used after checking lookup_package_id
+    marks a chunk registered with begin_upload_chunk as finished, recording [start, end) as
+    received when it was written
     """
     try:
-        add_package_id = insert_db(
-                        table='packages',
-                        fields=[ 'title', 'user_id' ],
-                        values=[ package_name, user ]
+        with transaction() as db:
+            db.execute("UPDATE upload_sessions SET writers = writers - 1 WHERE id = ?", [ session_id ])
+            if start is not None:
+                db.execute(
+                        "INSERT INTO upload_ranges (session_id, start_offset, end_offset) VALUES (?, ?, ?)",
+                        [ session_id, start, end ]
                         )
-        return add_package_id
-    except sqlite3.IntegrityError as err:
-        raise IntegrityError(message='package name already in use')
     except Exception as err:
-        current_app.logger.error("Unhandled Error in store_package_name package_name={pn} user={u} : {e}".format(
-                                pn=package_name,
-                                u=user,
-                                e=err
-                                ))
+        current_app.logger.error("Unhandled Error in end_upload_chunk id={i} : {e}".format(
+                    i=session_id,
+                    e=err
+                    ))
         raise UnhandledError()
 
-def delete_package(package_id):
+def claim_upload_session(session_id, user_id, state):
     """
-    removes a package from the database package table, used for cleanup from errors
+    moves an open upload session of user_id with no chunks being written to state, so it
+    can be committed or aborted without any writes racing it.  Returns False if it could
+    not be claimed
     """
     try:
-        delete_query = "DELETE FROM packages WHERE id = ?"
-
-        query_db(
-            query=delete_query,
-            args = [ package_id ]
-            )
-        return True
+        with transaction() as db:
+            return db.execute(
+                    "UPDATE upload_sessions SET state = ? WHERE id = ? AND user_id = ? AND state = 'open' AND writers = 0",
+                    [ state, session_id, user_id ]
+                    ).rowcount > 0
     except Exception as err:
-        current_app.logger.error("could not delete package {pd} from table : {e}".format(
-                                pd = package_id,
-                                e = err
-                                ))
+        current_app.logger.error("Unhandled Error in claim_upload_session id={i} : {e}".format(
+                    i=session_id,
+                    e=err
+                    ))
         raise UnhandledError()
 
-
-def lookup_filestore_id_by_path(filepath):
+def claim_expired_upload_session(session_id, now):
     """
-    looks up a current filestore_id from a package location
+    claims an upload session that expired before now for removal, the same way
+    claim_upload_session does.  Returns False if it has been written to since, or it is
+    claimed or has chunks being written
     """
     try:
-        search_query = "SELECT id FROM filestore WHERE package_filepath = ?"
-
-        filestore_id = query_db(
-                query=search_query,
-                args = [ filepath ],
-                one=True
-                )
-        return filestore_id['id'] if filestore_id is not None else None
+        with transaction() as db:
+            return db.execute(
+                    "UPDATE upload_sessions SET state = 'expiring' WHERE id = ? AND state = 'open' AND writers = 0 AND expires <= ?",
+                    [ session_id, now ]
+                    ).rowcount > 0
     except Exception as err:
-        current_app.logger.error("Unhandled Error in lookup_filestore_id_by_path filestore={f} : {e}".format(
-                        f=filepath,
-                        e=err
-                        ))
+        current_app.logger.error("Unhandled Error in claim_expired_upload_session id={i} : {e}".format(
+                    i=session_id,
+                    e=err
+                    ))
         raise UnhandledError()
 
-def store_filestore(filepath):
+def release_upload_session(session_id):
     """
-    stores a new filestore in the database, should only be used after checking lookup_filestore_id_by_path
+    reopens a claimed upload session
     """
     try:
-        add_filestore_id = insert_db(
-                    table='filestore',
-                    fields = [ 'package_filepath' ],
-                    values = [ filepath ]
-                    )
-        return add_filestore_id
-    except sqlite3.IntegrityError as err:
-        current_app.logger.error("Package location is not unique : {f}".format(
-                f=filepath
-                ))
-        raise UnhandledError()
+        with transaction() as db:
+            db.execute("UPDATE upload_sessions SET state = 'open' WHERE id = ?", [ session_id ])
     except Exception as err:
-        current_app.logger.error("Unhandled Error in store_filestore filepath={f} : {e}".format(
-                    f=filepath,
+        current_app.logger.error("Unhandled Error in release_upload_session id={i} : {e}".format(
+                    i=session_id,
                     e=err
                     ))
         raise UnhandledError()
 
-def delete_filestore(filestore_id):
+def delete_upload_session(session_id):
     """
-    deletes a filestore from the database, used for cleanup from errors
+    removes an upload session and its received ranges
     """
     try:
-        delete_query = "DELETE FROM filestore WHERE id = ?"
-
-        query_db(
-            query = delete_query,
-            args = [ filestore_id ]
-            )
-        return True
+        with transaction() as db:
+            db.execute("DELETE FROM upload_ranges WHERE session_id = ?", [ session_id ])
+            db.execute("DELETE FROM upload_sessions WHERE id = ?", [ session_id ])
     except Exception as err:
-        current_app.logger.error("could not delete filestore id {fi} from filestore : {e}".format(
-                                fi = filestore_id,
-                                e = err
-                                ))
+        current_app.logger.error("Unhandled Error in delete_upload_session id={i} : {e}".format(
+                    i=session_id,
+                    e=err
+                    ))
         raise UnhandledError()
 
-def lookup_tag_id(package_id, tag):
+def list_expired_upload_sessions(now):
     """
-    looks up the tag_id of a package and file location
+    lists the ids of upload sessions that expired before now, sessions being committed,
+    aborted or written to are left alone
     """
     try:
-        search_query = "SELECT id FROM tags WHERE package_id = ? AND tag = ?"
+        expired = query_db(
+                query="SELECT id FROM upload_sessions WHERE expires <= ? AND state = 'open' AND writers = 0",
+                args=[ now ]
+                )
+        return [ session['id'] for session in expired ] if expired is not None else []
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in list_expired_upload_sessions : {e}".format(e=err))
+        raise UnhandledError()
 
-        tag_id = query_db(
-                    query=search_query,
-                    args = [ package_id, tag ],
-                    one=True
-                    )
-        return tag_id['id'] if tag_id is not None else None
+def lookup_password(user):
+    """
+    Lookup a users password
+    """
+    return lookup_credentials(user)['password']
+
+
+
+def search_all_packages(cursor=None, limit=None):
+    """
+    returns a list of all packages currently being stored, ordered by id.
+    cursor/limit select a keyset page, the packages with an id greater than cursor
+    """
+    try:
+        all_packages_query = "SELECT title, id FROM packages WHERE id > ? ORDER BY id LIMIT ?"
+        packages = query_db(
+                query=all_packages_query,
+                args=[ cursor or 0, limit if limit is not None else -1 ],
+                readonly=True
+                )
+        if None == packages:
+            packages = []
+        return packages
     except Exception as err:
-        current_app.logger.error("Unhandled Error lookup_tag_id package_id={pi} tag={t} : {e} {et}".format(
-                        pi=package_id,
-                        t=tag,
-                        e=err,
-                        et=type(err)
-                        ))
+        current_app.logger.error("Unhandled Error in search_all_packages : {e}".format(
+                    e=err
+                    ))
         raise UnhandledError()
 
-def store_tag(package_id, filestore_id, tag):
+def iter_all_packages(cursor=None, limit=None, batch_size=500):
+    """
+    generator over all packages, fetched batch_size at a time
+    """
+    return iter_pages(search_all_packages, cursor=cursor, limit=limit, batch_size=batch_size)
+
+def search_packages(search_term, limit=None):
     """
-    This is used to store a new tag in the tag table
+    Allows users to search for specific text within a package name.  Uses the trigram
+    full text index when it is available, best matches first
     """
     try:
-        add_tag_id = insert_db(
-                    table='tags',
-                    fields = [ 'tag', 'package_id', 'filestore_id' ],
-                    values = [ tag, package_id, filestore_id ]
-                    )
-        return add_tag_id
-    except sqlite3.IntegrityError as err:
-        current_app.logger.error("Tag and package_id are not unique. package_id={pi} filestore_id={fi} tag={t}: {e}".format(
-                            pi=package_id,
-                            fi=filestore_id,
-                            t=tag,
-                            e=err
-                            ))
-        raise IntegrityError(message='Tag is not unique to package')
+        if use_fts(search_term):
+            search_query = SEARCH_PACKAGES_FTS_QUERY
+            search_args = [ fts_phrase(search_term) ]
+        else:
+            search_query = "SELECT title, id FROM packages WHERE title LIKE ? LIMIT ?"
+            search_args = [ "%{st}%".format(st=search_term) ]
+        packages = query_db(
+                query=search_query,
+                args=search_args + [ limit if limit is not None else -1 ],
+                readonly=True
+                )
+        if None == packages:
+            packages = []
+        return packages
     except Exception as err:
-        current_app.logger.error("Unhandled Error in store_tag_id package_id={pi} filestore_id={fi} tag={t} : {e}".format(
-                            pi=package_id,
-                            fi=filestore_id,
-                            t=tag,
-                            e=err
-                            ))
+        current_app.logger.error("Unhandled Error in search_packages {st} : {e}".format(
+                    st=search_term,
+                    e=err
+                    ))
         raise UnhandledError()
 
-def cleanup_add(package_id, filestore_id):
+def lookup_package_id(package_name):
     """
-    cleanup for insertion attempts that fail at a later stage
+    looks up the package id for the given package name, if exists.  Names the package
+    filter or the negative cache already know are missing return None without looking
+    the package up
     """
-    if None != package_id:
-        delete_package(package_id=package_id)
-    if None != filestore_id:
-        delete_filestore(filestore_id=filestore_id)
-    return None
+    try:
+        if not package_may_exist(package_name):
+            return None
+        if cached_miss(('package', package_name)):
+            return None
+        generation = miss_generation()
 
-def store_package_rows(package_name, user, filepath, tag):
-    """ 
-    The complete storing of an entire package
+        search_query = "SELECT id FROM packages WHERE title = ?"
+    
+        package_id = query_db(
+                query=search_query,
+                args = [ package_name ],
+                one=True,
+                readonly=True
+                )
+
+        if package_id is None:
+            remember_miss(('package', package_name), generation)
+            return None
+        return package_id['id']
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in lookup_package_id {pn} : {e}".format(
+                    pn = package_name,
+                    e=err
+                    ))
+
+        raise UnhandledError()
+ 
+def insert_returning_id(db, table, fields=(), values=()):
     """
+    Inserts a row inside the caller's transaction and returns its id
+    """
+    query = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        table,
+        ', '.join(fields),
+        ', '.join(['?'] * len(values))
+        )
+    if SQLITE_HAS_RETURNING:
+        return db.execute(query + ' RETURNING id', values).fetchall()[0]['id']
+    return db.execute(query, values).lastrowid
 
-    # this is used to detect if the package already existed before this
-    # attempt.  aids in cleanup
-    curr_package_id = lookup_package_id(
-                        package_name=package_name
-                        )
-   
-    package_id = curr_package_id
+def write_package_rows(db, package_name, user, filename, digest, size, blob_path, tmp_path, tag, volume=None, mtime=None, content_type=None,
+        published=None):
+    """
+    Writes the package, filestore and tag rows of a publish on db.  The caller owns
+    the transaction, this must run with the write lock already held so nothing can
+    insert the same package or blob between the lookup and the insert.  Files are
+    stored once per digest, the filestore refcount counts the tags pointing at it.
+    Once the rows are written the upload at tmp_path is moved to blob_path, also
+    under the write lock, so a blob is never removed while it is being published.
+    volume is the storage volume blob_path is on.  A new filestore row also records
+    the file's mtime, content type and upload time, so downloads need not stat it.
+    Files are shared between tags uploaded under different names, so the tag records
+    the content type of its own filename too.
+    A blob this linked into place is appended to published, for the caller to take
+    back if the transaction does not commit after all
+    """
+    package_id = db.execute(
+                    "SELECT id FROM packages WHERE title = ?",
+                    [ package_name ]
+                    ).fetchone()
     if None == package_id:
-        package_id = store_package_name(
-                        package_name=package_name,
-                        user=user
-                        )
+        package_id = insert_returning_id(
+                    db,
+                    table='packages',
+                    fields=[ 'title', 'user_id' ],
+                    values=[ package_name, user ]
+                    )
+    else:
+        package_id = package_id['id']
+        if db.execute(
+                "SELECT 1 FROM tags WHERE package_id = ? AND filename = ?",
+                [ package_id, filename ]
+                ).fetchone() is not None:
+            raise IntegrityError(message='filename exists for package')
 
-    curr_filestore_id = lookup_filestore_id_by_path(
-                        filepath=filepath
-                        )
-    filestore_id = curr_filestore_id
+    filestore_id = db.execute(
+                    "SELECT id, package_filepath FROM filestore WHERE digest = ?",
+                    [ digest ]
+                    ).fetchone()
     if None == filestore_id:
-        try:
-            filestore_id = store_filestore(
-                        filepath=filepath
-                        )
-        except Exception as err:
-            current_app.logger.error("Exception in store_filestore")
-            
-            cleanup_add(
-                package_id = package_id if (curr_package_id == None) else None,
-                filestore_id = None
-                )
-            raise UnhandledError()
-    
-    tag_id = lookup_tag_id(
-                package_id=package_id,
-                tag=tag
-                )
-    if None != tag_id:
-        # this means the tag already exists for adding this package
-        cleanup_add(
-            package_id = package_id if (curr_package_id == None) else None,
-            filestore_id = filestore_id if (curr_filestore_id == None) else None
-            )
-        raise IntegrityError(message='tag is already in use for package')
+        filestore_id = insert_returning_id(
+                    db,
+                    table='filestore',
+                    fields=[ 'package_filepath', 'digest', 'size', 'refcount', 'volume', 'mtime', 'content_type', 'uploaded' ],
+                    values=[ blob_path, digest, size, 0, volume, mtime, content_type, int(time.time()) ]
+                    )
+    else:
+        # a blob stored under an older fan-out stays where it is until it is resharded
+        blob_path = filestore_id['package_filepath']
+        filestore_id = filestore_id['id']
 
-    # store the tag in the database
     try:
-        tag_id = store_tag(
-                package_id=package_id,
-                filestore_id=filestore_id,
-                tag=tag
+        tag_id = insert_returning_id(
+                    db,
+                    table='tags',
+                    fields=[ 'tag', 'package_id', 'filestore_id', 'filename', 'content_type' ],
+                    values=[ tag, package_id, filestore_id, filename, content_type ]
+                    )
+    except sqlite3.IntegrityError:
+        # this means the tag already exists for adding this package,
+        # rolling back removes the package and filestore rows again
+        raise IntegrityError(message='tag is already in use for package')
+
+    db.execute("UPDATE filestore SET refcount = refcount + 1 WHERE id = ?", [ filestore_id ])
+    if publish_blob(tmp_path, blob_path) and published is not None:
+        published.append((blob_path, tmp_path))
+
+    return { 
+            'package_id' : package_id,
+            'tag_id' : tag_id,
+            'digest' : digest
+            }
+
+def unpublish_rolled_back(published):
+    """
+    moves blobs published by a transaction that was rolled back out of the blob store again,
+    unless a publish of the same content has committed a row for them since
+    """
+    for blob_path, tmp_path in published:
+        try:
+            dispose_unreferenced(blob_path, blob_path, lambda path: unpublish_blob(path, tmp_path))
+        except UnhandledError:
+            pass
+
+def store_package_rows(package_name, user, filename, digest, size, blob_path, tmp_path, tag, volume=None, mtime=None, content_type=None):
+    """ 
+    The complete storing of an entire package.  All rows are written in one
+    transaction, so a failure part way through leaves nothing behind.  With
+    GROUP_COMMIT on, the rows are handed to the group commit writer and share
+    a commit with other concurrent publishes.  A blob published by rows that
+    were rolled back is moved back to tmp_path
+    """
+    published = []
+    publish = dict(
+                package_name=package_name,
+                user=user,
+                filename=filename,
+                digest=digest,
+                size=size,
+                blob_path=blob_path,
+                tmp_path=tmp_path,
+                tag=tag,
+                volume=volume,
+                mtime=mtime,
+                content_type=content_type,
+                published=published
                 )
+    try:
+        if current_app.config['GROUP_COMMIT']:
+            rows = get_group_committer().submit(write_package_rows, **publish)
+        else:
+            with transaction() as db:
+                rows = write_package_rows(db, **publish)
+        invalidate_filepath_cache(lambda key, value: key == (package_name, tag))
+        remember_package(package_name)
+        return rows
     except IntegrityError as err:
-        cleanup_add(
-            package_id = package_id if (curr_package_id == None) else None,
-            filestore_id = filestore_id if (curr_filestore_id == None) else None
-            )
         raise err
     except Exception as err:
-        current_app.logger.error("Exception in store_tag")
-        cleanup_add(
-            package_id = package_id if (curr_package_id == None) else None,
-            filestore_id = filestore_id if (curr_filestore_id == None) else None
-            )
+        # a write that timed out may still be committed by the group commit writer
+        if not isinstance(err, GroupCommitTimeout):
+            unpublish_rolled_back(published)
+        current_app.logger.error("Unhandled Error in store_package_rows package_name={pn} user={u} digest={d} tag={t} : {e}".format(
+                            pn=package_name,
+                            u=user,
+                            d=digest,
+                            t=tag,
+                            e=err
+                            ))
         raise UnhandledError()
-    return { 
-            'package_id' : package_id,
-            'tag_id' : tag_id
-            }
 
 
-def search_all_tags_by_id(package_id):
+def search_all_tags_by_id(package_id, cursor=None, limit=None, details=False):
     """
-    returns a list of all tags for a specific package
+    returns a list of all tags for a specific package, ordered by id.
+    cursor/limit select a keyset page, the tags with an id greater than cursor.
+    details adds what was recorded about each tag's file when it was stored
     """
+    columns, join = tag_columns(details)
     try:
-        all_tags_query = "SELECT tag, id FROM tags WHERE package_id = ?"
+        all_tags_query = "SELECT tags.tag AS tag, tags.id AS id{c} FROM tags{j} WHERE tags.package_id = ? AND tags.id > ? ORDER BY tags.id LIMIT ?".format(c=columns, j=join)
         tags = query_db(
                 query=all_tags_query,
-                args = [ package_id ]
+                args = [ package_id, cursor or 0, limit if limit is not None else -1 ],
+                readonly=True
                 )
         if None == tags:
             tags = []
@@ -441,18 +828,23 @@ def search_all_tags_by_id(package_id):
                     ))
         raise UnhandledError()
 
-
-
-def search_tags_by_id_and_term(package_id, tag_search_term):
+def search_tags_by_id_and_term(package_id, tag_search_term, limit=None, details=False):
     """
-    Allows users to search for specific text within a packages' tag
+    Allows users to search for specific text within a packages' tag.  Uses the trigram
+    full text index when it is available, best matches first
     """
+    columns, join = tag_columns(details)
     try:
-        search_query = "SELECT tag, id FROM tags WHERE package_id = ? AND tag LIKE ?"
-        search_term = "%{tst}%".format(tst=tag_search_term)
+        if use_fts(tag_search_term):
+            search_query = SEARCH_TAGS_FTS_QUERY.format(c=columns, j=join)
+            search_args = [ fts_phrase(tag_search_term), package_id ]
+        else:
+            search_query = "SELECT tags.tag AS tag, tags.id AS id{c} FROM tags{j} WHERE tags.package_id = ? AND tags.tag LIKE ? LIMIT ?".format(c=columns, j=join)
+            search_args = [ package_id, "%{tst}%".format(tst=tag_search_term) ]
         tags = query_db(
                 query=search_query,
-                args=[ package_id, search_term ]
+                args=search_args + [ limit if limit is not None else -1 ],
+                readonly=True
                 )
         if None == tags:
             tags = []
@@ -466,7 +858,7 @@ def search_tags_by_id_and_term(package_id, tag_search_term):
                     ))
         raise UnhandledError()
 
-def search_all_tags(package_name):
+def search_all_tags(package_name, cursor=None, limit=None, details=False):
     """
     looks up a package and return all of its tags that are available
     """
@@ -476,9 +868,29 @@ def search_all_tags(package_name):
     if package_id == None:
         raise NotFoundError(message='could not locate package')
 
-    return search_all_tags_by_id(package_id=package_id)
+    return search_all_tags_by_id(package_id=package_id, cursor=cursor, limit=limit, details=details)
+
+def iter_all_tags(package_name, cursor=None, limit=None, batch_size=500, details=False):
+    """
+    looks up a package and returns a generator over all of its tags.  The package is
+    looked up straight away so a missing package raises before anything is streamed
+    """
+    package_id = lookup_package_id(
+                        package_name=package_name
+                        )
+    if package_id == None:
+        raise NotFoundError(message='could not locate package')
+
+    return iter_pages(
+                search_all_tags_by_id,
+                cursor=cursor,
+                limit=limit,
+                batch_size=batch_size,
+                package_id=package_id,
+                details=details
+                )
 
-def search_tags(package_name, tag_search):
+def search_tags(package_name, tag_search, limit=None, details=False):
     """
     looks up a package and searches its tag for specific parameters
     """
@@ -491,72 +903,375 @@ def search_tags(package_name, tag_search):
 
     return search_tags_by_id_and_term(
                 package_id = package_id,
-                tag_search_term=tag_search
+                tag_search_term=tag_search,
+                limit=limit,
+                details=details
                 )
 
-def lookup_filestore_id_from_tag(package_id, tag):
+def lookup_filepath_row(package_name, tag):
     """
-    makes the database search for the filestore_id of a file referenced by package_id and tag
+    looks up the package id, filestore id and file path for a given package name and tag.
+    This resolves the package, tag and filestore in a single query, the left joins leave
+    the columns of whatever could not be found NULL so each failure still gets its own message.
+    Unknown packages are turned away by the package filter, and recent misses are answered
+    from the negative cache, without the join
     """
+    if not package_may_exist(package_name):
+        raise NotFoundError(message='could not locate package')
+
     try:
-        search_query = "SELECT filestore_id FROM tags WHERE package_id = ? AND tag = ?"
-        filestore_id = query_db(
-                query=search_query,
-                args=[ package_id, tag ],
-                one=True
+        missing = cached_miss(('filepath', package_name, tag))
+        if missing is not None:
+            raise NotFoundError(message=missing)
+        generation = miss_generation()
+        filepath = query_db(
+                query=LOOKUP_FILEPATH_QUERY,
+                args=[ tag, package_name ],
+                one=True,
+                readonly=True
                 )
-        return filestore_id['filestore_id'] if filestore_id is not None else None
+    except NotFoundError:
+        raise
     except Exception as err:
-        current_app.logger.error("Unhandled Error in lookup_filestore_id_from_tag: package_id {pi}, tag {t} : {e}".format(
-                    pi=package_id,
-                    t=tag,
-                    e=err
-                    ))
+        current_app.logger.error("Unhandled Error in lookup_filepath: package_name {pn}, tag {t} : {e}".format(
+                pn=package_name,
+                t=tag,
+                e=err
+                ))
         raise UnhandledError()
-  
-def lookup_filepath_from_id(filestore_id):
+
+    missing = None
+    if filepath == None:
+        missing = 'could not locate package'
+    elif filepath['filestore_id'] == None:
+        missing = 'could not locate tag for package'
+    if missing is not None:
+        remember_miss(('filepath', package_name, tag), generation, missing)
+        raise NotFoundError(message=missing)
+
+    if filepath['package_filepath'] == None:
+        raise NotFoundError(message='could not locate file for package')
+
+    return filepath
+
+# the filestore column holding the size of each encoding's variant, NULL when there is none
+VARIANT_COLUMNS = {
+    'gzip' : 'gzip_size',
+    'zstd' : 'zstd_size'
+    }
+
+def row_variants(row):
     """
-    returns the filepath for a specified filestore_id
+    the precompressed variants of a filestore row, encoding -> size
     """
+    return dict(
+            (encoding, row[column])
+            for encoding, column in VARIANT_COLUMNS.iteritems()
+            if row[column] is not None
+            )
 
+def list_uncompressed(after_id=0, digest=None, limit=100):
+    """
+    lists stored files the compression stage has not looked at yet, in id order after after_id,
+    or only the file of digest
+    """
+    query = "SELECT id, package_filepath, size, volume FROM filestore WHERE compressed = 0 AND refcount > 0 AND digest IS NOT NULL AND id > ?"
+    args = [ after_id ]
+    if digest is not None:
+        query += " AND digest = ?"
+        args.append(digest)
     try:
-        search_query = "SELECT package_filepath FROM filestore WHERE id = ?"
-        filepath = query_db(
-                query = search_query,
-                args = [ filestore_id ],
-                one=True
+        rows = query_db(
+                query=query + " ORDER BY id LIMIT ?",
+                args=args + [ limit ],
+                readonly=True
                 )
-        return filepath['package_filepath'] if filepath is not None else None
+        return rows if rows is not None else []
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in list_uncompressed after_id={a} : {e}".format(
+                a=after_id,
+                e=err
+                ))
+        raise UnhandledError()
+
+def store_variants(filestore_id, package_filepath, variants):
+    """
+    records the compression stage of a stored file, variants maps an encoding to the
+    (temporary path, size) of a variant worth keeping.  The variants are moved into place
+    under the write lock, and only if the file was not deleted in the meantime.  Returns
+    False if it was, the variants are removed then
+    """
+    try:
+        variants = variants.items()
+        assignments = [ "compressed = 1" ] + [ "{c} = ?".format(c=VARIANT_COLUMNS[encoding]) for encoding, variant in variants ]
+        with transaction() as db:
+            stored = db.execute(
+                    "UPDATE filestore SET {a} WHERE id = ? AND package_filepath = ?".format(a=', '.join(assignments)),
+                    [ size for encoding, (tmp_path, size) in variants ] + [ filestore_id, package_filepath ]
+                    ).rowcount > 0
+            for encoding, (tmp_path, size) in variants:
+                if stored:
+                    publish_blob(tmp_path, variant_path(package_filepath, encoding))
+                else:
+                    remove_blob(tmp_path)
+        if stored:
+            invalidate_filepath_cache(lambda key, value: value['filestore_id'] == filestore_id)
+        return stored
     except Exception as err:
-        current_app.logger.error("Unhandled Error in lookup_filepath: filestore_id {fi} : {e}".format(
+        current_app.logger.error("Unhandled Error in store_variants filestore_id={fi} : {e}".format(
                 fi=filestore_id,
                 e=err
                 ))
         raise UnhandledError()
 
-def lookup_filepath(package_name, tag):
+def list_blobs(after_id=0, limit=100, volumes=None):
     """
-    looks up a file path with a given package name and tag
+    lists stored blobs in id order after after_id, only those on the named volumes when
+    volumes is given.  Files stored before the blob store have no digest and are left to
+    migrate_to_blobs
     """
-    package_id = lookup_package_id(
-                        package_name=package_name
-                        )
-    if package_id == None:
-        raise NotFoundError(message='could not locate package')
+    query = "SELECT id, package_filepath, digest, volume FROM filestore WHERE digest IS NOT NULL AND id > ?"
+    args = [ after_id ]
+    if volumes is not None:
+        query += " AND COALESCE(volume, ?) IN ({p})".format(p=', '.join('?' * len(volumes)))
+        args += [ DEFAULT_VOLUME ] + list(volumes)
+    try:
+        rows = query_db(
+                query=query + " ORDER BY id LIMIT ?",
+                args=args + [ limit ],
+                readonly=True
+                )
+        return rows if rows is not None else []
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in list_blobs after_id={a} : {e}".format(
+                a=after_id,
+                e=err
+                ))
+        raise UnhandledError()
+
+def relocate_blob(filestore_id, package_filepath, new_path, volume, links):
+    """
+    points a filestore row at new_path on volume, linking each (source, target) of links
+    into place under the write lock, the blob and its variants or copies of them staged on
+    the new volume.  The old files are left in place for downloads that already resolved
+    them, the caller removes them.  Returns False if the row was deleted or moved meanwhile
+    """
+    try:
+        with transaction() as db:
+            moved = db.execute(
+                    "UPDATE filestore SET package_filepath = ?, volume = ? WHERE id = ? AND package_filepath = ?",
+                    [ new_path, volume, filestore_id, package_filepath ]
+                    ).rowcount > 0
+            if moved:
+                for source, target in links:
+                    link_blob(source, target)
+        if moved:
+            invalidate_filepath_cache(lambda key, value: value['filestore_id'] == filestore_id)
+        return moved
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in relocate_blob filestore_id={fi} : {e}".format(
+                fi=filestore_id,
+                e=err
+                ))
+        raise UnhandledError()
+
+def list_scrub_rows(after_id=0, limit=500):
+    """
+    lists filestore rows in id order after after_id for the scrubber, with the number
+    of tags pointing at each
+    """
+    try:
+        rows = query_db(
+                query="""
+                    SELECT id, package_filepath, digest, size, refcount, volume, gzip_size, zstd_size,
+                           (SELECT COUNT(*) FROM tags WHERE tags.filestore_id = filestore.id) AS tags
+                    FROM filestore WHERE id > ? ORDER BY id LIMIT ?
+                    """,
+                args=[ after_id, limit ],
+                readonly=True
+                )
+        return rows if rows is not None else []
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in list_scrub_rows after_id={a} : {e}".format(
+                a=after_id,
+                e=err
+                ))
+        raise UnhandledError()
+
+def list_scrub_tags(after_id=0, limit=500):
+    """
+    lists tags in id order after after_id for the scrubber, flagging the ones whose
+    package or filestore row no longer exists
+    """
+    try:
+        rows = query_db(
+                query="""
+                    SELECT batch.id AS id, batch.tag AS tag, batch.package_id AS package_id,
+                           batch.filestore_id AS filestore_id,
+                           packages.id IS NOT NULL AS has_package, filestore.id IS NOT NULL AS has_filestore
+                    FROM (SELECT id, tag, package_id, filestore_id FROM tags WHERE id > ? ORDER BY id LIMIT ?) AS batch
+                    LEFT JOIN packages ON packages.id = batch.package_id
+                    LEFT JOIN filestore ON filestore.id = batch.filestore_id
+                    ORDER BY batch.id
+                    """,
+                args=[ after_id, limit ],
+                readonly=True
+                )
+        return rows if rows is not None else []
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in list_scrub_tags after_id={a} : {e}".format(
+                a=after_id,
+                e=err
+                ))
+        raise UnhandledError()
 
-    filestore_id = lookup_filestore_id_from_tag(
-                                package_id=package_id,
-                                tag=tag
-                                )
+def lookup_stored_paths(paths):
+    """
+    which of paths a filestore row points at
+    """
+    try:
+        rows = query_db(
+                query="SELECT package_filepath FROM filestore WHERE package_filepath IN ({p})".format(p=', '.join('?' * len(paths))),
+                args=list(paths),
+                readonly=True
+                ) or []
+        return set(row['package_filepath'] for row in rows)
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in lookup_stored_paths : {e}".format(e=err))
+        raise UnhandledError()
 
-    if filestore_id == None:
-        raise NotFoundError(message='could not locate tag for package')
+def dispose_unreferenced(path, package_filepath, dispose):
+    """
+    calls dispose(path) under the write lock if no filestore row points at package_filepath,
+    publishes link blobs in under the same lock so this can not race with one.  Returns
+    whether it was disposed of
+    """
+    try:
+        with transaction() as db:
+            if db.execute("SELECT 1 FROM filestore WHERE package_filepath = ?", [ package_filepath ]).fetchone() is not None:
+                return False
+            dispose(path)
+            return True
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in dispose_unreferenced path={p} : {e}".format(
+                p=path,
+                e=err
+                ))
+        raise UnhandledError()
 
-    filepath = lookup_filepath_from_id(
-                    filestore_id=filestore_id
+def dispose_stored(filestore_id, package_filepath, dispose):
+    """
+    calls dispose(package_filepath) under the write lock while the row still points at it
+    """
+    try:
+        with transaction() as db:
+            if db.execute(
+                    "SELECT 1 FROM filestore WHERE id = ? AND package_filepath = ?",
+                    [ filestore_id, package_filepath ]
+                    ).fetchone() is None:
+                return False
+            dispose(package_filepath)
+        invalidate_filepath_cache(lambda key, value: value['filestore_id'] == filestore_id)
+        return True
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in dispose_stored filestore_id={fi} : {e}".format(
+                fi=filestore_id,
+                e=err
+                ))
+        raise UnhandledError()
+
+def clear_variants(filestore_id, encodings):
+    """
+    forgets variants of a stored file that are gone, so the compression stage makes them again
+    """
+    assignments = [ "compressed = 0" ] + [ "{c} = NULL".format(c=VARIANT_COLUMNS[encoding]) for encoding in encodings ]
+    try:
+        with transaction() as db:
+            db.execute("UPDATE filestore SET {a} WHERE id = ?".format(a=', '.join(assignments)), [ filestore_id ])
+        invalidate_filepath_cache(lambda key, value: value['filestore_id'] == filestore_id)
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in clear_variants filestore_id={fi} : {e}".format(
+                fi=filestore_id,
+                e=err
+                ))
+        raise UnhandledError()
+
+def recount_refs(filestore_id):
+    """
+    sets a filestore row's refcount to the number of tags pointing at it
+    """
+    try:
+        with transaction() as db:
+            db.execute(
+                    "UPDATE filestore SET refcount = (SELECT COUNT(*) FROM tags WHERE filestore_id = ?) WHERE id = ?",
+                    [ filestore_id, filestore_id ]
                     )
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in recount_refs filestore_id={fi} : {e}".format(
+                fi=filestore_id,
+                e=err
+                ))
+        raise UnhandledError()
 
-    if filepath == None:
-        raise NotFoundError(message='could not locate file for package')
+def delete_dangling_tag(tag_id):
+    """
+    deletes a tag whose package or file is gone, releasing its reference on the file if
+    there still is one.  Returns False if the tag was already gone
+    """
+    try:
+        with transaction() as db:
+            tag = db.execute("SELECT filestore_id FROM tags WHERE id = ?", [ tag_id ]).fetchone()
+            if tag is None:
+                return False
+            db.execute("DELETE FROM tags WHERE id = ?", [ tag_id ])
+            db.execute("UPDATE filestore SET refcount = refcount - 1 WHERE id = ? AND refcount > 0", [ tag['filestore_id'] ])
+        invalidate_filepath_cache(lambda key, value: value['filestore_id'] == tag['filestore_id'])
+        return True
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in delete_dangling_tag tag_id={t} : {e}".format(
+                t=tag_id,
+                e=err
+                ))
+        raise UnhandledError()
 
-    return filepath
+def volume_usage():
+    """
+    the number of files and bytes stored on each volume, name -> (files, bytes)
+    """
+    try:
+        rows = query_db(
+                query="SELECT COALESCE(volume, ?) AS volume, COUNT(*) AS files, COALESCE(SUM(size), 0) AS stored FROM filestore WHERE refcount > 0 GROUP BY 1",
+                args=[ DEFAULT_VOLUME ],
+                readonly=True
+                ) or []
+        return dict((row['volume'], (row['files'], row['stored'])) for row in rows)
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in volume_usage : {e}".format(e=err))
+        raise UnhandledError()
+
+def lookup_blob(digest):
+    """
+    looks up the stored file of a blob by its digest, None if it is not stored
+    """
+    try:
+        return query_db(
+                query="SELECT package_filepath, digest, size, gzip_size, zstd_size, volume, mtime, content_type FROM filestore WHERE digest = ? AND refcount > 0",
+                args=[ digest ],
+                one=True,
+                readonly=True
+                )
+    except Exception as err:
+        current_app.logger.error("Unhandled Error in lookup_blob: digest {d} : {e}".format(
+                d=digest,
+                e=err
+                ))
+        raise UnhandledError()
+
+def lookup_filepath(package_name, tag):
+    """
+    looks up a file path with a given package name and tag
+    """
+    return lookup_filepath_row(
+                package_name=package_name,
+                tag=tag
+                )['package_filepath']
@@ -0,0 +1,235 @@
+import os
+import time
+import hmac
+import base64
+import hashlib
+import threading
+import Queue
+
+from flask import current_app
+
+from metrics import Histogram
+
+HASH_ALGORITHM = 'pbkdf2_sha256'
+SALT_BYTES = 16
+
+WAIT_MS_BOUNDS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000]
+
+class HasherBusyError(Exception):
+    """
+    raised when the hashing queue is full, the caller should be told to retry later
+    """
+    pass
+
+def hash_password(password, iterations, salt=None):
+    """
+    returns the stored form of password, pbkdf2_sha256$<iterations>$<salt>$<hash>
+    """
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    salt = salt or os.urandom(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    return '$'.join([
+        HASH_ALGORITHM,
+        str(iterations),
+        base64.b64encode(salt),
+        base64.b64encode(digest)
+        ])
+
+def check_password(password, stored, iterations):
+    """
+    checks password against its stored form.  Returns (matches, new_stored), new_stored
+    is the password hashed again when it matched but was stored with a different
+    iteration count, or in plaintext by an older version, otherwise None
+    """
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    if isinstance(stored, unicode):
+        stored = stored.encode('utf-8')
+    parts = stored.split('$')
+    if len(parts) != 4 or parts[0] != HASH_ALGORITHM:
+        # stored before passwords were hashed
+        matches = hmac.compare_digest(password, stored)
+        return matches, hash_password(password, iterations) if matches else None
+
+    stored_iterations = int(parts[1])
+    salt = base64.b64decode(parts[2])
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, stored_iterations)
+    matches = hmac.compare_digest(digest, base64.b64decode(parts[3]))
+    if matches and stored_iterations != iterations:
+        return True, hash_password(password, iterations)
+    return matches, None
+
+class _Job(object):
+    __slots__ = ('work', 'args', 'queued', 'result', 'error', 'done')
+
+    def __init__(self, work, args):
+        self.work = work
+        self.args = args
+        self.queued = time.time()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class PasswordHasher(object):
+    """
+    Runs password hashing on a fixed set of worker threads so a burst of logins
+    cannot tie up every request worker in the key derivation.  pbkdf2 releases the
+    GIL, so the workers hash in parallel.  At most queue_size jobs may wait, once
+    the queue is full submit raises HasherBusyError instead of queueing more
+    """
+    def __init__(self, workers=2, queue_size=16, iterations=100000, timeout=30):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.iterations = iterations
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self.wait_ms = Histogram(WAIT_MS_BOUNDS)
+        self._stats = {
+            'hashed' : 0,
+            'verified' : 0,
+            'rehashed' : 0,
+            'rejected' : 0
+            }
+
+    def start(self):
+        with self._start_lock:
+            self._start_threads()
+
+    def _start_threads(self):
+        self._threads = [ thread for thread in self._threads if thread.is_alive() ]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name='password-hasher')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop_event.set()
+        # wakes the workers, unless the queue is full and they are busy anyway
+        for thread in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full:
+                break
+
+    def wait_stopped(self, timeout=None):
+        """
+        waits up to timeout seconds for the workers to finish once stopped
+        """
+        for thread in list(self._threads):
+            thread.join(timeout)
+
+    def _submit(self, work, *args):
+        job = _Job(work, args)
+        with self._start_lock:
+            stopped = self._stop_event.is_set()
+            full = False
+            if not stopped:
+                self._start_threads()
+                try:
+                    self._queue.put_nowait(job)
+                except Queue.Full:
+                    full = True
+        if full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise HasherBusyError('password hashing queue is full')
+        if stopped:
+            # a caller still holding a hasher that was replaced when the settings changed
+            return work(*args)
+        if not job.done.wait(self.timeout):
+            raise HasherBusyError('password hashing did not finish after {t}s'.format(t=self.timeout))
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def hash(self, password):
+        result = self._submit(hash_password, password, self.iterations)
+        with self._lock:
+            self._stats['hashed'] += 1
+        return result
+
+    def verify(self, password, stored):
+        """
+        returns (matches, new_stored), see check_password
+        """
+        matches, new_stored = self._submit(check_password, password, stored, self.iterations)
+        with self._lock:
+            self._stats['verified'] += 1
+            if new_stored is not None:
+                self._stats['rehashed'] += 1
+        return matches, new_stored
+
+    def _run(self):
+        # bound locally, module globals are cleared while a daemon thread is still
+        # waiting at interpreter shutdown
+        empty = Queue.Empty
+        while not self._stop_event.is_set():
+            try:
+                job = self._queue.get(timeout=1)
+            except empty:
+                continue
+            if job is None:
+                continue
+            self._work(job)
+        # whatever was queued before the stop is still done, submits after it work inline
+        with self._start_lock:
+            jobs = []
+            while True:
+                try:
+                    job = self._queue.get_nowait()
+                except empty:
+                    break
+                if job is not None:
+                    jobs.append(job)
+            # the other workers still need waking
+            for _ in self._threads:
+                try:
+                    self._queue.put_nowait(None)
+                except Queue.Full:
+                    break
+        for job in jobs:
+            self._work(job)
+
+    def _work(self, job):
+        self.wait_ms.observe((time.time() - job.queued) * 1000.0)
+        try:
+            job.result = job.work(*job.args)
+        except Exception as err:
+            job.error = err
+        finally:
+            job.done.set()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['queue_size'] = self.queue_size
+        stats['workers'] = self.workers
+        stats['iterations'] = self.iterations
+        stats['wait_ms'] = self.wait_ms.get_stats()
+        return stats
+
+def get_password_hasher():
+    """
+    Returns the password hasher for the current configuration, creating it on first use
+    """
+    app = current_app._get_current_object()
+    config = app.config
+    settings = (config['PASSWORD_HASH_WORKERS'], config['PASSWORD_HASH_QUEUE_SIZE'],
+                config['PASSWORD_HASH_ITERATIONS'], config['PASSWORD_HASH_TIMEOUT'])
+    hasher = app.extensions.get('password_hasher')
+    if hasher is not None and (hasher.pid != os.getpid() or hasher.settings != settings):
+        hasher.stop()
+        hasher = None
+    if hasher is None:
+        hasher = PasswordHasher(*settings)
+        hasher.settings = settings
+        app.extensions['password_hasher'] = hasher
+    return hasher
@@ -0,0 +1,163 @@
+import os
+import math
+import time
+import threading
+
+from flask import current_app
+
+BUDGETS = ('upload_bytes', 'downloads', 'searches')
+
+class TokenBucket(object):
+    """
+    A token bucket holding at most burst tokens, refilled at rate tokens a second
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost, now):
+        """
+        takes cost tokens if there are enough and returns 0, otherwise takes nothing
+        and returns the seconds until there will be enough
+        """
+        self.refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+    def reset(self):
+        """
+        seconds until the bucket is full again
+        """
+        return (self.burst - self.tokens) / self.rate
+
+class RateLimit(object):
+    """
+    The outcome of one check against a user's budget, used for the RateLimit-* headers
+    """
+    __slots__ = ('limit', 'remaining', 'reset', 'retry_after')
+
+    def __init__(self, limit, remaining, reset, retry_after=0):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        self.retry_after = retry_after
+
+    def headers(self):
+        headers = {
+            'RateLimit-Limit' : str(int(self.limit)),
+            'RateLimit-Remaining' : str(int(self.remaining)),
+            'RateLimit-Reset' : str(int(math.ceil(self.reset)))
+            }
+        if self.retry_after:
+            headers['Retry-After'] = str(int(math.ceil(self.retry_after)))
+        return headers
+
+class RateLimiter(object):
+    """
+    Per user token buckets for each budget in BUDGETS, plus a cap on how many uploads
+    a user may have in progress at once.  limits maps a budget to (rate a second, burst),
+    user_limits maps a user id to its own limits, including 'max_concurrent_uploads',
+    overriding the defaults.  Limits only hold within one process
+    """
+    def __init__(self, limits, user_limits=None, max_concurrent_uploads=2, prune_interval=60):
+        self.limits = limits
+        self.user_limits = user_limits or {}
+        self.max_concurrent_uploads = max_concurrent_uploads
+        self.prune_interval = prune_interval
+        self.pid = os.getpid()
+        self._buckets = {}
+        self._uploads = {}
+        self._lock = threading.Lock()
+        self._next_prune = time.time() + prune_interval
+        self._stats = dict((budget, { 'allowed' : 0, 'limited' : 0 }) for budget in BUDGETS)
+        self._stats['concurrent_uploads'] = { 'allowed' : 0, 'limited' : 0 }
+
+    def _limit(self, user_id, name):
+        return self.user_limits.get(user_id, {}).get(name, self.limits.get(name))
+
+    def take(self, user_id, budget, cost=1):
+        """
+        charges cost to the user's budget.  Returns a RateLimit, its retry_after is
+        non zero when the budget could not cover the cost.  A cost bigger than the
+        burst is capped at the burst, so it waits for a full bucket rather than never
+        being allowed
+        """
+        rate, burst = self._limit(user_id, budget)
+        now = time.time()
+        with self._lock:
+            if now >= self._next_prune:
+                self._prune(now)
+            bucket = self._buckets.get((user_id, budget))
+            if bucket is None or bucket.rate != rate or bucket.burst != burst:
+                bucket = TokenBucket(rate, burst, now)
+                self._buckets[(user_id, budget)] = bucket
+            retry_after = bucket.take(min(cost, bucket.burst), now)
+            self._stats[budget]['limited' if retry_after else 'allowed'] += 1
+            return RateLimit(bucket.burst, bucket.tokens, bucket.reset(), retry_after)
+
+    def _prune(self, now):
+        # a full bucket is the same as no bucket, drop them so idle users cost nothing
+        for key, bucket in self._buckets.items():
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+        self._next_prune = now + self.prune_interval
+
+    def acquire_upload(self, user_id):
+        """
+        reserves one of the user's concurrent upload slots, False if they are all in use
+        """
+        cap = self._limit(user_id, 'max_concurrent_uploads') or self.max_concurrent_uploads
+        with self._lock:
+            in_progress = self._uploads.get(user_id, 0)
+            if in_progress >= cap:
+                self._stats['concurrent_uploads']['limited'] += 1
+                return False
+            self._uploads[user_id] = in_progress + 1
+            self._stats['concurrent_uploads']['allowed'] += 1
+            return True
+
+    def release_upload(self, user_id):
+        with self._lock:
+            in_progress = self._uploads.get(user_id, 0) - 1
+            if in_progress > 0:
+                self._uploads[user_id] = in_progress
+            else:
+                self._uploads.pop(user_id, None)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict((name, dict(counts)) for name, counts in self._stats.iteritems())
+            stats['buckets'] = len(self._buckets)
+            stats['uploads_in_progress'] = sum(self._uploads.itervalues())
+        return stats
+
+def get_rate_limiter():
+    """
+    Returns the rate limiter for the current configuration, or None when RATELIMIT_ENABLED is off
+    """
+    app = current_app._get_current_object()
+    config = app.config
+    if not config['RATELIMIT_ENABLED']:
+        return None
+    settings = (config['RATELIMIT_LIMITS'], config['RATELIMIT_USER_LIMITS'], config['RATELIMIT_MAX_CONCURRENT_UPLOADS'])
+    limiter = app.extensions.get('rate_limiter')
+    if limiter is None or limiter.pid != os.getpid() or limiter.settings != settings:
+        limiter = RateLimiter(
+                limits=config['RATELIMIT_LIMITS'],
+                user_limits=config['RATELIMIT_USER_LIMITS'],
+                max_concurrent_uploads=config['RATELIMIT_MAX_CONCURRENT_UPLOADS']
+                )
+        limiter.settings = settings
+        app.extensions['rate_limiter'] = limiter
+    return limiter
@@ -6,5 +6,7 @@ UNAUTHORIZED = 401
 FORBIDDEN = 403
 NOT_FOUND = 404
 CONFLICT = 409
+TOO_MANY_REQUESTS = 429
 INTERNAL_SERVER_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 
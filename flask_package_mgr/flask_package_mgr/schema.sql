@@ -2,6 +2,9 @@ drop table if exists users;
 drop table if exists packages;
 drop table if exists filestore;
 drop table if exists tags;
+drop table if exists apikeys;
+drop table if exists upload_sessions;
+drop table if exists upload_ranges;
 
 create table users (
     id          integer primary key autoincrement,
@@ -22,6 +25,16 @@ create table packages (
 create table filestore (
     id          integer primary key autoincrement,
     package_filepath varchar(255),
+    digest      varchar(64),
+    size        integer,
+    refcount    integer default 0,
+    gzip_size   integer,
+    zstd_size   integer,
+    compressed  integer default 0,
+    volume      varchar(64),
+    mtime       integer,
+    content_type varchar(255),
+    uploaded    integer,
     CONSTRAINT unique_loc UNIQUE(package_filepath)
     );
 
@@ -30,6 +43,8 @@ create table tags (
     tag             varchar(255),
     package_id      integer,
     filestore_id    integer,
+    filename        varchar(255),
+    content_type    varchar(255),
     FOREIGN KEY(package_id)     REFERENCES packages(id),
     FOREIGN KEY(filestore_id)   REFERENCES filestore(id),
     CONSTRAINT unique_tags UNIQUE (tag, package_id)
@@ -0,0 +1,45 @@
+drop table if exists packages_fts;
+drop table if exists tags_fts;
+
+create virtual table packages_fts using fts5(
+    title,
+    content='packages',
+    content_rowid='id',
+    tokenize='trigram'
+    );
+
+create virtual table tags_fts using fts5(
+    tag,
+    content='tags',
+    content_rowid='id',
+    tokenize='trigram'
+    );
+
+create trigger if not exists packages_fts_insert after insert on packages begin
+    insert into packages_fts(rowid, title) values (new.id, new.title);
+end;
+
+create trigger if not exists packages_fts_delete after delete on packages begin
+    insert into packages_fts(packages_fts, rowid, title) values ('delete', old.id, old.title);
+end;
+
+create trigger if not exists packages_fts_update after update of title on packages begin
+    insert into packages_fts(packages_fts, rowid, title) values ('delete', old.id, old.title);
+    insert into packages_fts(rowid, title) values (new.id, new.title);
+end;
+
+create trigger if not exists tags_fts_insert after insert on tags begin
+    insert into tags_fts(rowid, tag) values (new.id, new.tag);
+end;
+
+create trigger if not exists tags_fts_delete after delete on tags begin
+    insert into tags_fts(tags_fts, rowid, tag) values ('delete', old.id, old.tag);
+end;
+
+create trigger if not exists tags_fts_update after update of tag on tags begin
+    insert into tags_fts(tags_fts, rowid, tag) values ('delete', old.id, old.tag);
+    insert into tags_fts(rowid, tag) values (new.id, new.tag);
+end;
+
+insert into packages_fts(packages_fts) values ('rebuild');
+insert into tags_fts(tags_fts) values ('rebuild');
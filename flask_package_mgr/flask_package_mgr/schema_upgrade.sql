@@ -0,0 +1,43 @@
+create index if not exists tags_package_id on tags (package_id);
+create index if not exists tags_filestore_id on tags (filestore_id);
+create unique index if not exists tags_package_filename on tags (package_id, filename);
+create unique index if not exists filestore_digest on filestore (digest);
+create index if not exists filestore_volume on filestore (volume);
+
+create table if not exists apikeys (
+    id          integer primary key autoincrement,
+    user_id     integer,
+    name        varchar(255),
+    prefix      varchar(16),
+    key_hash    varchar(64),
+    created     integer,
+    FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+
+create unique index if not exists apikeys_prefix on apikeys (prefix);
+create index if not exists apikeys_user_id on apikeys (user_id);
+
+create table if not exists upload_sessions (
+    id          varchar(32) primary key,
+    user_id     integer,
+    package_name varchar(255),
+    tag         varchar(255),
+    filename    varchar(255),
+    size        integer,
+    digest      varchar(64),
+    state       varchar(16) default 'open',
+    writers     integer default 0,
+    expires     integer,
+    FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+
+create index if not exists upload_sessions_expires on upload_sessions (expires);
+
+create table if not exists upload_ranges (
+    session_id  varchar(32),
+    start_offset integer,
+    end_offset  integer,
+    FOREIGN KEY(session_id) REFERENCES upload_sessions(id)
+    );
+
+create index if not exists upload_ranges_session_id on upload_ranges (session_id);
@@ -0,0 +1,479 @@
+import os
+import time
+import errno
+import fcntl
+import hashlib
+import threading
+import collections
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from flask import current_app
+
+from flask_package_mgr import release_db
+
+from package_database import list_scrub_rows, list_scrub_tags, lookup_stored_paths, dispose_unreferenced, dispose_stored, clear_variants, recount_refs, delete_dangling_tag, relocate_blob, row_variants
+from blobstore import HASH_CHUNK_SIZE, VARIANT_SUFFIXES, blob_path, blob_root, variant_path, remove_blob
+from ratelimit import TokenBucket
+from volumes import get_volumes, volume_folder
+
+# what a scrub can find
+#   missing - a filestore row whose file is gone
+#   mismatch - a stored file whose size or digest is not the one recorded
+#   missing_variant - a precompressed variant that is recorded but gone
+#   refcount - a filestore refcount that is not the number of tags pointing at it
+#   dangling_tag - a tag whose package or filestore row is gone
+#   orphan - a file in the blob store no filestore row points at
+KINDS = ('missing', 'mismatch', 'missing_variant', 'refcount', 'dangling_tag', 'orphan')
+ACTIONS = ('report', 'quarantine', 'repair')
+
+# findings kept for the stats endpoint, the rest are only logged
+RECENT_FINDINGS = 100
+
+# held in UPLOAD_FOLDER while a pass runs, so the scrubbers of several workers take turns
+SCRUB_LOCK = '.scrub.lock'
+
+class ScrubStopped(Exception):
+    pass
+
+class IopsLimiter(object):
+    """
+    Paces the scrubber's filesystem operations to at most max_iops a second across
+    all its workers, 0 does not limit them
+    """
+    def __init__(self, max_iops):
+        self._bucket = TokenBucket(max_iops, max(max_iops, 1), time.time()) if max_iops else None
+        self._lock = threading.Lock()
+
+    def take(self, ops=1):
+        if self._bucket is None:
+            return
+        while True:
+            with self._lock:
+                wait = self._bucket.take(ops, time.time())
+            if not wait:
+                return
+            time.sleep(wait)
+
+class ScrubReport(object):
+    """
+    The progress and findings of scrub passes.  Every finding is handed to on_finding as it
+    is made, so a long pass reports as it goes
+    """
+    def __init__(self, on_finding=None):
+        self.on_finding = on_finding
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._recent = collections.deque(maxlen=RECENT_FINDINGS)
+        self._stats = {
+            'passes' : 0,
+            'running' : False,
+            'rows_checked' : 0,
+            'tags_checked' : 0,
+            'files_checked' : 0,
+            'bytes_hashed' : 0,
+            'found' : dict((kind, 0) for kind in KINDS),
+            'quarantined' : 0,
+            'repaired' : 0,
+            'errors' : 0,
+            'skipped' : 0,
+            'last_pass' : None
+            }
+
+    def stop(self):
+        self._stop_event.set()
+
+    def wait(self, timeout):
+        """
+        waits timeout seconds, True if the scrub was stopped meanwhile
+        """
+        return self._stop_event.wait(timeout)
+
+    def check_stopped(self):
+        if self._stop_event.is_set():
+            raise ScrubStopped()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def finding(self, finding):
+        with self._lock:
+            self._stats['found'][finding['kind']] += 1
+            if finding.get('action') in ('quarantined', 'repaired'):
+                self._stats[finding['action']] += 1
+            self._recent.append(finding)
+        current_app.logger.warning("scrub found {f}".format(f=finding))
+        if self.on_finding is not None:
+            self.on_finding(finding)
+
+    def begin_pass(self):
+        with self._lock:
+            self._stats['running'] = True
+            self._pass = { 'started' : time.time(), 'found' : sum(self._stats['found'].values()) }
+
+    def end_pass(self, completed):
+        with self._lock:
+            self._stats['running'] = False
+            self._stats['passes'] += 1
+            self._stats['last_pass'] = {
+                'started' : self._pass['started'],
+                'finished' : time.time(),
+                'completed' : completed,
+                'found' : sum(self._stats['found'].values()) - self._pass['found']
+                }
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['found'] = dict(self._stats['found'])
+            stats['recent'] = list(self._recent)
+        return stats
+
+def quarantine_file(path, root):
+    """
+    moves a file under root aside into the quarantine directory next to root, keeping
+    its path relative to root
+    """
+    target = os.path.join(os.path.dirname(root), 'quarantine', os.path.relpath(path, root))
+    try:
+        os.makedirs(os.path.dirname(target))
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    if os.path.exists(target):
+        target = '{t}.{n}'.format(t=target, n=int(time.time()))
+    os.rename(path, target)
+    return target
+
+def _hash_file(path, limiter, report):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            limiter.take()
+            report.check_stopped()
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    report.count('bytes_hashed', size)
+    return digest.hexdigest(), size
+
+def check_row_files(row, limiter, report, verify_digest):
+    """
+    checks the files of one filestore row, runs on the worker pool so it only touches the
+    filesystem.  Returns the findings
+    """
+    findings = []
+    path = row['package_filepath']
+    base = { 'filestore_id' : row['id'], 'path' : path, 'digest' : row['digest'] }
+    limiter.take()
+    try:
+        st = os.stat(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return [ dict(base, kind='missing') ]
+    if row['size'] is not None and st.st_size != row['size']:
+        findings.append(dict(base, kind='mismatch', detail='size {a} is not {e}'.format(a=st.st_size, e=row['size'])))
+    elif verify_digest and row['digest'] is not None:
+        digest, size = _hash_file(path, limiter, report)
+        if digest != row['digest']:
+            findings.append(dict(base, kind='mismatch', detail='digest is {d}'.format(d=digest)))
+    missing = []
+    for encoding in row_variants(row):
+        limiter.take()
+        if not os.path.isfile(variant_path(path, encoding)):
+            missing.append(encoding)
+    if missing:
+        findings.append(dict(base, kind='missing_variant', encodings=sorted(missing)))
+    return findings
+
+def find_blob_copy(row):
+    """
+    looks for a missing blob where a volume would store it, a reshard or drain that was
+    stopped part way can leave the only copy there.  Returns (path, volume) or None
+    """
+    config = current_app.config
+    for name in get_volumes():
+        candidate = blob_path(volume_folder(name), row['digest'], levels=config['BLOB_FANOUT_LEVELS'], width=config['BLOB_FANOUT_WIDTH'])
+        if candidate != row['package_filepath'] and os.path.isfile(candidate) and (row['size'] is None or os.path.getsize(candidate) == row['size']):
+            return candidate, name
+    return None
+
+def act_on_row(finding, row, action):
+    """
+    quarantines or repairs what a row check found, returns what was done
+    """
+    kind = finding['kind']
+    root = blob_root(volume_folder(row['volume']))
+    if kind == 'mismatch':
+        moved = []
+        dispose_stored(row['id'], row['package_filepath'], lambda path: moved.append(quarantine_file(path, root)))
+        return 'quarantined' if moved else 'reported'
+    if action != 'repair':
+        return 'reported'
+    if kind == 'missing' and row['digest'] is not None:
+        copy = find_blob_copy(row)
+        if copy is not None and relocate_blob(row['id'], row['package_filepath'], copy[0], copy[1], []):
+            return 'repaired'
+    elif kind == 'missing_variant':
+        clear_variants(row['id'], finding['encodings'])
+        return 'repaired'
+    elif kind == 'refcount':
+        recount_refs(row['id'])
+        return 'repaired'
+    return 'reported'
+
+def scrub_rows(report, pool, limiter, config):
+    action = config['SCRUB_ACTION']
+    after_id = 0
+    while True:
+        report.check_stopped()
+        rows = list_scrub_rows(after_id=after_id, limit=config['SCRUB_BATCH_SIZE'])
+        # a pass can take hours, connections are only held for each read and write
+        release_db()
+        if not rows:
+            return
+        after_id = rows[-1]['id']
+        checked = pool.map(lambda row: check_row_files(row, limiter, report, config['SCRUB_VERIFY_DIGEST']), rows)
+        for row, findings in zip(rows, checked):
+            if row['refcount'] != row['tags']:
+                findings.append({
+                    'kind' : 'refcount',
+                    'filestore_id' : row['id'],
+                    'path' : row['package_filepath'],
+                    'digest' : row['digest'],
+                    'detail' : 'refcount {r} but {t} tags'.format(r=row['refcount'], t=row['tags'])
+                    })
+            for finding in findings:
+                if action != 'report':
+                    finding['action'] = act_on_row(finding, row, action)
+                    release_db()
+                else:
+                    finding['action'] = 'reported'
+                report.finding(finding)
+        report.count('rows_checked', len(rows))
+
+def scrub_tags(report, config):
+    after_id = 0
+    while True:
+        report.check_stopped()
+        tags = list_scrub_tags(after_id=after_id, limit=config['SCRUB_BATCH_SIZE'])
+        release_db()
+        if not tags:
+            return
+        after_id = tags[-1]['id']
+        for tag in tags:
+            if tag['has_package'] and tag['has_filestore']:
+                continue
+            finding = {
+                'kind' : 'dangling_tag',
+                'tag_id' : tag['id'],
+                'tag' : tag['tag'],
+                'package_id' : tag['package_id'],
+                'filestore_id' : tag['filestore_id'],
+                'detail' : 'package is gone' if not tag['has_package'] else 'file is gone',
+                'action' : 'reported'
+                }
+            if config['SCRUB_ACTION'] == 'repair':
+                if delete_dangling_tag(tag['id']):
+                    finding['action'] = 'repaired'
+                release_db()
+            report.finding(finding)
+        report.count('tags_checked', len(tags))
+
+def stored_path(path):
+    """
+    the blob a file in the blob store belongs to, variants belong to the blob they were made from
+    """
+    for suffix in VARIANT_SUFFIXES.itervalues():
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+def walk_blob_store(root, limiter, report):
+    """
+    yields every file in the blob store under root, leaving out the uploads in progress
+    """
+    for directory, dirs, files in os.walk(root):
+        limiter.take()
+        report.check_stopped()
+        if directory == root and 'tmp' in dirs:
+            dirs.remove('tmp')
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.join(directory, name)
+
+def scrub_files(report, pool, limiter, config, root):
+    action = config['SCRUB_ACTION']
+    min_age = config['SCRUB_ORPHAN_MIN_AGE']
+
+    def check(paths):
+        stored = lookup_stored_paths(set(stored_path(path) for path in paths))
+        release_db()
+        def changed(path):
+            limiter.take()
+            try:
+                # link() changes the ctime, so this is the time the file was published
+                return os.stat(path).st_ctime
+            except OSError:
+                return None
+        unreferenced = [ path for path in paths if stored_path(path) not in stored ]
+        now = time.time()
+        for path, ctime in zip(unreferenced, pool.map(changed, unreferenced)):
+            if ctime is None or now - ctime < min_age:
+                continue
+            finding = { 'kind' : 'orphan', 'path' : path, 'action' : 'reported' }
+            if action == 'quarantine':
+                if dispose_unreferenced(path, stored_path(path), lambda path: quarantine_file(path, root)):
+                    finding['action'] = 'quarantined'
+                release_db()
+            elif action == 'repair':
+                if dispose_unreferenced(path, stored_path(path), remove_blob):
+                    finding['action'] = 'repaired'
+                release_db()
+            report.finding(finding)
+        report.count('files_checked', len(paths))
+
+    if not os.path.isdir(root):
+        return
+    batch = []
+    for path in walk_blob_store(root, limiter, report):
+        batch.append(path)
+        if len(batch) >= config['SCRUB_BATCH_SIZE']:
+            check(batch)
+            batch = []
+    if batch:
+        check(batch)
+
+@contextmanager
+def scrub_lock(config):
+    """
+    takes the scrub lock without waiting.  Yields the lock file, or None when another process
+    holds it.  The file records when the last complete pass finished
+    """
+    with open(os.path.join(config['UPLOAD_FOLDER'], SCRUB_LOCK), 'a+') as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield None
+            return
+        try:
+            yield lock_file
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def last_pass_finished(lock_file):
+    lock_file.seek(0)
+    try:
+        return float(lock_file.read())
+    except ValueError:
+        return None
+
+def scrub(report=None, config=None, interval=None):
+    """
+    Runs one scrub pass: every filestore row against its files, every tag against its package
+    and filestore row, and every file in each volume's blob store against the filestore rows.
+    Filesystem checks run on SCRUB_WORKERS threads a SCRUB_BATCH_SIZE batch at a time, paced to
+    SCRUB_MAX_IOPS, and the database is only read a batch at a time so serving is not held up.
+    SCRUB_ACTION 'report' changes nothing, 'quarantine' moves orphans and mismatched files aside
+    into <volume>/quarantine, 'repair' quarantines mismatched files, removes orphans older than
+    SCRUB_ORPHAN_MIN_AGE, repoints rows at a copy of their missing blob, forgets missing variants,
+    recounts refcounts and deletes dangling tags.
+
+    Only one process scrubs at a time, a pass is skipped (and counted as skipped) while another
+    holds the scrub lock, or when interval is given and any process completed a pass less than
+    interval seconds ago.  Returns the report
+    """
+    config = config or current_app.config
+    if config['SCRUB_ACTION'] not in ACTIONS:
+        raise ValueError('SCRUB_ACTION must be one of {a}'.format(a=', '.join(ACTIONS)))
+    report = report or ScrubReport()
+    with scrub_lock(config) as lock_file:
+        if lock_file is None:
+            report.count('skipped')
+            return report
+        finished = last_pass_finished(lock_file)
+        if interval and finished is not None and time.time() - finished < interval:
+            report.count('skipped')
+            return report
+        limiter = IopsLimiter(config['SCRUB_MAX_IOPS'])
+        pool = ThreadPool(config['SCRUB_WORKERS'])
+        report.begin_pass()
+        completed = False
+        try:
+            scrub_rows(report, pool, limiter, config)
+            scrub_tags(report, config)
+            roots = set(blob_root(volume['path']) for volume in get_volumes().itervalues())
+            for root in sorted(roots):
+                scrub_files(report, pool, limiter, config, root)
+            completed = True
+        except ScrubStopped:
+            pass
+        finally:
+            pool.close()
+            pool.join()
+            report.end_pass(completed)
+        if completed:
+            lock_file.truncate(0)
+            lock_file.write(repr(time.time()))
+            lock_file.flush()
+    return report
+
+class Scrubber(threading.Thread):
+    """
+    Background thread that runs a scrub pass every interval seconds.  Each worker of a
+    pre-fork server starts one, the scrub lock has them take turns so passes across all
+    workers are still interval seconds apart and never overlap
+    """
+    def __init__(self, app, interval):
+        threading.Thread.__init__(self, name='scrubber')
+        self.daemon = True
+        self.app = app
+        self.interval = interval
+        self.pid = os.getpid()
+        self.report = ScrubReport()
+
+    def stop(self):
+        self.report.stop()
+
+    def wait_stopped(self, timeout=None):
+        """
+        waits up to timeout seconds for a pass that is running to give up once stopped
+        """
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self.report.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    scrub(self.report, interval=self.interval)
+            except Exception as err:
+                self.app.logger.error("Unhandled Error in scrub pass : {e}".format(e=err))
+                self.report.count('errors')
+
+    def get_stats(self):
+        stats = self.report.get_stats()
+        stats['interval'] = self.interval
+        return stats
+
+def start_scrubber():
+    """
+    Starts the background scrub thread if SCRUB_INTERVAL is set and it is not already running
+    """
+    app = current_app._get_current_object()
+    scrubber = app.extensions.get('scrubber')
+    if scrubber is not None and scrubber.is_alive() and scrubber.pid == os.getpid():
+        return scrubber
+    if not app.config['SCRUB_INTERVAL']:
+        return None
+    scrubber = Scrubber(app, app.config['SCRUB_INTERVAL'])
+    scrubber.start()
+    app.extensions['scrubber'] = scrubber
+    return scrubber
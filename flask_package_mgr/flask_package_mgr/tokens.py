@@ -0,0 +1,131 @@
+import os
+import time
+import hmac
+import base64
+import hashlib
+import threading
+
+from flask import current_app
+
+class InvalidTokenError(Exception):
+    """
+    raised when a token is malformed, has a bad signature, has expired or was revoked
+    """
+    def __init__(self, message='Invalid Token'):
+        Exception.__init__(self, message)
+        self.message = message
+
+class TokenSigner(object):
+    """
+    Issues and verifies stateless tokens.  A token is
+
+        <key id>.<user id>.<expires>.<token id>.<signature>
+
+    where the signature is an HMAC-SHA256 of everything before it.  New tokens are
+    signed with key_id, tokens signed with any other key in keys still verify, so
+    keys can be rotated by adding the new key, switching key_id, and dropping the
+    old key once its tokens have expired
+    """
+    def __init__(self, keys, key_id, ttl):
+        if key_id not in keys:
+            raise ValueError('token signing key {k} is not configured'.format(k=key_id))
+        self.key_id = str(key_id)
+        self.ttl = ttl
+        # keyed hmac objects are copied per token so the key schedule is only computed once
+        self._macs = dict(
+                (str(kid), hmac.new(str(secret), digestmod=hashlib.sha256))
+                for kid, secret in keys.iteritems()
+                )
+
+    def _signature(self, kid, payload):
+        mac = self._macs[kid].copy()
+        mac.update(payload)
+        return base64.urlsafe_b64encode(mac.digest()).rstrip('=')
+
+    def sign(self, user_id, now=None):
+        expires = int((now or time.time()) + self.ttl)
+        payload = '{k}.{u}.{e}.{t}'.format(
+                k=self.key_id,
+                u=int(user_id),
+                e=expires,
+                t=os.urandom(8).encode('hex')
+                )
+        return payload + '.' + self._signature(self.key_id, payload)
+
+    def verify(self, token, now=None):
+        """
+        checks the signature and expiry of token and returns (user_id, token_id, expires)
+        """
+        try:
+            token = str(token)
+            payload, signature = token.rsplit('.', 1)
+            kid, user_id, expires, token_id = payload.split('.')
+            user_id = int(user_id)
+            expires = int(expires)
+        except (ValueError, UnicodeError):
+            raise InvalidTokenError()
+        if kid not in self._macs:
+            raise InvalidTokenError()
+        if not hmac.compare_digest(self._signature(kid, payload), signature):
+            raise InvalidTokenError()
+        if expires <= (now or time.time()):
+            raise InvalidTokenError(message='Token has expired')
+        return user_id, token_id, expires
+
+class RevocationList(object):
+    """
+    The ids of revoked tokens that have not expired yet.  Entries are dropped once the
+    token would have expired anyway, so the set stays as small as the number of tokens
+    revoked within one token lifetime
+    """
+    def __init__(self):
+        self._revoked = {}
+        self._lock = threading.Lock()
+        self._next_prune = 0
+
+    def revoke(self, token_id, expires):
+        with self._lock:
+            self._revoked[token_id] = expires
+
+    def is_revoked(self, token_id, now=None):
+        now = now or time.time()
+        if now >= self._next_prune:
+            self._prune(now)
+        return token_id in self._revoked
+
+    def _prune(self, now):
+        with self._lock:
+            for token_id, expires in self._revoked.items():
+                if expires <= now:
+                    del self._revoked[token_id]
+            self._next_prune = now + 60
+
+    def __len__(self):
+        return len(self._revoked)
+
+def get_token_signer():
+    """
+    Returns the token signer for the current configuration.  TOKEN_KEYS maps key ids
+    to secrets, when it is not set SECRET_KEY is the only key
+    """
+    app = current_app._get_current_object()
+    config = app.config
+    keys = config['TOKEN_KEYS'] or { config['TOKEN_KEY_ID'] : config['SECRET_KEY'] }
+    settings = (sorted(keys.items()), config['TOKEN_KEY_ID'], config['TOKEN_TTL'])
+    signer = app.extensions.get('token_signer')
+    if signer is None or signer.settings != settings:
+        signer = TokenSigner(keys, config['TOKEN_KEY_ID'], config['TOKEN_TTL'])
+        signer.settings = settings
+        app.extensions['token_signer'] = signer
+    return signer
+
+def get_revocations():
+    """
+    Returns this process's list of revoked tokens
+    """
+    app = current_app._get_current_object()
+    revocations = app.extensions.get('token_revocations')
+    if revocations is None:
+        revocations = RevocationList()
+        app.extensions['token_revocations'] = revocations
+    return revocations
@@ -0,0 +1,219 @@
+import os
+import re
+import time
+
+from package_database import store_package_rows, store_upload_session, lookup_upload_session, list_upload_ranges, begin_upload_chunk, end_upload_chunk, claim_upload_session, claim_expired_upload_session, release_upload_session, delete_upload_session, list_expired_upload_sessions
+from error_handlers import InvalidUseError, IntegrityError, NotFoundError
+from blobstore import HASH_CHUNK_SIZE, blob_root, temp_dir, is_digest, hash_file, remove_blob, stage_copy
+from filestore import validate_upload, guess_content_type, queue_compression, blob_location, sync_published
+from durability import durability_level, sync_to_disk
+from volumes import choose_volume, volume_folder, get_volume_counters
+from flask_package_mgr import app, release_db
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+def session_path(session_id):
+    """
+    the file an upload session's chunks are written into, next to the other temporary uploads
+    so it can be moved into the blob store on commit
+    """
+    return os.path.join(blob_root(app.config['UPLOAD_FOLDER']), 'tmp', session_id + '.session')
+
+def merge_ranges(ranges):
+    """
+    merges overlapping and adjacent [start, end) ranges, ranges must be ordered by start
+    """
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([ start, end ])
+    return merged
+
+def parse_content_range(content_range):
+    """
+    parses a 'bytes <first>-<last>/<size>' Content-Range header into [start, end) and size
+    """
+    match = CONTENT_RANGE.match(content_range or '')
+    if match is None:
+        raise InvalidUseError(message='Content-Range must be bytes <first>-<last>/<size>')
+    first, last, size = [ int(part) for part in match.groups() ]
+    if last < first:
+        raise InvalidUseError(message='Content-Range is empty')
+    return first, last + 1, size
+
+def _get_session(session_id, user_id):
+    session = lookup_upload_session(session_id)
+    if session is None or session['user_id'] != user_id:
+        raise NotFoundError(message='upload not found')
+    return session
+
+def _claim_session(session_id, user_id, state):
+    _get_session(session_id, user_id)
+    if not claim_upload_session(session_id, user_id, state):
+        raise IntegrityError(message='upload is busy, chunks are still being written or it is being committed')
+
+def create_upload_session(user_id, package_name, tag, filename, size, digest=None):
+    """
+    starts a resumable upload of size bytes.  digest is the sha256 the client expects,
+    when given the upload is checked against it on commit
+    """
+    filename = validate_upload(filename, package_name, tag)
+    if digest is not None and not is_digest(digest):
+        raise InvalidUseError(message='invalid digest')
+    expire_upload_sessions()
+
+    session_id = os.urandom(16).encode('hex')
+    temp_dir(app.config['UPLOAD_FOLDER'])
+    open(session_path(session_id), 'wb').close()
+    expires = int(time.time()) + app.config['UPLOAD_SESSION_TTL']
+    store_upload_session(
+            session_id=session_id,
+            user_id=user_id,
+            package_name=package_name,
+            tag=tag,
+            filename=filename,
+            size=size,
+            digest=digest,
+            expires=expires
+            )
+    return get_upload_session(session_id, user_id)
+
+def get_upload_session(session_id, user_id):
+    """
+    reports an upload session and the byte ranges received so far
+    """
+    session = _get_session(session_id, user_id)
+    received = merge_ranges(list_upload_ranges(session_id))
+    return {
+        'upload_id' : session_id,
+        'package_name' : session['package_name'],
+        'tag' : session['tag'],
+        'filename' : session['filename'],
+        'size' : session['size'],
+        'received' : received,
+        'complete' : received == [ [ 0, session['size'] ] ] or session['size'] == 0,
+        'expires' : session['expires']
+        }
+
+def write_upload_chunk(session_id, user_id, content_range, content_length, stream):
+    """
+    writes one chunk of an upload, read from stream a block at a time.  Chunks may arrive
+    in any order and in parallel, each one is recorded as received once it is on disk
+    """
+    start, end, size = parse_content_range(content_range)
+    if content_length != end - start:
+        raise InvalidUseError(message='Content-Length does not match Content-Range')
+    expires = int(time.time()) + app.config['UPLOAD_SESSION_TTL']
+    if not begin_upload_chunk(session_id, user_id, expires):
+        _get_session(session_id, user_id)
+        raise IntegrityError(message='upload is being committed')
+
+    level = durability_level()
+    received = False
+    try:
+        session = lookup_upload_session(session_id)
+        if size != session['size'] or end > session['size']:
+            raise InvalidUseError(message='Content-Range is outside of the upload')
+        # the chunk may take a while to arrive, don't hold pooled connections while it does
+        release_db()
+        with open(session_path(session_id), 'r+b') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining:
+                block = stream.read(min(HASH_CHUNK_SIZE, remaining))
+                if not block:
+                    raise InvalidUseError(message='chunk is shorter than its Content-Range')
+                f.write(block)
+                remaining -= len(block)
+            f.flush()
+            if level == 'file':
+                os.fsync(f.fileno())
+        if level == 'group':
+            sync_to_disk([ session_path(session_id) ], level)
+        received = True
+    finally:
+        if received:
+            end_upload_chunk(session_id, start, end)
+        else:
+            end_upload_chunk(session_id)
+    return get_upload_session(session_id, user_id)
+
+def commit_upload_session(session_id, user_id):
+    """
+    publishes a complete upload the same way a single request upload is published, and
+    removes the session
+    """
+    _claim_session(session_id, user_id, 'committing')
+    try:
+        status = get_upload_session(session_id, user_id)
+        if not status['complete']:
+            raise InvalidUseError(message='upload is incomplete')
+        session = lookup_upload_session(session_id)
+        release_db()
+        path = session_path(session_id)
+        digest, size = hash_file(path)
+        if session['digest'] is not None and digest != session['digest']:
+            raise InvalidUseError(message='upload does not match its digest')
+        volume = choose_volume()['name']
+        published = blob_location(digest, volume)
+        mtime = int(os.path.getmtime(path))
+        staged = None
+        if os.stat(volume_folder(volume)).st_dev != os.stat(path).st_dev:
+            # sessions are written under UPLOAD_FOLDER, one going onto a volume on another disk is
+            # copied over before the write lock is taken, so publishing it is still a link
+            staged = stage_copy(path, volume_folder(volume))
+        try:
+            rows = store_package_rows(
+                    package_name=session['package_name'],
+                    user=user_id,
+                    filename=session['filename'],
+                    digest=digest,
+                    size=size,
+                    blob_path=published,
+                    tmp_path=staged or path,
+                    tag=session['tag'],
+                    volume=volume,
+                    mtime=mtime,
+                    content_type=guess_content_type(session['filename'])
+                    )
+        finally:
+            if staged is not None:
+                remove_blob(staged)
+    except Exception:
+        release_upload_session(session_id)
+        raise
+    delete_upload_session(session_id)
+    if staged is not None:
+        remove_blob(path)
+    # the rows are committed, so the writer is handed back before waiting on the sync
+    release_db()
+    sync_published(published, volume, durability_level())
+    get_volume_counters().record_write(volume, size)
+    queue_compression(digest)
+    return rows
+
+def abort_upload_session(session_id, user_id):
+    """
+    drops an upload session and everything received for it
+    """
+    _claim_session(session_id, user_id, 'aborting')
+    delete_upload_session(session_id)
+    remove_blob(session_path(session_id))
+    return { 'message' : 'upload has been aborted' }
+
+def expire_upload_sessions(now=None):
+    """
+    removes upload sessions nobody has written to for UPLOAD_SESSION_TTL seconds, returns how many.
+    Each is claimed first, so a session a chunk or commit got to in the meantime is kept
+    """
+    now = now or int(time.time())
+    removed = 0
+    for session_id in list_expired_upload_sessions(now):
+        if not claim_expired_upload_session(session_id, now):
+            continue
+        delete_upload_session(session_id)
+        remove_blob(session_path(session_id))
+        removed += 1
+    return removed
@@ -0,0 +1,160 @@
+import os
+import time
+import random
+import threading
+
+from flask import current_app
+
+from error_handlers import UnhandledError
+
+# the volume of files stored before STORAGE_VOLUMES existed, UPLOAD_FOLDER unless it is listed
+DEFAULT_VOLUME = 'default'
+
+def get_volumes():
+    """
+    the configured storage volumes, name -> volume.  Without STORAGE_VOLUMES, UPLOAD_FOLDER is
+    the only volume.  Once volumes are listed UPLOAD_FOLDER only takes new files if it is listed
+    as 'default' itself, otherwise it is drained like any other volume marked drain.
+
+    accel_prefix is the nginx internal location serving a volume's path for DOWNLOAD_MODE
+    'x-accel-redirect', DOWNLOAD_ACCEL_PREFIX/<name>/ unless the volume sets one.  UPLOAD_FOLDER
+    is served from DOWNLOAD_ACCEL_PREFIX itself
+    """
+    config = current_app.config
+    volumes = {}
+    for volume in config['STORAGE_VOLUMES'] or []:
+        volumes[volume['name']] = {
+            'name' : volume['name'],
+            'path' : volume['path'],
+            'weight' : volume.get('weight', 1),
+            'drain' : volume.get('drain', False),
+            'accel_prefix' : volume.get('accel_prefix', '{p}/{n}/'.format(p=config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/'), n=volume['name']))
+            }
+    if DEFAULT_VOLUME not in volumes:
+        volumes[DEFAULT_VOLUME] = {
+            'name' : DEFAULT_VOLUME,
+            'path' : config['UPLOAD_FOLDER'],
+            'weight' : 0 if config['STORAGE_VOLUMES'] else 1,
+            'drain' : bool(config['STORAGE_VOLUMES']),
+            'accel_prefix' : config['DOWNLOAD_ACCEL_PREFIX']
+            }
+    return volumes
+
+def get_volume(name):
+    """
+    a volume by name, files with no volume recorded are on the default volume.  None when
+    the volume is no longer configured
+    """
+    return get_volumes().get(name or DEFAULT_VOLUME)
+
+def volume_folder(name):
+    """
+    the folder a volume stores its blobs under, UPLOAD_FOLDER for a volume no longer configured
+    """
+    volume = get_volume(name)
+    return volume['path'] if volume is not None else current_app.config['UPLOAD_FOLDER']
+
+def volume_space(volume):
+    """
+    the (total, free) bytes of the filesystem a volume is on, (0, 0) when it is not there
+    """
+    try:
+        stat = os.statvfs(volume['path'])
+    except OSError as err:
+        current_app.logger.error("Unable to stat volume {n} at {p} : {e}".format(n=volume['name'], p=volume['path'], e=err))
+        return 0, 0
+    return stat.f_blocks * stat.f_frsize, stat.f_bavail * stat.f_frsize
+
+def choose_volume(exclude=None):
+    """
+    picks the volume a new file is stored on, at random in proportion to weight times free
+    space so emptier and bigger disks fill up first.  Volumes being drained, with no weight
+    or with less than STORAGE_MIN_FREE bytes free take nothing
+    """
+    candidates = []
+    for volume in get_volumes().itervalues():
+        if volume['drain'] or volume['weight'] <= 0 or volume['name'] == exclude:
+            continue
+        total, free = volume_space(volume)
+        if free > current_app.config['STORAGE_MIN_FREE']:
+            candidates.append((volume['weight'] * free, volume))
+    if not candidates:
+        current_app.logger.error("No storage volume has space for a new file")
+        raise UnhandledError()
+    point = random.uniform(0, sum(score for score, volume in candidates))
+    for score, volume in candidates:
+        point -= score
+        if point <= 0:
+            break
+    return volume
+
+IO_COUNTERS = {
+    'files_written' : 0,
+    'bytes_written' : 0,
+    'files_read' : 0,
+    'bytes_read' : 0
+    }
+
+class VolumeStats(object):
+    """
+    Counts the bytes written to and read from each volume by this process
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def _record(self, name, kind, nbytes):
+        with self._lock:
+            counts = self._counts.setdefault(name or DEFAULT_VOLUME, dict(IO_COUNTERS))
+            counts['files_' + kind] += 1
+            counts['bytes_' + kind] += nbytes
+
+    def record_write(self, name, nbytes):
+        self._record(name, 'written', nbytes)
+
+    def record_read(self, name, nbytes):
+        self._record(name, 'read', nbytes)
+
+    def get_stats(self, name):
+        elapsed = max(time.time() - self.started, 1e-6)
+        with self._lock:
+            counts = dict(self._counts.get(name, IO_COUNTERS))
+        counts['write_bytes_per_sec'] = counts['bytes_written'] / elapsed
+        counts['read_bytes_per_sec'] = counts['bytes_read'] / elapsed
+        return counts
+
+def get_volume_counters():
+    """
+    Returns this process's per volume I/O counters
+    """
+    app = current_app._get_current_object()
+    counters = app.extensions.get('volume_stats')
+    if counters is None or counters.pid != os.getpid():
+        counters = VolumeStats()
+        app.extensions['volume_stats'] = counters
+    return counters
+
+def get_volume_stats(usage):
+    """
+    reports each volume's settings, fill level and I/O.  usage maps a volume name to the
+    number of files and bytes stored on it
+    """
+    counters = get_volume_counters()
+    stats = {}
+    for name, volume in get_volumes().iteritems():
+        total, free = volume_space(volume)
+        files, stored = usage.get(name, (0, 0))
+        stats[name] = dict(
+                counters.get_stats(name),
+                path=volume['path'],
+                weight=volume['weight'],
+                drain=volume['drain'],
+                total_bytes=total,
+                free_bytes=free,
+                fill=1 - float(free) / total if total else None,
+                files=files,
+                stored_bytes=stored
+                )
+    return stats
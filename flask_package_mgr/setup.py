@@ -8,6 +8,9 @@ setup(
         'flask',
         'marshmallow'
         ],
+    extras_require={
+        'zstd' : [ 'zstandard' ]
+        },
     setup_requires=[
         'pytest-runner',
         ],
@@ -1,11 +1,15 @@
+import time
 from time import sleep
 import re
 import io
 import os
+import fcntl
 import shutil
 import tempfile
 import pytest
+import threading
 import filecmp
+import sqlite3
 from flask_package_mgr import flask_package_mgr
 from flask import json
 import flask_package_mgr.response_codes as response_codes
@@ -24,6 +28,8 @@ test_filenames=[
 def client(request):
     db_fd, flask_package_mgr.app.config['DATABASE'] = tempfile.mkstemp()
     flask_package_mgr.app.config['TESTING'] = True
+    # a real hashing cost only slows the tests down
+    flask_package_mgr.app.config['PASSWORD_HASH_ITERATIONS'] = 1000
     client = flask_package_mgr.app.test_client()
 
     for test_file in test_filenames:
@@ -51,6 +57,8 @@ def client(request):
                 print(e)
 
     def teardown():
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.shutdown_background_services()
         os.close(db_fd)
         os.unlink(flask_package_mgr.app.config['DATABASE'])
         for test_file in test_filenames:
@@ -89,8 +97,9 @@ def add_base_user(client):
             )
     assert r.status_code == 200
   
-def add_base_user_and_get_token(client):
-    add_base_user(client)
+def add_base_user_and_get_token(client, add_user=True):
+    if add_user:
+        add_base_user(client)
     get_token_data = {
         'username' : 'nweaver',
         'password' : 'password'
@@ -116,6 +125,87 @@ def test_list_users(client):
     assert b'[]' in r.data
 
 
+def test_db_pool_reuses_connections(client):
+    add_base_user(client)
+    for i in range(10):
+        r = client.get('/api/v1/admin/user_list')
+        assert r.status_code == 200
+
+    r = client.get('/api/v1/admin/stats')
+    assert r.status_code == 200
+    pool_stats = json.loads(r.data)['db_pool']
+    assert pool_stats['checkouts'] >= 11
+    assert pool_stats['created'] <= pool_stats['size']
+    assert pool_stats['in_use'] == 0
+
+def test_db_pool_recycles_after_max_uses(client):
+    flask_package_mgr.app.config['DATABASE_POOL_MAX_USES'] = 2
+    try:
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+        for i in range(6):
+            r = client.get('/api/v1/admin/user_list')
+            assert r.status_code == 200
+        with flask_package_mgr.app.app_context():
+            pool_stats = flask_package_mgr.get_pool().get_stats()
+        assert pool_stats['recycled'] == 3
+        assert pool_stats['created'] == 3
+    finally:
+        flask_package_mgr.app.config['DATABASE_POOL_MAX_USES'] = 1000
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+
+def test_shutdown_background_services(client):
+    from flask_package_mgr.durability import get_group_syncer
+
+    with flask_package_mgr.app.app_context():
+        syncer = get_group_syncer()
+        syncer.submit([ flask_package_mgr.app.config['UPLOAD_FOLDER'] ])
+        flask_package_mgr.get_pool()
+        # closing the connections leaves the services that do not use them running
+        flask_package_mgr.close_pool()
+        assert 'sqlite_pool' not in flask_package_mgr.app.extensions
+        assert syncer is get_group_syncer()
+        flask_package_mgr.shutdown_background_services()
+        assert 'group_syncer' not in flask_package_mgr.app.extensions
+        # the services are finished before the pools they use are closed
+        assert not syncer._thread.is_alive()
+        assert syncer is not get_group_syncer()
+
+def test_wal_read_write_split(client):
+    flask_package_mgr.app.config['DATABASE_WAL'] = True
+    try:
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+        token = add_base_user_and_get_token(client)
+        r = add_package(client, token, 'test', '1.0')
+        assert r.status_code == 200
+
+        r, response = get_package(client, token, 'test', '1.0')
+        assert response == True
+
+        with flask_package_mgr.app.app_context():
+            mode = flask_package_mgr.get_db().execute('PRAGMA journal_mode').fetchone()
+            assert 'wal' == mode['journal_mode']
+
+            read_db = flask_package_mgr.get_read_db()
+            assert read_db is not flask_package_mgr.get_db()
+            with pytest.raises(flask_package_mgr.sqlite3.OperationalError):
+                read_db.execute("INSERT INTO packages (title, user_id) VALUES ('readonly', 1)")
+
+            result = flask_package_mgr.checkpoint_db()
+            assert 0 == result['busy']
+
+        r = client.get('/api/v1/admin/stats')
+        stats = json.loads(r.data)
+        assert 1 == stats['db_pool']['size']
+        assert stats['db_read_pool']['checkouts'] > 0
+        assert 'wal_checkpointer' in stats
+    finally:
+        flask_package_mgr.app.config['DATABASE_WAL'] = False
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+
 def test_add_user(client):
     adduser = {
         'username' : 'nweaver',
@@ -157,12 +247,14 @@ def test_add_user(client):
         assert b'apikey' in user_dict
         assert b'id' in user_dict
         if 'nweaver' == user_dict['username']:
-            assert b'password' in user_dict['password']
+            assert user_dict['password'].startswith('pbkdf2_sha256$')
+            assert b'password' not in user_dict['password']
             assert b'ApiKey' in user_dict['apikey']
             assert 1 == user_dict['id']
             found_nweaver = True
         if 'johndoe' == user_dict['username']:
-            assert b'jdoe0123' in user_dict['password']
+            assert user_dict['password'].startswith('pbkdf2_sha256$')
+            assert b'jdoe0123' not in user_dict['password']
             assert b'ApiKey' in user_dict['apikey']
             assert 2 == user_dict['id']
             found_johndoe = True
@@ -208,7 +300,8 @@ def test_duplicate_user_add(client):
         assert b'apikey' in user_dict
         assert b'id' in user_dict
         if 'nweaver' == user_dict['username']:
-            assert b'password' in user_dict['password']
+            assert user_dict['password'].startswith('pbkdf2_sha256$')
+            assert b'password' not in user_dict['password']
             assert b'ApiKey' in user_dict['apikey']
             assert 1 == user_dict['id']
             found_nweaver = True
@@ -233,7 +326,9 @@ def test_get_token(client):
     response_dict = json.loads(r.data)
 
     assert b'token' in response_dict
-    assert b'aValidToken' in response_dict['token']
+    key_id, user_id, expires, token_id, signature = response_dict['token'].split('.')
+    assert '1' == key_id
+    assert '1' == user_id
 
 def test_get_token_fail_bad_pass(client):
     add_base_user(client)
@@ -414,7 +509,9 @@ def test_invalidate_token_fail_bad_username(client):
 
 def test_invalidate_token_fail_bad_username_in_token(client):
     token = add_base_user_and_get_token(client)
-    token_data = { 'token' : 'aValidToken-invalidusername' }
+    # pointing a signed token at another user breaks its signature
+    key_id, user_id, rest = token.split('.', 2)
+    token_data = { 'token' : '.'.join([ key_id, '2', rest ]) }
     invalidate_token_data = { 
         'username' : 'nweaver',
         'password' : 'password'
@@ -428,7 +525,270 @@ def test_invalidate_token_fail_bad_username_in_token(client):
             )
     
     assert response_codes.UNAUTHORIZED == r.status_code
-    assert b'Unable to find user' in r.data
+    assert b'Invalid Token' in r.data
+
+def get_stored_password(username):
+    with flask_package_mgr.app.app_context():
+        db = flask_package_mgr.get_db()
+        return db.execute("SELECT password FROM users WHERE username = ?", [ username ]).fetchone()[0]
+
+def test_stopped_password_hasher(client):
+    from flask_package_mgr.passwords import PasswordHasher, check_password
+
+    # jobs queued when the hasher is stopped are still done
+    hasher = PasswordHasher(workers=1, iterations=1000, timeout=5)
+    results = {}
+    def hash_password(i):
+        results[i] = hasher.hash('password{i}'.format(i=i))
+    threads = [ threading.Thread(target=hash_password, args=(i, )) for i in range(4) ]
+    for t in threads:
+        t.start()
+    hasher.stop()
+    for t in threads:
+        t.join()
+    hasher.wait_stopped(5)
+    assert 4 == len(results)
+    assert all(check_password('password{i}'.format(i=i), results[i], 1000)[0] for i in range(4))
+
+    # and callers still holding it once it is gone hash for themselves
+    start = time.time()
+    matches, new_stored = hasher.verify('password0', results[0])
+    assert matches
+    assert time.time() - start < 5
+
+def test_password_rehashed_on_login(client):
+    add_base_user(client)
+    assert get_stored_password('nweaver').startswith('pbkdf2_sha256$1000$')
+
+    # changing the cost rehashes the password the next time it is used
+    flask_package_mgr.app.config['PASSWORD_HASH_ITERATIONS'] = 2000
+    try:
+        add_base_user_and_get_token(client, add_user=False)
+        assert get_stored_password('nweaver').startswith('pbkdf2_sha256$2000$')
+    finally:
+        flask_package_mgr.app.config['PASSWORD_HASH_ITERATIONS'] = 1000
+
+    # passwords stored in plaintext before hashing are upgraded too
+    with flask_package_mgr.app.app_context():
+        db = flask_package_mgr.get_db()
+        db.execute("UPDATE users SET password = 'password' WHERE username = 'nweaver'")
+        db.commit()
+    add_base_user_and_get_token(client, add_user=False)
+    assert get_stored_password('nweaver').startswith('pbkdf2_sha256$1000$')
+
+def test_get_token_busy(client):
+    add_base_user(client)
+    flask_package_mgr.app.config['PASSWORD_HASH_QUEUE_SIZE'] = 1
+    flask_package_mgr.app.config['PASSWORD_HASH_WORKERS'] = 1
+    started = threading.Event()
+    release = threading.Event()
+    def park():
+        started.set()
+        release.wait()
+    blockers = []
+    try:
+        with flask_package_mgr.app.app_context():
+            from flask_package_mgr.passwords import get_password_hasher
+            hasher = get_password_hasher()
+        # park the only worker, then take the only queue slot
+        blockers.append(threading.Thread(target=hasher._submit, args=(park, )))
+        blockers[0].start()
+        started.wait(5)
+        blockers.append(threading.Thread(target=hasher._submit, args=(park, )))
+        blockers[1].start()
+        while 1 != hasher._queue.qsize():
+            sleep(0.01)
+
+        r = client.post(
+                '/api/v1/user/get_token',
+                data=json.dumps({ 'username' : 'nweaver', 'password' : 'password' }),
+                content_type='application/json'
+                )
+        assert response_codes.SERVICE_UNAVAILABLE == r.status_code
+        assert b'too many logins in progress' in r.data
+        assert 1 == hasher.get_stats()['rejected']
+    finally:
+        release.set()
+        for blocker in blockers:
+            blocker.join()
+        flask_package_mgr.app.config['PASSWORD_HASH_QUEUE_SIZE'] = 16
+        flask_package_mgr.app.config['PASSWORD_HASH_WORKERS'] = 2
+
+def test_revoked_token_rejected(client):
+    token = add_base_user_and_get_token(client)
+    token_data = { 'token' : token }
+    invalidate_token_data = { 
+        'username' : 'nweaver',
+        'password' : 'password'
+        }
+    r = client.post(
+            '/api/v1/user/invalidate_token',
+            data=json.dumps(invalidate_token_data),
+            headers=token_data,
+            content_type='application/json'
+            )
+    assert 200 == r.status_code
+
+    r = list_packages(client, token, {})
+    assert response_codes.UNAUTHORIZED == r.status_code
+    assert b'Token has been revoked' in r.data
+
+def test_token_expiry_and_key_rotation(client):
+    token = add_base_user_and_get_token(client)
+    assert 200 == list_packages(client, token, {}).status_code
+
+    # rotate to a new signing key, tokens signed with the old key keep working
+    flask_package_mgr.app.config['TOKEN_KEYS'] = { '1' : 'TempKey', '2' : 'NewKey' }
+    flask_package_mgr.app.config['TOKEN_KEY_ID'] = '2'
+    try:
+        new_token = add_base_user_and_get_token(client, add_user=False)
+        assert new_token.startswith('2.')
+        assert 200 == list_packages(client, token, {}).status_code
+        assert 200 == list_packages(client, new_token, {}).status_code
+
+        # once the old key is dropped its tokens are rejected
+        flask_package_mgr.app.config['TOKEN_KEYS'] = { '2' : 'NewKey' }
+        r = list_packages(client, token, {})
+        assert response_codes.UNAUTHORIZED == r.status_code
+        assert b'Invalid Token' in r.data
+
+        flask_package_mgr.app.config['TOKEN_TTL'] = -1
+        expired_token = add_base_user_and_get_token(client, add_user=False)
+        r = list_packages(client, expired_token, {})
+        assert response_codes.UNAUTHORIZED == r.status_code
+        assert b'Token has expired' in r.data
+    finally:
+        flask_package_mgr.app.config['TOKEN_KEYS'] = None
+        flask_package_mgr.app.config['TOKEN_KEY_ID'] = '1'
+        flask_package_mgr.app.config['TOKEN_TTL'] = 24 * 60 * 60
+
+def test_apikeys(client):
+    token = add_base_user_and_get_token(client)
+    r = client.post(
+            '/api/v1/user/apikeys',
+            data=json.dumps({ 'name' : 'ci' }),
+            headers={ 'token' : token },
+            content_type='application/json'
+            )
+    assert 200 == r.status_code
+    issued = json.loads(r.data)
+    assert issued['apikey'].startswith(issued['prefix'] + '.')
+    apikey_headers = { 'Authorization' : 'ApiKey ' + issued['apikey'] }
+
+    # only the prefix and a hash of the secret are stored
+    with flask_package_mgr.app.app_context():
+        stored = flask_package_mgr.get_db().execute("SELECT prefix, key_hash FROM apikeys").fetchall()
+    assert [ issued['prefix'] ] == [ row['prefix'] for row in stored ]
+    assert issued['apikey'].split('.')[1] not in stored[0]['key_hash']
+
+    r = add_package(client, None, 'test', '1.0', headers=apikey_headers)
+    assert 200 == r.status_code
+    for attempt in range(2):
+        r = client.get(
+                '/api/v1/packages',
+                headers=apikey_headers,
+                data=json.dumps({}),
+                content_type='application/json'
+                )
+        assert 200 == r.status_code
+    with flask_package_mgr.app.app_context():
+        stats = flask_package_mgr.get_pool_stats()['apikey_cache']
+        assert 1 == stats['misses']
+        assert 2 == stats['hits']
+
+    r = client.get(
+            '/api/v1/user/apikeys',
+            headers=apikey_headers,
+            data=json.dumps({}),
+            content_type='application/json'
+            )
+    assert 200 == r.status_code
+    listed = json.loads(r.data)
+    assert 1 == len(listed)
+    assert 'ci' == listed[0]['name']
+    assert 'key_hash' not in listed[0]
+
+    # an api key authenticates, but there is no token to invalidate
+    r = client.post(
+            '/api/v1/user/invalidate_token',
+            data=json.dumps({ 'username' : 'nweaver', 'password' : 'password' }),
+            headers=apikey_headers,
+            content_type='application/json'
+            )
+    assert response_codes.INVALID_USE == r.status_code
+    assert b'Token not provided' in r.data
+
+    r = client.delete(
+            '/api/v1/user/apikeys/' + issued['prefix'],
+            headers={ 'token' : token },
+            content_type='application/json'
+            )
+    assert 200 == r.status_code
+    assert b'apikey has been revoked' in r.data
+
+    r = add_package(client, None, 'test', '2.0', headers=apikey_headers)
+    assert response_codes.UNAUTHORIZED == r.status_code
+    assert b'Invalid ApiKey' in r.data
+
+    r = client.delete(
+            '/api/v1/user/apikeys/' + issued['prefix'],
+            headers={ 'token' : token },
+            content_type='application/json'
+            )
+    assert response_codes.NOT_FOUND == r.status_code
+
+def test_rate_limits(client):
+    token = add_base_user_and_get_token(client)
+    flask_package_mgr.app.config['RATELIMIT_ENABLED'] = True
+    flask_package_mgr.app.config['RATELIMIT_LIMITS'] = {
+            'upload_bytes' : (1, 10),
+            'downloads' : (1, 5),
+            'searches' : (0.1, 2)
+            }
+    try:
+        r = list_packages(client, token, {})
+        assert 200 == r.status_code
+        assert '2' == r.headers['RateLimit-Limit']
+        assert '1' == r.headers['RateLimit-Remaining']
+        assert 200 == list_packages(client, token, {}).status_code
+        r = list_packages(client, token, {})
+        assert response_codes.TOO_MANY_REQUESTS == r.status_code
+        assert b'searches rate limit exceeded' in r.data
+        assert '10' == r.headers['Retry-After']
+
+        # uploads bigger than the burst wait for a full bucket
+        assert 200 == add_package(client, token, 'test', '1.0').status_code
+        r = add_package(client, token, 'test', '2.0', new_filename='test2.txt')
+        assert response_codes.TOO_MANY_REQUESTS == r.status_code
+        assert b'upload_bytes rate limit exceeded' in r.data
+
+        # limits can be raised for a single user
+        flask_package_mgr.app.config['RATELIMIT_USER_LIMITS'] = {
+                1 : { 'searches' : (100, 100), 'upload_bytes' : (1000000, 1000000), 'max_concurrent_uploads' : 1 }
+                }
+        assert 200 == list_packages(client, token, {}).status_code
+
+        with flask_package_mgr.app.app_context():
+            from flask_package_mgr.ratelimit import get_rate_limiter
+            limiter = get_rate_limiter()
+            assert limiter.acquire_upload(1)
+        charged = limiter.get_stats()['upload_bytes']
+        r = add_package(client, token, 'test', '2.0', new_filename='test2.txt')
+        assert response_codes.TOO_MANY_REQUESTS == r.status_code
+        assert b'too many uploads in progress' in r.data
+        # an upload turned away for concurrency is not charged to the byte budget
+        assert charged == limiter.get_stats()['upload_bytes']
+        limiter.release_upload(1)
+        assert 200 == add_package(client, token, 'test', '2.0', new_filename='test2.txt').status_code
+        assert 0 == limiter.get_stats()['uploads_in_progress']
+    finally:
+        flask_package_mgr.app.config['RATELIMIT_ENABLED'] = False
+        flask_package_mgr.app.config['RATELIMIT_USER_LIMITS'] = {}
+        flask_package_mgr.app.config['RATELIMIT_LIMITS'] = {
+            'upload_bytes' : (10 * 1024 * 1024, 100 * 1024 * 1024),
+            'downloads' : (10, 50),
+            'searches' : (10, 50)
+            }
 
 def test_file_post(client):
     token = add_base_user_and_get_token(client)
@@ -500,8 +860,8 @@ def test_file_post(client):
     assert 200==r.status_code
     assert 'test' not in r.data
 
-def add_package(client, token, package_name, tag, new_filename='test.txt'):
-    token_data = { 'token' : token }
+def add_package(client, token, package_name, tag, new_filename='test.txt', headers=None):
+    token_data = headers or { 'token' : token }
 
     package_post_data = {
             "package_name" : package_name,
@@ -596,6 +956,127 @@ def test_multi_post_fail(client):
     assert 'package_id' in resp
     assert resp['package_id'] == 1
 
+def test_multi_post_fail_leaves_no_rows(client):
+    token = add_base_user_and_get_token(client)
+    r = add_package(client, token, 'test', '1.0')
+    assert 200 == r.status_code
+
+    r = add_package(client, token, 'test', '1.0', 'test2.txt')
+    assert response_codes.CONFLICT == r.status_code
+    assert 'tag is already in use' in r.data
+
+    with flask_package_mgr.app.app_context():
+        filestore = flask_package_mgr.get_db().execute('SELECT package_filepath, digest, refcount FROM filestore').fetchall()
+        packages = flask_package_mgr.get_db().execute('SELECT title FROM packages').fetchall()
+    assert 1 == len(filestore)
+    assert filestore[0]['package_filepath'].endswith(filestore[0]['digest'])
+    assert 1 == filestore[0]['refcount']
+    assert 1 == len(packages)
+    uploads_tmp = os.path.join(flask_package_mgr.app.config['UPLOAD_FOLDER'], 'blobs', 'tmp')
+    assert [] == os.listdir(uploads_tmp)
+
+def test_group_commit_concurrent_publishes(client):
+    from flask_package_mgr.package_database import store_package_rows
+    from flask_package_mgr.error_handlers import IntegrityError
+    from flask_package_mgr.blobstore import temp_blob, blob_path
+
+    flask_package_mgr.app.config['GROUP_COMMIT'] = True
+    flask_package_mgr.app.config['GROUP_COMMIT_MAX_WAIT'] = 0.05
+    try:
+        token = add_base_user_and_get_token(client)
+        r = add_package(client, token, 'test', '1.0')
+        assert 200 == r.status_code
+
+        results = {}
+        def publish(i, tag):
+            with flask_package_mgr.app.app_context():
+                upload_folder = flask_package_mgr.app.config['UPLOAD_FOLDER']
+                fd, tmp_path = temp_blob(upload_folder)
+                os.close(fd)
+                digest = '{i:064x}'.format(i=i)
+                try:
+                    results[i] = store_package_rows(
+                                    package_name='test',
+                                    user=1,
+                                    filename='file{i}.txt'.format(i=i),
+                                    digest=digest,
+                                    size=0,
+                                    blob_path=blob_path(upload_folder, digest),
+                                    tmp_path=tmp_path,
+                                    tag=tag
+                                    )
+                except IntegrityError as err:
+                    results[i] = err
+
+        threads = [ threading.Thread(target=publish, args=(i, '2.{i}'.format(i=i))) for i in range(8) ]
+        threads.append(threading.Thread(target=publish, args=(8, '1.0')))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for i in range(8):
+            assert 1 == results[i]['package_id']
+        assert isinstance(results[8], IntegrityError)
+        assert 'tag is already in use for package' == results[8].message
+
+        r = get_package_tag_info(client, token, 'test')
+        assert 9 == len(json.loads(r.data))
+
+        r = client.get('/api/v1/admin/stats')
+        group_stats = json.loads(r.data)['group_commit']
+        assert 10 == group_stats['submitted']
+        assert 1 == group_stats['failed_writes']
+        assert 10 == group_stats['batch_size']['sum']
+        assert group_stats['batch_size']['count'] < 10
+    finally:
+        flask_package_mgr.app.config['GROUP_COMMIT'] = False
+        flask_package_mgr.app.config['GROUP_COMMIT_MAX_WAIT'] = 0.002
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+
+def test_rolled_back_publish(client, monkeypatch):
+    from flask_package_mgr import package_database
+    from flask_package_mgr.blobstore import temp_blob, blob_path
+
+    write_package_rows = package_database.write_package_rows
+    def write_then_fail(db, **kwargs):
+        # the blob is linked in before the commit, which then fails
+        write_package_rows(db, **kwargs)
+        raise sqlite3.OperationalError('disk I/O error')
+    monkeypatch.setattr(package_database, 'write_package_rows', write_then_fail)
+
+    token = add_base_user_and_get_token(client)
+    upload_folder = flask_package_mgr.app.config['UPLOAD_FOLDER']
+    try:
+        for i, group_commit in enumerate((False, True)):
+            flask_package_mgr.app.config['GROUP_COMMIT'] = group_commit
+            with flask_package_mgr.app.app_context():
+                fd, tmp_path = temp_blob(upload_folder)
+                os.write(fd, 'rolled back')
+                os.close(fd)
+                digest = '{i:064x}'.format(i=i + 1)
+                with pytest.raises(package_database.UnhandledError):
+                    package_database.store_package_rows(
+                            package_name='test',
+                            user=1,
+                            filename='test.txt',
+                            digest=digest,
+                            size=11,
+                            blob_path=blob_path(upload_folder, digest),
+                            tmp_path=tmp_path,
+                            tag='1.0'
+                            )
+                # nothing was stored, the upload is back where it was
+                assert not os.path.exists(blob_path(upload_folder, digest))
+                assert os.path.exists(tmp_path)
+                os.remove(tmp_path)
+                assert 0 == flask_package_mgr.get_db().execute('SELECT COUNT(*) FROM filestore').fetchone()[0]
+    finally:
+        flask_package_mgr.app.config['GROUP_COMMIT'] = False
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+
 def test_post_fail(client):
     token = add_base_user_and_get_token(client)
     token_data = { 'token' : token }
@@ -980,6 +1461,177 @@ def test_file_package_get(client):
     resp = json.loads(r.data)
     assert len(resp) == 0
 
+def test_search_ranked_with_limit(client):
+    token = add_base_user_and_get_token(client)
+    for name, filename in [('libfoo-extras', 'test.txt'), ('foo', 'test2.txt'), ('bar', 'test3.txt'), ('FooBar', 'test4.txt')]:
+        r = add_package(client, token, name, '1.0', filename)
+        assert 200 == r.status_code
+
+    token_data = { 'token' : token }
+    r = client.get(
+            '/api/v1/packages',
+            headers=token_data,
+            data=json.dumps({'search' : 'foo'}),
+            content_type='application/json'
+            )
+    assert 200 == r.status_code
+    resp = json.loads(r.data)
+    assert 3 == len(resp)
+    # shortest title containing the term ranks first
+    assert 'foo' == resp[0]['title']
+
+    r = client.get(
+            '/api/v1/packages',
+            headers=token_data,
+            data=json.dumps({'search' : 'foo', 'limit' : 2}),
+            content_type='application/json'
+            )
+    assert 200 == r.status_code
+    assert 2 == len(json.loads(r.data))
+
+    r = client.get(
+            '/api/v1/packages',
+            headers=token_data,
+            data=json.dumps({'search' : 'foo', 'limit' : 0}),
+            content_type='application/json'
+            )
+    assert response_codes.INVALID_USE == r.status_code
+    assert 'limit must be a positive integer' in r.data
+
+    r = add_package(client, token, 'foo', '1.10', 'test5.txt')
+    assert 200 == r.status_code
+    r = get_package_tag_info(client, token, 'foo', '1.1')
+    assert 200 == r.status_code
+    resp = json.loads(r.data)
+    assert 1 == len(resp)
+    assert '1.10' == resp[0]['tag']
+
+def list_packages(client, token, get_data):
+    r = client.get(
+            '/api/v1/packages',
+            headers={ 'token' : token },
+            data=json.dumps(get_data),
+            content_type='application/json'
+            )
+    return r
+
+def test_packages_keyset_pages(client):
+    token = add_base_user_and_get_token(client)
+    names = ['p{i}'.format(i=i) for i in range(5)]
+    for name in names:
+        r = add_package(client, token, name, '1.0')
+        assert 200 == r.status_code
+
+    seen = []
+    get_data = { 'limit' : 2 }
+    while True:
+        r = list_packages(client, token, get_data)
+        assert 200 == r.status_code
+        seen.extend(p['title'] for p in json.loads(r.data))
+        if 'X-Next-Cursor' not in r.headers:
+            break
+        get_data['cursor'] = int(r.headers['X-Next-Cursor'])
+    assert names == seen
+
+    r = list_packages(client, token, { 'cursor' : 3 })
+    assert ['p3', 'p4'] == [p['title'] for p in json.loads(r.data)]
+    assert 'X-Next-Cursor' not in r.headers
+
+def test_rows_serialized_at_the_boundary(client):
+    from flask_package_mgr.blueprints.routes import rows_to_dicts, stream_response
+
+    token = add_base_user_and_get_token(client)
+    for i in range(5):
+        assert 200 == add_package(client, token, 'p{i}'.format(i=i), '1.0').status_code
+    with flask_package_mgr.app.test_request_context():
+        # lookups get rows indexed by column name, no dict is built for them
+        rows = flask_package_mgr.get_read_db().execute('SELECT id, title FROM packages ORDER BY id').fetchall()
+        assert all(isinstance(row, sqlite3.Row) for row in rows)
+        assert 'p0' == rows[0]['title']
+
+        converted = rows_to_dicts(rows)
+        assert converted is rows
+        assert [ { 'id' : i + 1, 'title' : 'p{i}'.format(i=i) } for i in range(5) ] == converted
+        assert [] == rows_to_dicts([])
+
+        # chunks are joined into one json array whatever their size
+        rows = flask_package_mgr.get_read_db().execute('SELECT id, title FROM packages ORDER BY id').fetchall()
+        for chunk_rows in (1, 2, 5, 500):
+            response = stream_response(iter(rows), chunk_rows=chunk_rows)
+            assert converted == json.loads(''.join(response.response))
+
+def test_listing_stream(client):
+    token = add_base_user_and_get_token(client)
+    flask_package_mgr.app.config['LIST_BATCH_SIZE'] = 2
+    try:
+        for i in range(5):
+            r = add_package(client, token, 'p{i}'.format(i=i), '1.0')
+            assert 200 == r.status_code
+            r = add_package(client, token, 'test', '1.{i}'.format(i=i), 'test{i}.txt'.format(i=i))
+            assert 200 == r.status_code
+
+        r = list_packages(client, token, { 'stream' : True })
+        assert 200 == r.status_code
+        assert 'application/json' == r.mimetype
+        resp = json.loads(r.data)
+        assert ['p0', 'test', 'p1', 'p2', 'p3', 'p4'] == [p['title'] for p in resp]
+
+        r = list_packages(client, token, { 'stream' : True, 'cursor' : 2, 'limit' : 3 })
+        assert ['p1', 'p2', 'p3'] == [p['title'] for p in json.loads(r.data)]
+
+        r = client.get(
+                '/api/v1/packages/test',
+                headers={ 'token' : token },
+                data=json.dumps({ 'stream' : True }),
+                content_type='application/json'
+                )
+        assert 200 == r.status_code
+        assert ['1.0', '1.1', '1.2', '1.3', '1.4'] == [t['tag'] for t in json.loads(r.data)]
+
+        r = client.get(
+                '/api/v1/packages/unknown',
+                headers={ 'token' : token },
+                data=json.dumps({ 'stream' : True }),
+                content_type='application/json'
+                )
+        assert response_codes.NOT_FOUND == r.status_code
+
+        r = client.get('/api/v1/admin/user_list?stream=true')
+        assert 200 == r.status_code
+        assert 'nweaver' == json.loads(r.data)[0]['username']
+
+        r = client.get('/api/v1/admin/user_list?limit=1&cursor=1')
+        assert 200 == r.status_code
+        assert [] == json.loads(r.data)
+    finally:
+        flask_package_mgr.app.config['LIST_BATCH_SIZE'] = 500
+
+def test_search_like_fallback(client):
+    flask_package_mgr.app.config['SEARCH_FTS'] = False
+    try:
+        token = add_base_user_and_get_token(client)
+        for name, filename in [('libfoo-extras', 'test.txt'), ('foo', 'test2.txt'), ('bar', 'test3.txt')]:
+            r = add_package(client, token, name, '1.0', filename)
+            assert 200 == r.status_code
+        r = add_package(client, token, 'foo', '1.10', 'test3.txt')
+        assert 200 == r.status_code
+
+        token_data = { 'token' : token }
+        r = client.get(
+                '/api/v1/packages',
+                headers=token_data,
+                data=json.dumps({'search' : 'foo'}),
+                content_type='application/json'
+                )
+        assert 200 == r.status_code
+        assert 2 == len(json.loads(r.data))
+
+        r = get_package_tag_info(client, token, 'foo', '1.1')
+        assert 200 == r.status_code
+        assert 1 == len(json.loads(r.data))
+    finally:
+        flask_package_mgr.app.config['SEARCH_FTS'] = True
+
 def test_file_package_get_fail(client):
     token = add_base_user_and_get_token(client)
     
@@ -1228,6 +1880,137 @@ def test_file_package_get_fail_2(client):
     assert response_codes.NOT_FOUND == r.status_code
     assert 'could not locate tag for package' in r.data
 
+def test_file_package_get_fail_3(client):
+    token = add_base_user_and_get_token(client)
+    r = add_package(client, token, 'test', '1.0')
+    assert 200 == r.status_code
+
+    # a tag whose filestore row has gone missing
+    with flask_package_mgr.app.app_context():
+        db = flask_package_mgr.get_db()
+        db.execute("INSERT INTO tags (tag, package_id, filestore_id) VALUES ('1.1', 1, 99)")
+        db.commit()
+
+    r, response = get_package(client, token, 'test', '1.1')
+    assert response_codes.NOT_FOUND == r.status_code
+    assert 'could not locate file for package' in r.data
+
+def test_filepath_cache(client):
+    token = add_base_user_and_get_token(client)
+    r = add_package(client, token, 'test', '1.0')
+    assert 200 == r.status_code
+
+    for attempt in range(3):
+        r, response = get_package(client, token, 'test', '1.0')
+        assert 200 == r.status_code
+
+    with flask_package_mgr.app.app_context():
+        stats = flask_package_mgr.get_pool_stats()['filepath_cache']
+        assert 1 == stats['misses']
+        assert 2 == stats['hits']
+        assert 1 == stats['entries']
+
+        # removing the tag drops its cached resolution
+        from flask_package_mgr.package_database import delete_dangling_tag
+        assert delete_dangling_tag(1)
+        stats = flask_package_mgr.get_pool_stats()['filepath_cache']
+        assert 0 == stats['entries']
+        assert 1 == stats['invalidations']
+
+    r, response = get_package(client, token, 'test', '1.0')
+    assert response_codes.NOT_FOUND == r.status_code
+
+def test_missing_lookups_short_circuit(client, monkeypatch):
+    from flask_package_mgr import package_database
+
+    token = add_base_user_and_get_token(client)
+    r = add_package(client, token, 'test', '1.0')
+    assert 200 == r.status_code
+
+    for attempt in range(2):
+        r, response = get_package(client, token, 'nothere', '1.0')
+        assert response_codes.NOT_FOUND == r.status_code
+        assert 'could not locate package' in r.data
+
+        r, response = get_package(client, token, 'test', '2.0')
+        assert response_codes.NOT_FOUND == r.status_code
+        assert 'could not locate tag for package' in r.data
+
+    with flask_package_mgr.app.app_context():
+        stats = flask_package_mgr.get_pool_stats()
+        assert 2 == stats['package_filter']['rejected']
+        assert 1 == stats['negative_cache']['hits']
+
+    # publishing the missing tag clears the cached miss straight away
+    r = add_package_filename(client, token, 'test', '2.0', new_filename='test2.txt')
+    assert 200 == r.status_code
+    r, response = get_package(client, token, 'test', '2.0')
+    assert 200 == r.status_code
+
+    # hits and known misses cost no query beyond the lookup itself
+    queries = []
+    query_db = package_database.query_db
+    def counted_query_db(query, *args, **kwargs):
+        queries.append(query)
+        return query_db(query, *args, **kwargs)
+    monkeypatch.setattr(package_database, 'query_db', counted_query_db)
+    flask_package_mgr.app.config['FILEPATH_CACHE_ENABLED'] = False
+    try:
+        assert 200 == get_package(client, token, 'test', '2.0')[0].status_code
+        assert 1 == len(queries)
+        del queries[:]
+        assert response_codes.NOT_FOUND == get_package(client, token, 'nothere', '1.0')[0].status_code
+        assert response_codes.NOT_FOUND == get_package(client, token, 'test', '3.0')[0].status_code
+        assert response_codes.NOT_FOUND == get_package(client, token, 'test', '3.0')[0].status_code
+        assert 1 == len(queries)
+    finally:
+        flask_package_mgr.app.config['FILEPATH_CACHE_ENABLED'] = True
+
+    # publishes by other processes, which this one's filter and cache never heard of, are
+    # picked up once the filter is refreshed and the misses have expired
+    flask_package_mgr.app.config['NEGATIVE_CACHE_TTL'] = 0.2
+    flask_package_mgr.app.config['PACKAGE_FILTER_REFRESH'] = 0.2
+    try:
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+        for attempt in range(2):
+            assert response_codes.NOT_FOUND == get_package(client, token, 'elsewhere', '1.0')[0].status_code
+            assert response_codes.NOT_FOUND == get_package(client, token, 'test', '3.0')[0].status_code
+        with flask_package_mgr.app.app_context():
+            db = flask_package_mgr.get_db()
+            db.execute("INSERT INTO packages (title, user_id) VALUES ('elsewhere', 1)")
+            db.execute("INSERT INTO tags (tag, package_id, filestore_id, filename) SELECT '1.0', packages.id, 1, 'test.txt' FROM packages WHERE title = 'elsewhere'")
+            db.execute("INSERT INTO tags (tag, package_id, filestore_id, filename) SELECT '3.0', packages.id, 1, 'test3.txt' FROM packages WHERE title = 'test'")
+            db.commit()
+        sleep(0.3)
+        assert 200 == get_package(client, token, 'elsewhere', '1.0')[0].status_code
+        assert 200 == get_package(client, token, 'test', '3.0')[0].status_code
+    finally:
+        flask_package_mgr.app.config['NEGATIVE_CACHE_TTL'] = 5
+        flask_package_mgr.app.config['PACKAGE_FILTER_REFRESH'] = 5
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+
+def test_cache_generation():
+    from flask_package_mgr.cache import LRUCache
+    cache = LRUCache(size=4)
+    # a value read before an invalidation is not cached
+    generation = cache.generation
+    cache.invalidate_where(lambda key, value: False)
+    cache.put('stale', True, generation=generation)
+    assert cache.get('stale') is None
+    cache.put('fresh', True, generation=cache.generation)
+    assert cache.get('fresh')
+
+def test_bloom_filter_error_rate():
+    from flask_package_mgr.cache import BloomFilter
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add('package{i}'.format(i=i))
+    assert all('package{i}'.format(i=i) in bloom for i in range(1000))
+    false_positives = sum(1 for i in range(10000) if 'other{i}'.format(i=i) in bloom)
+    assert false_positives < 300
+
 def add_package_filename(client, token, package_name, tag, new_filename='test.txt', local_filename='test.txt'):
     token_data = { 'token' : token }
 
@@ -1257,6 +2040,730 @@ def add_package_filename(client, token, package_name, tag, new_filename='test.tx
             )
     return r;
 
+def test_blob_dedup(client):
+    token = add_base_user_and_get_token(client)
+    assert 200 == add_package(client, token, 'test', '1.0').status_code
+    assert 200 == add_package(client, token, 'test', '2.0', 'test2.txt').status_code
+    assert 200 == add_package(client, token, 'fork', '1.0').status_code
+
+    with flask_package_mgr.app.app_context():
+        filestore = flask_package_mgr.get_db().execute('SELECT package_filepath, digest, size, refcount FROM filestore').fetchall()
+    assert 1 == len(filestore)
+    assert 3 == filestore[0]['refcount']
+    assert os.path.getsize(test_filenames[0]) == filestore[0]['size']
+    digest = filestore[0]['digest']
+
+    # each tag still downloads under the name it was uploaded as
+    r, response = get_package(client, token, 'test', '2.0')
+    assert 200 == r.status_code
+    assert 'filename=test2.txt' in r.headers['Content-Disposition']
+    assert r.headers['Content-Location'].endswith('/api/v1/blobs/' + digest)
+    assert open(test_filenames[0]).read() == r.data
+
+    r = client.get('/api/v1/blobs/' + digest, headers={ 'token' : token })
+    assert 200 == r.status_code
+    assert open(test_filenames[0]).read() == r.data
+    assert 'immutable' in r.headers['Cache-Control']
+    assert '"{d}"'.format(d=digest) == r.headers['ETag']
+
+    r = client.get('/api/v1/blobs/' + digest, headers={ 'token' : token, 'If-None-Match' : '"{d}"'.format(d=digest) })
+    assert 304 == r.status_code
+
+    r = client.get('/api/v1/blobs/' + '0' * 64, headers={ 'token' : token })
+    assert response_codes.NOT_FOUND == r.status_code
+    r = client.get('/api/v1/blobs/notadigest', headers={ 'token' : token })
+    assert response_codes.INVALID_USE == r.status_code
+    r = client.get('/api/v1/blobs/' + digest)
+    assert response_codes.UNAUTHORIZED == r.status_code
+
+def test_streamed_upload(client):
+    from flask_package_mgr import filestore
+    import hashlib
+
+    token = add_base_user_and_get_token(client)
+    uploads_tmp = os.path.join(flask_package_mgr.app.config['UPLOAD_FOLDER'], 'blobs', 'tmp')
+    # spans several reads of the multipart parser
+    content = os.urandom(300 * 1024)
+    with open(test_filenames[1], 'wb') as f:
+        f.write(content)
+
+    def copy_to_blob(stream, upload_folder):
+        raise AssertionError('upload was not streamed into the blob store')
+    original = filestore.copy_to_blob
+    filestore.copy_to_blob = copy_to_blob
+    try:
+        r = add_package_filename(client, token, 'test', '1.0', local_filename=test_filenames[1])
+        assert 200 == r.status_code
+        assert hashlib.sha256(content).hexdigest() == json.loads(r.data)['digest']
+        assert [] == os.listdir(uploads_tmp)
+
+        # a rejected upload was streamed too, its temporary file goes with the request
+        r = add_package_filename(client, token, 'test', '2.0', new_filename='test.xfd', local_filename=test_filenames[1])
+        assert response_codes.INVALID_USE == r.status_code
+        assert [] == os.listdir(uploads_tmp)
+    finally:
+        filestore.copy_to_blob = original
+
+    r, response = get_package(client, token, 'test', '1.0')
+    assert 200 == r.status_code
+    assert content == r.data
+
+def test_resumable_upload(client):
+    import hashlib
+
+    token = add_base_user_and_get_token(client)
+    headers = { 'token' : token }
+    content = os.urandom(3000)
+    def put_chunk(upload_id, start, end):
+        return client.put(
+                '/api/v1/uploads/' + upload_id,
+                headers={ 'token' : token, 'Content-Range' : 'bytes {s}-{e}/{n}'.format(s=start, e=end - 1, n=len(content)) },
+                data=content[start:end],
+                content_type='application/octet-stream'
+                )
+
+    r = client.post('/api/v1/uploads', headers=headers, content_type='application/json', data=json.dumps({
+                'package_name' : 'test', 'tag' : '1.0', 'filename' : 'big.txt', 'size' : len(content),
+                'digest' : hashlib.sha256(content).hexdigest()
+                }))
+    assert 200 == r.status_code
+    upload_id = json.loads(r.data)['upload_id']
+
+    # out of order, the middle chunk is still missing
+    assert 200 == put_chunk(upload_id, 2000, 3000).status_code
+    r = put_chunk(upload_id, 0, 1000)
+    assert [ [ 0, 1000 ], [ 2000, 3000 ] ] == json.loads(r.data)['received']
+    r = client.post('/api/v1/uploads/{u}/commit'.format(u=upload_id), headers=headers, content_type='application/json')
+    assert response_codes.INVALID_USE == r.status_code
+    assert 'upload is incomplete' in r.data
+    assert response_codes.INVALID_USE == put_chunk(upload_id, 2500, 3001).status_code
+
+    assert 200 == put_chunk(upload_id, 500, 2500).status_code
+    r = client.get('/api/v1/uploads/' + upload_id, headers=headers, content_type='application/json')
+    status = json.loads(r.data)
+    assert [ [ 0, 3000 ] ] == status['received']
+    assert status['complete']
+
+    r = client.post('/api/v1/uploads/{u}/commit'.format(u=upload_id), headers=headers, content_type='application/json')
+    assert 200 == r.status_code
+    assert hashlib.sha256(content).hexdigest() == json.loads(r.data)['digest']
+    r = client.get('/api/v1/uploads/' + upload_id, headers=headers, content_type='application/json')
+    assert response_codes.NOT_FOUND == r.status_code
+
+    r, response = get_package(client, token, 'test', '1.0')
+    assert 200 == r.status_code
+    assert 'filename=big.txt' in r.headers['Content-Disposition']
+    assert content == r.data
+    uploads_tmp = os.path.join(flask_package_mgr.app.config['UPLOAD_FOLDER'], 'blobs', 'tmp')
+    assert [] == os.listdir(uploads_tmp)
+
+def test_upload_chunk_holds_no_connection(client):
+    from flask import g
+    from flask_package_mgr.upload_sessions import write_upload_chunk
+
+    token = add_base_user_and_get_token(client)
+    r = client.post('/api/v1/uploads', headers={ 'token' : token }, content_type='application/json', data=json.dumps({
+                'package_name' : 'test', 'tag' : '1.0', 'filename' : 'big.txt', 'size' : 10
+                }))
+    upload_id = json.loads(r.data)['upload_id']
+
+    class SlowStream(object):
+        # a client still sending its chunk, other requests need the connections meanwhile
+        def read(self, size):
+            assert not hasattr(g, 'sqlite_db')
+            assert not hasattr(g, 'sqlite_read_db')
+            return '0123456789'[:size]
+
+    flask_package_mgr.app.config['DATABASE_WAL'] = True
+    try:
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+            status = write_upload_chunk(upload_id, 1, 'bytes 0-9/10', 10, SlowStream())
+            assert [ [ 0, 10 ] ] == status['received']
+    finally:
+        flask_package_mgr.app.config['DATABASE_WAL'] = False
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.close_pool()
+
+def test_upload_sessions_expire(client):
+    from flask_package_mgr.upload_sessions import expire_upload_sessions, session_path
+
+    token = add_base_user_and_get_token(client)
+    headers = { 'token' : token }
+    upload_ids = []
+    for tag in ('1.0', '2.0'):
+        r = client.post('/api/v1/uploads', headers=headers, content_type='application/json', data=json.dumps({
+                    'package_name' : 'test', 'tag' : tag, 'filename' : 'test.txt', 'size' : 10
+                    }))
+        assert 200 == r.status_code
+        upload_ids.append(json.loads(r.data)['upload_id'])
+
+    r = client.delete('/api/v1/uploads/' + upload_ids[0], headers=headers, content_type='application/json')
+    assert 200 == r.status_code
+    with flask_package_mgr.app.app_context():
+        assert not os.path.exists(session_path(upload_ids[0]))
+        assert os.path.exists(session_path(upload_ids[1]))
+        assert 0 == expire_upload_sessions()
+        later = time.time() + flask_package_mgr.app.config['UPLOAD_SESSION_TTL'] + 1
+        # sessions being committed or written to are not expired from under their request
+        db = flask_package_mgr.get_db()
+        for state, writers in (('committing', 0), ('open', 1)):
+            db.execute('UPDATE upload_sessions SET state = ?, writers = ? WHERE id = ?', [ state, writers, upload_ids[1] ])
+            db.commit()
+            assert 0 == expire_upload_sessions(now=later)
+            assert os.path.exists(session_path(upload_ids[1]))
+        db.execute("UPDATE upload_sessions SET state = 'open', writers = 0 WHERE id = ?", [ upload_ids[1] ])
+        db.commit()
+        assert 1 == expire_upload_sessions(now=later)
+        assert not os.path.exists(session_path(upload_ids[1]))
+    r = client.get('/api/v1/uploads/' + upload_ids[1], headers=headers, content_type='application/json')
+    assert response_codes.NOT_FOUND == r.status_code
+
+def test_conditional_and_range_downloads(client):
+    token = add_base_user_and_get_token(client)
+    assert 200 == add_package(client, token, 'test', '1.0').status_code
+    content = open(test_filenames[0], 'rb').read()
+    url = '/api/v1/packages/test/1.0'
+    def download(**headers):
+        headers['token'] = token
+        return client.get(url, headers=headers, data=json.dumps({}), content_type='application/json')
+
+    r = download()
+    assert 200 == r.status_code
+    etag = r.headers['ETag']
+    assert etag.strip('"') == r.headers['Content-Location'].rsplit('/', 1)[1]
+    assert 'bytes' == r.headers['Accept-Ranges']
+    assert 'private, no-cache' == r.headers['Cache-Control']
+
+    assert 304 == download(**{ 'If-None-Match' : etag }).status_code
+    assert 304 == download(**{ 'If-Modified-Since' : r.headers['Last-Modified'] }).status_code
+    # a matching ETag wins over a Range
+    assert 304 == download(**{ 'If-None-Match' : etag, 'Range' : 'bytes=0-3' }).status_code
+    assert 200 == download(**{ 'If-None-Match' : '"other"' }).status_code
+
+    r = download(Range='bytes=5-8')
+    assert 206 == r.status_code
+    assert content[5:9] == r.data
+    assert 'bytes 5-8/{n}'.format(n=len(content)) == r.headers['Content-Range']
+
+    r = download(Range='bytes=-4')
+    assert 206 == r.status_code
+    assert content[-4:] == r.data
+
+    # a stale If-Range gets the whole file
+    r = download(**{ 'Range' : 'bytes=5-8', 'If-Range' : '"other"' })
+    assert 200 == r.status_code
+    assert content == r.data
+
+    r = download(Range='bytes=0-1,4-5,5-6')
+    assert 206 == r.status_code
+    assert r.headers['Content-Type'].startswith('multipart/byteranges; boundary=')
+    boundary = r.headers['Content-Type'].split('boundary=')[1]
+    assert int(r.headers['Content-Length']) == len(r.data)
+    parts = r.data.split('--' + boundary)
+    assert 4 == len(parts)
+    assert parts[1].endswith('\r\n\r\n' + content[0:2] + '\r\n')
+    assert 'Content-Range: bytes 4-6/{n}'.format(n=len(content)) in parts[2]
+    assert parts[2].endswith('\r\n\r\n' + content[4:7] + '\r\n')
+    assert '--\r\n' == parts[3]
+
+    assert 416 == download(Range='bytes=1000-2000,3000-4000').status_code
+    assert 416 == download(Range='bytes=1000-2000').status_code
+
+    flask_package_mgr.app.config['DOWNLOAD_MAX_RANGES'] = 2
+    try:
+        r = download(Range='bytes=0-1,3-4,6-7')
+        assert 200 == r.status_code
+        assert content == r.data
+    finally:
+        flask_package_mgr.app.config['DOWNLOAD_MAX_RANGES'] = 16
+
+def test_download_offload(client):
+    token = add_base_user_and_get_token(client)
+    assert 200 == add_package(client, token, 'test', '1.0').status_code
+    with flask_package_mgr.app.app_context():
+        path = flask_package_mgr.get_db().execute('SELECT package_filepath FROM filestore').fetchone()['package_filepath']
+    upload_folder = os.path.abspath(flask_package_mgr.app.config['UPLOAD_FOLDER'])
+
+    try:
+        flask_package_mgr.app.config['DOWNLOAD_MODE'] = 'x-sendfile'
+        r, response = get_package(client, token, 'test', '1.0')
+        assert 200 == r.status_code
+        assert path == r.headers['X-Sendfile']
+        assert '' == r.data
+        assert 'filename=test.txt' in r.headers['Content-Disposition']
+
+        flask_package_mgr.app.config['DOWNLOAD_MODE'] = 'x-accel-redirect'
+        r, response = get_package(client, token, 'test', '1.0')
+        assert 200 == r.status_code
+        assert '/protected/' + os.path.relpath(path, upload_folder) == r.headers['X-Accel-Redirect']
+        assert '' == r.data
+
+        # a client that already has the file is answered without the proxy
+        r = client.get('/api/v1/packages/test/1.0', data=json.dumps({}), content_type='application/json',
+                headers={ 'token' : token, 'If-None-Match' : r.headers['ETag'] })
+        assert 304 == r.status_code
+        assert 'X-Accel-Redirect' not in r.headers
+
+        # files on another volume are served from that volume's location
+        stored = path
+        volume_a = tempfile.mkdtemp()
+        volume_b = tempfile.mkdtemp()
+        flask_package_mgr.app.config['STORAGE_VOLUMES'] = [
+            { 'name' : 'fast', 'path' : volume_a },
+            { 'name' : 'slow', 'path' : volume_b, 'weight' : 0, 'accel_prefix' : '/slow/' }
+            ]
+        try:
+            with open(test_filenames[1], 'wb') as f:
+                f.write('stored on a volume')
+            assert 200 == add_package_filename(client, token, 'volume', '1.0', local_filename=test_filenames[1]).status_code
+            with flask_package_mgr.app.app_context():
+                path = flask_package_mgr.get_db().execute("SELECT package_filepath FROM filestore WHERE volume = 'fast'").fetchone()[0]
+            r, response = get_package(client, token, 'volume', '1.0')
+            assert 200 == r.status_code
+            assert '/protected/fast/' + os.path.relpath(path, volume_a) == r.headers['X-Accel-Redirect']
+
+            flask_package_mgr.app.config['STORAGE_VOLUMES'][0]['accel_prefix'] = '/fast'
+            flask_package_mgr.app.config['FILEPATH_CACHE_ENABLED'] = False
+            r, response = get_package(client, token, 'volume', '1.0')
+            assert '/fast/' + os.path.relpath(path, volume_a) == r.headers['X-Accel-Redirect']
+            # files from before volumes were configured stay under DOWNLOAD_ACCEL_PREFIX
+            r, response = get_package(client, token, 'test', '1.0')
+            assert '/protected/' + os.path.relpath(stored, upload_folder) == r.headers['X-Accel-Redirect']
+        finally:
+            flask_package_mgr.app.config['STORAGE_VOLUMES'] = None
+            flask_package_mgr.app.config['FILEPATH_CACHE_ENABLED'] = True
+            shutil.rmtree(volume_a)
+            shutil.rmtree(volume_b)
+    finally:
+        flask_package_mgr.app.config['DOWNLOAD_MODE'] = 'direct'
+
+def test_precompressed_variants(client):
+    import gzip
+    from flask_package_mgr.compression import compress_pending
+
+    token = add_base_user_and_get_token(client)
+    text = ''.join('line {n} of a text heavy artifact\n'.format(n=n) for n in range(2000))
+    with open(test_filenames[1], 'wb') as f:
+        f.write(text)
+    with open(test_filenames[2], 'wb') as f:
+        f.write(os.urandom(64 * 1024))
+    assert 200 == add_package_filename(client, token, 'text', '1.0', local_filename=test_filenames[1]).status_code
+    assert 200 == add_package_filename(client, token, 'random', '1.0', local_filename=test_filenames[2]).status_code
+
+    old_encodings = flask_package_mgr.app.config['COMPRESS_ENCODINGS']
+    flask_package_mgr.app.config['COMPRESS_ENCODINGS'] = [ 'gzip' ]
+    try:
+        with flask_package_mgr.app.app_context():
+            # the random file compresses too poorly to keep a copy
+            assert (2, 1) == compress_pending()
+            assert (0, 0) == compress_pending()
+            rows = flask_package_mgr.get_db().execute('SELECT package_filepath, gzip_size, compressed FROM filestore ORDER BY id').fetchall()
+    finally:
+        flask_package_mgr.app.config['COMPRESS_ENCODINGS'] = old_encodings
+    assert [ 1, 1 ] == [ row['compressed'] for row in rows ]
+    assert rows[0]['gzip_size'] == os.path.getsize(rows[0]['package_filepath'] + '.gz')
+    assert rows[0]['gzip_size'] < len(text) // 10
+    assert rows[1]['gzip_size'] is None
+
+    def download(package_name, headers):
+        headers['token'] = token
+        return client.get('/api/v1/packages/{p}/1.0'.format(p=package_name), data=json.dumps({}),
+                content_type='application/json', headers=headers)
+
+    r = download('text', { 'Accept-Encoding' : 'gzip, deflate' })
+    assert 200 == r.status_code
+    assert 'gzip' == r.headers['Content-Encoding']
+    assert 'Accept-Encoding' in r.headers['Vary']
+    assert rows[0]['gzip_size'] == len(r.data)
+    assert text == gzip.GzipFile(fileobj=StringIO(r.data)).read()
+    etag = r.headers['ETag']
+    assert '-gzip"' in etag
+
+    r = download('text', { 'Accept-Encoding' : 'gzip', 'If-None-Match' : etag })
+    assert 304 == r.status_code
+    assert 'Accept-Encoding' in r.headers['Vary']
+
+    # clients that do not accept gzip get the file as uploaded
+    for headers in ({}, { 'Accept-Encoding' : 'gzip;q=0, identity' }):
+        r = download('text', headers)
+        assert 200 == r.status_code
+        assert 'Content-Encoding' not in r.headers
+        assert 'Accept-Encoding' in r.headers['Vary']
+        assert text == r.data
+
+    r = download('random', { 'Accept-Encoding' : 'gzip' })
+    assert 200 == r.status_code
+    assert 'Content-Encoding' not in r.headers
+    assert 'Vary' not in r.headers
+
+    # a variant that is gone is skipped for the file as uploaded
+    os.remove(rows[0]['package_filepath'] + '.gz')
+    r = download('text', { 'Accept-Encoding' : 'gzip' })
+    assert 200 == r.status_code
+    assert 'Content-Encoding' not in r.headers
+    assert text == r.data
+
+    # so are several ranges of it
+    r = download('text', { 'Accept-Encoding' : 'gzip', 'Range' : 'bytes=0-9,100-109' })
+    assert 206 == r.status_code
+    assert r.headers['Content-Type'].startswith('multipart/byteranges; boundary=')
+    assert 'Content-Encoding' not in r.headers
+    assert text[0:10] in r.data
+    assert text[100:110] in r.data
+    assert 'Content-Range: bytes 100-109/{l}'.format(l=len(text)) in r.data
+
+def test_reshard_blobs(client):
+    from flask_package_mgr.filestore import reshard_blobs
+
+    token = add_base_user_and_get_token(client)
+    assert 200 == add_package(client, token, 'test', '1.0').status_code
+    root = os.path.join(os.path.abspath(flask_package_mgr.app.config['UPLOAD_FOLDER']), 'blobs')
+    with flask_package_mgr.app.app_context():
+        row = flask_package_mgr.get_db().execute('SELECT package_filepath, digest FROM filestore').fetchone()
+    old_path, digest = row['package_filepath'], row['digest']
+    assert os.path.join(root, digest[0:2], digest[2:4], digest) == old_path
+    # a download caches the old path
+    r, response = get_package(client, token, 'test', '1.0')
+    assert 200 == r.status_code
+
+    flask_package_mgr.app.config['BLOB_FANOUT_LEVELS'] = 1
+    flask_package_mgr.app.config['BLOB_FANOUT_WIDTH'] = 3
+    try:
+        with flask_package_mgr.app.app_context():
+            assert (1, 0) == reshard_blobs(grace=0)
+            assert (0, 0) == reshard_blobs(grace=0)
+            new_path = flask_package_mgr.get_db().execute('SELECT package_filepath FROM filestore').fetchone()['package_filepath']
+        assert os.path.join(root, digest[0:3], digest) == new_path
+        assert os.path.isfile(new_path)
+        assert not os.path.exists(old_path)
+        assert not os.path.exists(os.path.join(root, digest[0:2]))
+
+        r, response = get_package(client, token, 'test', '1.0')
+        assert 200 == r.status_code
+        assert open(test_filenames[0]).read() == r.data
+
+        # the same content published again is stored once, at its new path
+        assert 200 == add_package(client, token, 'fork', '1.0').status_code
+        with flask_package_mgr.app.app_context():
+            filestore = flask_package_mgr.get_db().execute('SELECT package_filepath, refcount FROM filestore').fetchall()
+        assert [ (new_path, 2) ] == [ (row['package_filepath'], row['refcount']) for row in filestore ]
+    finally:
+        flask_package_mgr.app.config['BLOB_FANOUT_LEVELS'] = 2
+        flask_package_mgr.app.config['BLOB_FANOUT_WIDTH'] = 2
+
+def test_storage_volumes(client):
+    from flask_package_mgr.filestore import drain_volumes
+
+    token = add_base_user_and_get_token(client)
+    # stored before any volumes were configured, on UPLOAD_FOLDER
+    assert 200 == add_package(client, token, 'before', '1.0').status_code
+    volume_a = tempfile.mkdtemp()
+    volume_b = tempfile.mkdtemp()
+    flask_package_mgr.app.config['STORAGE_VOLUMES'] = [
+        { 'name' : 'a', 'path' : volume_a, 'weight' : 1 },
+        { 'name' : 'b', 'path' : volume_b, 'weight' : 0 }
+        ]
+    try:
+        with open(test_filenames[1], 'wb') as f:
+            f.write('stored on a volume')
+        assert 200 == add_package_filename(client, token, 'after', '1.0', local_filename=test_filenames[1]).status_code
+        with flask_package_mgr.app.app_context():
+            rows = flask_package_mgr.get_db().execute('SELECT package_filepath, volume FROM filestore ORDER BY id').fetchall()
+        assert [ 'default', 'a' ] == [ row['volume'] for row in rows ]
+        assert rows[1]['package_filepath'].startswith(volume_a)
+
+        r, response = get_package(client, token, 'after', '1.0')
+        assert 200 == r.status_code
+        assert 'stored on a volume' == r.data
+
+        r = client.get('/api/v1/admin/stats')
+        volumes = json.loads(r.data)['volumes']
+        assert set([ 'default', 'a', 'b' ]) == set(volumes)
+        assert 1 == volumes['a']['files']
+        assert 1 == volumes['a']['files_written']
+        assert 1 == volumes['a']['files_read']
+        assert len('stored on a volume') == volumes['a']['bytes_read']
+        assert volumes['default']['drain']
+        assert 0 < volumes['a']['free_bytes'] <= volumes['a']['total_bytes']
+
+        # drain a, and UPLOAD_FOLDER which is no longer listed, onto b
+        flask_package_mgr.app.config['STORAGE_VOLUMES'] = [
+            { 'name' : 'a', 'path' : volume_a, 'weight' : 1, 'drain' : True },
+            { 'name' : 'b', 'path' : volume_b, 'weight' : 1 }
+            ]
+        with flask_package_mgr.app.app_context():
+            assert (2, 0) == drain_volumes(grace=0)
+            assert (0, 0) == drain_volumes(grace=0)
+            moved = flask_package_mgr.get_db().execute('SELECT package_filepath, volume FROM filestore ORDER BY id').fetchall()
+        assert [ 'b', 'b' ] == [ row['volume'] for row in moved ]
+        for row, old in zip(moved, rows):
+            assert row['package_filepath'].startswith(volume_b)
+            assert os.path.isfile(row['package_filepath'])
+            assert not os.path.exists(old['package_filepath'])
+        assert not os.path.exists(os.path.join(volume_a, 'blobs', rows[1]['package_filepath'].split(os.sep)[-1][0:2]))
+
+        for package_name, data in (('before', open(test_filenames[0]).read()), ('after', 'stored on a volume')):
+            r, response = get_package(client, token, package_name, '1.0')
+            assert 200 == r.status_code
+            assert data == r.data
+    finally:
+        flask_package_mgr.app.config['STORAGE_VOLUMES'] = None
+        shutil.rmtree(volume_a)
+        shutil.rmtree(volume_b)
+
+def test_durability_levels(client):
+    token = add_base_user_and_get_token(client)
+    try:
+        flask_package_mgr.app.config['DURABILITY'] = 'none'
+        assert 200 == add_package(client, token, 'none', '1.0').status_code
+
+        flask_package_mgr.app.config['DURABILITY'] = 'group'
+        flask_package_mgr.app.config['DURABILITY_GROUP_WINDOW'] = 0.05
+        results = {}
+        def publish(i):
+            results[i] = add_package(flask_package_mgr.app.test_client(), token, 'group{i}'.format(i=i), '1.0').status_code
+        threads = [ threading.Thread(target=publish, args=(i, )) for i in range(6) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [ 200 ] * 6 == [ results[i] for i in range(6) ]
+
+        syncer = json.loads(client.get('/api/v1/admin/stats').data)['group_syncer']
+        # every publish syncs its upload before it is linked in and its directories after
+        assert 12 == syncer['submitted']
+        assert 12 > syncer['syncs']
+        # concurrent publishes wait on the same sync, none of them holds the writer meanwhile
+        assert syncer['batch_size']['count'] > syncer['batch_size']['buckets'][0]['count']
+        assert 0 == syncer['failed_syncs']
+
+        for i in range(6):
+            r, response = get_package(client, token, 'group{i}'.format(i=i), '1.0')
+            assert 200 == r.status_code
+
+        flask_package_mgr.app.config['DURABILITY'] = 'sometimes'
+        assert 500 == add_package(client, token, 'unknown', '1.0').status_code
+    finally:
+        flask_package_mgr.app.config['DURABILITY'] = None
+        flask_package_mgr.app.config['DURABILITY_GROUP_WINDOW'] = 0.002
+    assert 0 == len(os.listdir(os.path.join(flask_package_mgr.app.config['UPLOAD_FOLDER'], 'blobs', 'tmp')))
+
+def test_stopped_group_syncer(client):
+    from flask_package_mgr.durability import get_group_syncer
+
+    upload_folder = flask_package_mgr.app.config['UPLOAD_FOLDER']
+    try:
+        flask_package_mgr.app.config['DURABILITY_GROUP_TIMEOUT'] = 5
+        with flask_package_mgr.app.app_context():
+            syncer = get_group_syncer()
+            syncer.submit([ upload_folder ])
+            # a change of settings replaces the syncer while callers may still hold the old one
+            flask_package_mgr.app.config['DURABILITY_GROUP_WINDOW'] = 0.01
+            assert syncer is not get_group_syncer()
+        # once its thread is gone too
+        syncer._thread.join(5)
+        start = time.time()
+        syncer.submit([ upload_folder ])
+        assert time.time() - start < 5
+        assert 2 == syncer.get_stats()['syncs']
+    finally:
+        flask_package_mgr.app.config['DURABILITY_GROUP_TIMEOUT'] = 30
+        flask_package_mgr.app.config['DURABILITY_GROUP_WINDOW'] = 0.002
+
+def test_scrubber(client):
+    from flask import g
+    from flask_package_mgr.scrubber import scrub, ScrubReport
+
+    token = add_base_user_and_get_token(client)
+    for i, package_name in enumerate(('missing', 'mismatch', 'refcount')):
+        assert 200 == add_package_filename(client, token, package_name, '1.0', local_filename=test_filenames[i]).status_code
+    upload_folder = flask_package_mgr.app.config['UPLOAD_FOLDER']
+    with flask_package_mgr.app.app_context():
+        db = flask_package_mgr.get_db()
+        paths = dict((row['title'], row['package_filepath']) for row in db.execute(
+                'SELECT packages.title, filestore.package_filepath FROM packages JOIN tags ON tags.package_id = packages.id JOIN filestore ON filestore.id = tags.filestore_id'
+                ).fetchall())
+        db.execute("UPDATE filestore SET refcount = 5 WHERE package_filepath = ?", [ paths['refcount'] ])
+        db.execute("INSERT INTO tags (tag, package_id, filestore_id) VALUES ('2.0', 1, 999)")
+        db.commit()
+    os.remove(paths['missing'])
+    with open(paths['mismatch'], 'ab') as f:
+        f.write('corrupted')
+    orphan = os.path.join(upload_folder, 'blobs', 'ab', 'cd', 'abcd' + '0' * 60)
+    os.makedirs(os.path.dirname(orphan))
+    with open(orphan, 'wb') as f:
+        f.write('orphan')
+
+    found = []
+    try:
+        flask_package_mgr.app.config['SCRUB_ORPHAN_MIN_AGE'] = 0
+        with flask_package_mgr.app.app_context():
+            config = dict(flask_package_mgr.app.config, SCRUB_ACTION='report')
+            stats = scrub(ScrubReport(on_finding=found.append), config=config).get_stats()
+            assert { 'missing' : 1, 'mismatch' : 1, 'missing_variant' : 0, 'refcount' : 1, 'dangling_tag' : 1, 'orphan' : 1 } == stats['found']
+            assert 5 == len(found)
+            assert set([ 'reported' ]) == set(finding['action'] for finding in found)
+            assert 3 == stats['rows_checked']
+            assert 4 == stats['tags_checked']
+            assert 3 == stats['files_checked']
+            assert stats['last_pass']['completed']
+            # reporting changes nothing
+            assert os.path.exists(orphan)
+
+            config['SCRUB_ACTION'] = 'repair'
+            stats = scrub(config=config).get_stats()
+            # writes and read batches hand their connections back, publishes need the writer
+            assert not hasattr(g, 'sqlite_db')
+            assert 1 == stats['quarantined']
+            assert 3 == stats['repaired']
+            assert not os.path.exists(orphan)
+            assert not os.path.exists(paths['mismatch'])
+            assert os.path.exists(os.path.join(upload_folder, 'quarantine', os.path.relpath(paths['mismatch'], os.path.join(upload_folder, 'blobs'))))
+
+            # what is left is the two files that are gone, which only a publish can bring back
+            config['SCRUB_ACTION'] = 'report'
+            stats = scrub(config=config).get_stats()
+            assert { 'missing' : 2, 'mismatch' : 0, 'missing_variant' : 0, 'refcount' : 0, 'dangling_tag' : 0, 'orphan' : 0 } == stats['found']
+
+            # the scrubbers of other workers take turns on the lock and space their passes out
+            stats = scrub(config=config, interval=3600).get_stats()
+            assert 1 == stats['skipped']
+            assert 0 == stats['passes']
+            with open(os.path.join(upload_folder, '.scrub.lock'), 'a+') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                stats = scrub(config=config).get_stats()
+                assert 1 == stats['skipped']
+                assert 0 == stats['passes']
+            assert 1 == scrub(config=config).get_stats()['passes']
+    finally:
+        flask_package_mgr.app.config['SCRUB_ORPHAN_MIN_AGE'] = 3600
+
+    r, response = get_package(client, token, 'refcount', '1.0')
+    assert 200 == r.status_code
+
+def test_scrubber_thread(client):
+    flask_package_mgr.app.config['SCRUB_INTERVAL'] = 3600
+    try:
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.shutdown_background_services()
+            # opening a pool starts nothing, the worker's first request starts the scrubber
+            flask_package_mgr.get_pool()
+            assert 'scrubber' not in flask_package_mgr.app.extensions
+        assert 200 == client.get('/api/v1/admin/user_list').status_code
+        stats = json.loads(client.get('/api/v1/admin/stats').data)
+        assert 3600 == stats['scrubber']['interval']
+    finally:
+        flask_package_mgr.app.config['SCRUB_INTERVAL'] = 0
+        with flask_package_mgr.app.app_context():
+            flask_package_mgr.shutdown_background_services()
+
+def test_recorded_file_metadata(client):
+    from werkzeug.http import http_date
+
+    token = add_base_user_and_get_token(client)
+    before = int(time.time())
+    assert 200 == add_package(client, token, 'meta', '1.0').status_code
+    r = client.get('/api/v1/packages/meta', data=json.dumps({ 'details' : True }),
+            content_type='application/json', headers={ 'token' : token })
+    assert 200 == r.status_code
+    tags = json.loads(r.data)
+    assert 1 == len(tags)
+    assert 'test.txt' == tags[0]['filename']
+    assert 'text/plain' == tags[0]['content_type']
+    assert os.path.getsize(test_filenames[0]) == tags[0]['size']
+    assert 64 == len(tags[0]['digest'])
+    assert before <= tags[0]['uploaded'] <= time.time()
+    assert tags[0]['mtime'] is not None
+    # without details listings are as before
+    r = client.get('/api/v1/packages/meta', data=json.dumps({}), content_type='application/json', headers={ 'token' : token })
+    assert [ 'id', 'tag' ] == sorted(json.loads(r.data)[0].keys())
+
+    # downloads are answered from the row, not the file
+    flask_package_mgr.app.config['FILEPATH_CACHE_ENABLED'] = False
+    try:
+        with flask_package_mgr.app.app_context():
+            db = flask_package_mgr.get_db()
+            db.execute("UPDATE filestore SET mtime = 1000000000")
+            db.execute("UPDATE tags SET content_type = 'application/x-recorded'")
+            db.commit()
+            path = db.execute('SELECT package_filepath FROM filestore').fetchone()[0]
+        r, response = get_package(client, token, 'meta', '1.0')
+        assert 200 == r.status_code
+        assert http_date(1000000000) == r.headers['Last-Modified']
+        assert str(tags[0]['size']) == r.headers['Content-Length']
+        # the recorded content type is sent, not one guessed from the filename
+        assert r.headers['Content-Type'].startswith('application/x-recorded')
+        r = client.get('/api/v1/packages/meta/1.0', data=json.dumps({}), content_type='application/json',
+                headers={ 'token' : token, 'If-Modified-Since' : http_date(1000000000) })
+        assert 304 == r.status_code
+
+        # files stored before it was recorded are stat'ed instead
+        with flask_package_mgr.app.app_context():
+            db = flask_package_mgr.get_db()
+            db.execute('UPDATE filestore SET mtime = NULL, content_type = NULL')
+            db.execute('UPDATE tags SET content_type = NULL')
+            db.commit()
+        r, response = get_package(client, token, 'meta', '1.0')
+        assert 200 == r.status_code
+        assert http_date(int(os.path.getmtime(path))) == r.headers['Last-Modified']
+        assert r.headers['Content-Type'].startswith('text/plain')
+
+        # the same content uploaded under another name has the type of that name, the blob
+        # the type of the name it was first stored as and never what the upload declared
+        with flask_package_mgr.app.app_context():
+            db = flask_package_mgr.get_db()
+            db.execute("UPDATE filestore SET content_type = 'text/plain'")
+            db.commit()
+        files = {
+            'file' : (open(test_filenames[0], 'rb'), 'data.npm', 'text/html'),
+            # the json part is read from its filename, see add_package_filename
+            'json' : (StringIO(''), json.dumps({ 'package_name' : 'meta', 'tag' : '2.0' }).replace('"', '\\"'), 'application/json')
+            }
+        assert 200 == client.post('/api/v1/packages', headers={ 'token' : token }, data=files).status_code
+        r, response = get_package(client, token, 'meta', '2.0')
+        assert 200 == r.status_code
+        assert r.headers['Content-Type'].startswith('application/octet-stream')
+        r = client.get('/api/v1/blobs/' + tags[0]['digest'], headers={ 'token' : token })
+        assert r.headers['Content-Type'].startswith('text/plain')
+
+        os.remove(path)
+        r, response = get_package(client, token, 'meta', '1.0')
+        assert 500 == r.status_code
+    finally:
+        flask_package_mgr.app.config['FILEPATH_CACHE_ENABLED'] = True
+
+def test_migrate_to_blobs(client):
+    from flask_package_mgr.filestore import migrate_to_blobs
+
+    token = add_base_user_and_get_token(client)
+    upload_folder = flask_package_mgr.app.config['UPLOAD_FOLDER']
+    # lay out two packages the way older versions stored them, sharing one file
+    with flask_package_mgr.app.app_context():
+        db = flask_package_mgr.get_db()
+        for package_id, title in ((1, 'test'), (2, 'fork')):
+            package_dir = os.path.abspath(os.path.join(upload_folder, title))
+            os.mkdir(package_dir)
+            shutil.copy(test_filenames[0], os.path.join(package_dir, 'test.txt'))
+            db.execute('INSERT INTO packages (id, title, user_id) VALUES (?, ?, 1)', [ package_id, title ])
+            db.execute('INSERT INTO filestore (id, package_filepath) VALUES (?, ?)', [ package_id, os.path.join(package_dir, 'test.txt') ])
+            db.execute('INSERT INTO tags (tag, package_id, filestore_id) VALUES (?, ?, ?)', [ '1.0', package_id, package_id ])
+        db.commit()
+
+        assert (2, 1) == migrate_to_blobs()
+        assert (0, 0) == migrate_to_blobs()
+        filestore = db.execute('SELECT package_filepath, refcount FROM filestore').fetchall()
+    assert 1 == len(filestore)
+    assert 2 == filestore[0]['refcount']
+    assert not os.path.exists(os.path.join(upload_folder, 'test'))
+    assert not os.path.exists(os.path.join(upload_folder, 'fork'))
+
+    for package_name in ('test', 'fork'):
+        r, response = get_package(client, token, package_name, '1.0')
+        assert 200 == r.status_code
+        assert 'filename=test.txt' in r.headers['Content-Disposition']
+        assert open(test_filenames[0]).read() == r.data
+
 def get_package(client, token, package_name, tag):
     token_data = { 'token' : token }
 